@@ -55,10 +55,11 @@ from tailucas_pylib.threads import (
 )
 from tailucas_pylib.zmq import zmq_term
 
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient, MongoClient
 from pymongo.database import Database
 from pymongo.collection import Collection
 from pymongo.cursor import Cursor
+from pymongo.asynchronous.database import AsyncDatabase
 
 from telegram.error import (
     TimedOut
@@ -73,7 +74,7 @@ from telegram.ext import (
     filters
 )
 
-from .influx import influxdb
+from .influx import InfluxDBFlusher, influxdb
 
 from .database import (
     db_startup,
@@ -124,8 +125,20 @@ features = UnleashClient(
 features.initialize_client()
 
 
+from .chart import chart_renderer
 from .currency import CurrencyConverter
+from .indexes import (
+    ACCOUNT_INDEXES,
+    CARD_INDEXES,
+    RATES_INDEXES,
+    index_advisor,
+    provision_indexes
+)
 from .event import TransactionUpdate, SQSEvent
+from .investec import TokenRefresher, investec_clients
+from .latency import MongoCommandTimer, TimedRequest
+from .normalize import NormalizationBackfill, normalization_complete
+from .tracing import TraceExporter, create_exporters, tracer
 from .transaction import TransactionHistory
 
 # Reduce Sentry noise
@@ -154,12 +167,35 @@ def main():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     md_conn: Optional[MongoClient] = None
+    md_async_conn: Optional[AsyncMongoClient] = None
     try:
         # Application threads
+        influxdb_flusher = InfluxDBFlusher()
+        influxdb_flusher.start()
+        trace_exporters = [name.strip() for name in app_config.get('tracing', 'exporters').split(',') if name.strip()]
+        if len(trace_exporters) > 0:
+            log.info(f'Exporting transaction traces using {trace_exporters}...')
+            tracer.configure(
+                exporters=create_exporters(
+                    names=trace_exporters,
+                    file_path=app_config.get('tracing', 'file_path'),
+                    file_max_bytes=app_config.getint('tracing', 'file_max_bytes'),
+                    otlp_endpoint=app_config.get('tracing', 'otlp_endpoint'),
+                    service_name=APP_NAME,
+                    timeout_secs=app_config.getfloat('tracing', 'export_timeout_secs')),
+                queue_size=app_config.getint('tracing', 'queue_size'))
+            trace_exporter = TraceExporter(batch_size=app_config.getint('tracing', 'export_batch_size'))
+            trace_exporter.start()
         currency_converter = CurrencyConverter(
             int_curr_symbol=int_curr_symbol,
             currency_symbol=currency_symbol)
         currency_converter.start()
+        chart_renderer.start(
+            pool_size=app_config.getint('chart', 'pool_size'),
+            render_timeout_secs=app_config.getfloat('chart', 'render_timeout_secs'),
+            backend=app_config.get('chart', 'backend'),
+            cache_max_entries=app_config.getint('chart', 'cache_max_entries'),
+            cache_max_bytes=app_config.getint('chart', 'cache_max_bytes'))
         log.info('Starting local SQLite database...')
         loop.run_until_complete(db_startup())
         # MongoDB cluster
@@ -176,18 +212,51 @@ def main():
         mongodb_account_collection_name = app_config.get('mongodb', 'account_collection_name')
         log.info(f'Opening MongoDB connection {mongodb_account_collection_name}...')
         md_account_collection: Collection = md_db[mongodb_account_collection_name]
+        # local currency rates for report pipelines
+        mongodb_rates_collection_name = app_config.get('mongodb', 'rates_collection_name')
+        if app_config.getboolean('mongodb', 'provision_indexes'):
+            provision_indexes(collection=md_card_collection, indexes=CARD_INDEXES)
+            provision_indexes(collection=md_account_collection, indexes=ACCOUNT_INDEXES)
+            provision_indexes(collection=md_db[mongodb_rates_collection_name], indexes=RATES_INDEXES)
+        if app_config.getboolean('mongodb', 'normalization_backfill'):
+            log.info('Starting normalization of existing transactions...')
+            normalization_backfill = NormalizationBackfill(
+                card_collection=md_card_collection,
+                account_collection=md_account_collection,
+                batch_size=app_config.getint('mongodb', 'normalization_batch_size'))
+            normalization_backfill.start()
+        else:
+            # documents are taken to be normalized already
+            normalization_complete.set()
+        if app_config.getboolean('mongodb', 'index_advisor'):
+            index_advisor(card_collection=md_card_collection, account_collection=md_account_collection)
+        log.info('Starting Investec access token refresher...')
+        investec_clients.configure(refresh_margin_secs=app_config.getint('app', 'access_token_refresh_margin_secs'))
+        token_refresher = TokenRefresher(check_interval_secs=app_config.getint('app', 'access_token_refresh_check_secs'))
+        token_refresher.start()
         log.info('Starting transaction history synchronizer...')
         transaction_history = TransactionHistory(
             mongodb_collection=md_account_collection,
             sync_interval=app_config.getint('app', 'transaction_history_refresh_interval_secs'),
-            do_db_mutations=features.is_enabled('database-mutations-from-recon'))
+            do_db_mutations=features.is_enabled('database-mutations-from-recon'),
+            sync_concurrency=app_config.getint('app', 'transaction_history_sync_concurrency'),
+            min_sync_interval=app_config.getint('app', 'transaction_history_min_interval_secs'),
+            max_sync_interval=app_config.getint('app', 'transaction_history_max_interval_secs'),
+            backfill_days=app_config.getint('app', 'transaction_history_backfill_days'),
+            backfill_window_days=app_config.getint('app', 'transaction_history_backfill_window_days'),
+            backfill_concurrency=app_config.getint('app', 'transaction_history_backfill_concurrency'))
         transaction_history.start()
         log.info('Starting Telegram Bot...')
         """Start the bot."""
         # Create the Application and pass it your bot's token.
-        application = Application.builder().token(creds.telegram_bot_api_token).build()
-        application.bot_data['mongodb_card_collection'] = md_card_collection
-        application.bot_data['mongodb_account_collection'] = md_account_collection
+        application = Application.builder().token(creds.telegram_bot_api_token).request(TimedRequest(connection_pool_size=256)).build()
+        # bot handlers use the async client so that MongoDB I/O does not block the event loop,
+        # application threads keep the synchronous client
+        md_async_conn = AsyncMongoClient(db_url, event_listeners=[MongoCommandTimer()])
+        md_async_db: AsyncDatabase = md_async_conn[mongodb_db_name]
+        application.bot_data['mongodb_card_collection'] = md_async_db[mongodb_card_collection_name]
+        application.bot_data['mongodb_account_collection'] = md_async_db[mongodb_account_collection_name]
+        application.bot_data['mongodb_rates_collection'] = md_async_db[mongodb_rates_collection_name]
         #application.bot_data["custom"] = None
         # bot commands
         command_handlers = [
@@ -231,9 +300,10 @@ def main():
             mongodb_collection=md_card_collection,
             queue_url=app_config.get('aws', 'sqs_queue_url'),
             do_db_mutations=features.is_enabled('database-mutations-from-events'),
-            remove_queued_messages=features.is_enabled('event-queue-remove-messages'))
+            remove_queued_messages=features.is_enabled('event-queue-remove-messages'),
+            trigger_history_sync=True)
         sqs_events.start()
-        influxdb.write('app', 'startup', 1)
+        influxdb.count('app', 'startup')
         monitor = threading.Thread(
             name='LoopTerminator',
             target=terminator,
@@ -253,8 +323,13 @@ def main():
         log.info('Shutting down...')
     finally:
         die()
+        chart_renderer.shutdown()
+        investec_clients.close()
+        influxdb.close()
         if md_conn:
             md_conn.close()
+        if md_async_conn and not loop.is_closed():
+            loop.run_until_complete(md_async_conn.close())
         zmq_term()
         loop.close()
     bye()
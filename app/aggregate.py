@@ -0,0 +1,85 @@
+import heapq
+
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+OTHER_LABEL = 'Other'
+
+# amount, currency code, rate date => amount in local currency
+Converter = Callable[[float, str, Optional[str]], Awaitable[float]]
+
+
+class Aggregator(object):
+    """
+    Accumulates a stream of report rows into a count and total per key,
+    optionally converting each amount to local currency on the way in.
+    Only one entry per key is held, so memory is bounded by the number of
+    distinct keys rather than by the number of rows.
+    """
+    def __init__(self, convert: Optional[Converter] = None):
+        self._convert: Optional[Converter] = convert
+        self._totals: Dict[str, Tuple[int, float]] = {}
+        self._labels: Dict[str, str] = {}
+        self.count: int = 0
+        self.total: float = 0.0
+        # rows that could not be included, which makes the aggregate incomplete
+        self.excluded: int = 0
+
+    async def add(self, key: str, amount: float, count: int = 1, label: Optional[str] = None, currency: Optional[str] = None, rate_date: Optional[str] = None) -> float:
+        if amount == 0:
+            return 0.0
+        if self._convert and currency:
+            amount = await self._convert(amount, currency, rate_date)
+        self.put(key=key, amount=amount, count=count, label=label)
+        return amount
+
+    def put(self, key: str, amount: float, count: int = 1, label: Optional[str] = None) -> None:
+        key_count, key_total = self._totals.get(key, (0, 0.0))
+        self._totals[key] = (key_count + count, key_total + amount)
+        if key not in self._labels:
+            # the first label seen for the key is the one shown
+            self._labels[key] = label or key
+        self.count += count
+        self.total += amount
+
+    def exclude(self, count: int) -> None:
+        self.excluded += count
+
+    def get(self, key: str) -> Tuple[int, float]:
+        return self._totals.get(key, (0, 0.0))
+
+    def top(self, n: Optional[int] = None) -> List[Tuple[str, float]]:
+        """
+        Labels and totals in descending order of total. When limited to the
+        top n, everything else is summed into a trailing "Other" entry.
+        """
+        if n is None or len(self._totals) <= n:
+            ranked = sorted(self._totals.items(), key=lambda item: item[1][1], reverse=True)
+        else:
+            ranked = heapq.nlargest(n, self._totals.items(), key=lambda item: item[1][1])
+        top = [(self._labels[key], total) for key, (_, total) in ranked]
+        if len(ranked) < len(self._totals):
+            other = self.total - sum(total for _, total in top)
+            if other > 0:
+                top.append((OTHER_LABEL, other))
+        return top
+
+    def to_dict(self) -> Dict:
+        return {
+            'rows': [[key, self._labels[key], count, total] for key, (count, total) in self._totals.items()]
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Aggregator':
+        aggregator = cls()
+        for key, label, count, total in data['rows']:
+            aggregator.put(key=key, amount=total, count=count, label=label)
+        return aggregator
+
+    def to_plot(self, n: int) -> Dict[str, List]:
+        to_plot = {'Merchant': [], 'Total': []}
+        for label, total in self.top(n=n):
+            to_plot['Merchant'].append(label)
+            to_plot['Total'].append(total)
+        return to_plot
+
@@ -1,3 +1,5 @@
+import asyncio
+
 from bson.json_util import dumps, loads
 from bson.objectid import ObjectId
 
@@ -7,16 +9,12 @@ import locale
 import random
 import re
 
-import pandas as pd
-import plotly.express as px
-
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
-from typing import Optional, Tuple, Sequence
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Sequence
 
-from pymongo.collection import Collection
-from pymongo.cursor import Cursor
+from pymongo.asynchronous.collection import AsyncCollection
 
 from sentry_sdk.integrations.logging import ignore_logger
 
@@ -45,9 +43,22 @@ from telegram.ext import (
     ConversationHandler
 )
 
-from investec_api_python import InvestecOpenApiClient
 from .event import TransactionUpdate, CustomContext
-from .currency import local_currency
+from .aggregate import Aggregator
+from .chart import Chart, chart_renderer
+from .currency import local_currency, materialize_rates
+from .investec import PooledInvestecClient, investec_clients
+from .latency import timed_handler
+from .tracing import Trace
+from .pipeline import (
+    account_debits_pipeline,
+    account_history_pipeline,
+    card_charges_pipeline,
+    card_rate_keys_pipeline
+)
+from .normalize import normalization_complete
+from .notification import NotificationContext, notification_contexts
+from .totals import CardTotals, running_totals
 
 
 # Reduce Sentry noise
@@ -76,12 +87,15 @@ REPORT_INTERVAL_TYPE_DATE = 1
 
 DEFAULT_TAG_UNTAGGED = '_untagged_'
 DEFAULT_ALL = '_all_'
-DEFAULT_INTERVAL = '_month_'
 
 USER_DATA_KEY_PAY_DAY = 'save_pay_day'
 USER_DATA_KEY_BILL_CYCLE_DAY = 'save_bill_cycle_day'
 USER_DATA_KEY_DEFAULT_DAY = 'save_default_day'
 
+# transaction notifications waiting out the coalescing window,
+# keyed on Telegram user, card and merchant
+pending_notifications: Dict[Tuple[int, str, str], List[TransactionUpdate]] = {}
+
 from .influx import influxdb
 
 from .database import (
@@ -104,24 +118,53 @@ from .database import (
     add_cards,
     add_interval_setting,
     get_interval_setting,
-    delete_interval_setting
+    delete_interval_setting,
+    get_period_report,
+    add_period_report,
+    get_sync_watermark
+)
+from .crypto import digest
+from .period import (
+    DEFAULT_INTERVAL,
+    describe_report_period,
+    get_datetime_a_month_ago,
+    get_last_of_day,
+    get_report_period
 )
 
 
-def get_datetime_a_month_ago() -> datetime:
-    now = datetime.now()
-    a_month_ago = now - relativedelta(months=1)
-    return a_month_ago
-
-
-def get_last_of_day(day: int) -> datetime:
-    now = datetime.now()
-    if now.day >= day:
-        this_month = now.replace(day=day)
-        return this_month
-    else:
-        previous_month = (now - relativedelta(months=1)).replace(day=day)
-        return previous_month
+async def get_period_aggregate(telegram_user_id: int, user_id: int, report_name: str, subjects: List[str], period_start: datetime, period_end: Optional[datetime], compute: Callable[[], Awaitable[Aggregator]], cacheable: bool = True) -> Aggregator:
+    settle_days: int = app_config.getint('app', 'report_cache_settle_days')
+    # late postings can still land in a recently closed period
+    if period_end is None or period_end > datetime.now() - timedelta(days=settle_days):
+        return await compute()
+    if not normalization_complete.is_set() or not cacheable:
+        # older documents are not yet matched by the report filters, or not all fetched
+        influxdb.count('bot', 'period_report_cache_bypass')
+        return await compute()
+    report_key = digest(payload=f'{report_name}:{",".join(sorted(subjects))}')
+    period_report = await get_period_report(
+        telegram_user_id=telegram_user_id,
+        user_id=user_id,
+        report_key=report_key,
+        period_start=period_start,
+        period_end=period_end)
+    if period_report:
+        influxdb.count('bot', 'period_report_cache_hit')
+        return Aggregator.from_dict(data=period_report.report)
+    influxdb.count('bot', 'period_report_cache_miss')
+    aggregator = await compute()
+    if aggregator.excluded > 0:
+        # computed again once the missing rows can be included
+        return aggregator
+    await add_period_report(
+        telegram_user_id=telegram_user_id,
+        user_id=user_id,
+        report_key=report_key,
+        period_start=period_start,
+        period_end=period_end,
+        report=aggregator.to_dict())
+    return aggregator
 
 
 def split_camel_case(s: str) -> str:
@@ -147,7 +190,7 @@ async def validate(command_name: str, update: Update, validate_registration=True
     else:
         log.debug(f'Telegram user {user.id} is in the allow-list: {allowed_users}')
     log.info(f'{command_name}: Telegram user ID {user.id} (language {user.language_code}).')
-    influxdb.write('command', f'{command_name}', 1)
+    influxdb.count('command', f'{command_name}')
     db_user: Optional[User] = None
     if validate_registration:
         db_user = await get_user(telegram_user_id=user.id)
@@ -172,6 +215,7 @@ async def validate(command_name: str, update: Update, validate_registration=True
     return db_user
 
 
+@timed_handler
 async def accounts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=ChatAction.TYPING)
     db_user: User = await validate(command_name='accounts', update=update)
@@ -189,67 +233,48 @@ async def accounts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     for account in accounts:
         log.debug(f'Telegram user {user.id} selects account ID {account.account_id}')
         # fetch associated transaction data
-        mongodb_query = {
-            "accountId": {
-                "$eq": account.account_id
-            },
-        }
-        if not app_config.getboolean('app', 'demo_mode'):
-            mongodb_query["dateTime"] = {
-                "$gte": start_date
-            }
-        projection = {}
-        sort = []
-        md_collection: Collection = context.bot_data['mongodb_account_collection']
-        log.debug(f'Fetching data from MongoDB collection...')
-        cursor = md_collection.find(mongodb_query, projection=projection, sort=sort)
-        costs = {}
-        i=0
-        total_debit: float = 0
-        for doc in cursor:
-            tran_type = doc['type']
-            if tran_type == 'CREDIT':
-                continue
-            charge_local_currency = float(doc['amount'])
-            if charge_local_currency == 0:
-                continue
-            i+=1
-            description = html.unescape(doc['description'])
+        query_start_date = start_date
+        if app_config.getboolean('app', 'demo_mode'):
+            query_start_date = None
+        top_n = 15
+        pipeline = account_debits_pipeline(account_id=account.account_id, start_date=query_start_date)
+        md_collection: AsyncCollection = context.bot_data['mongodb_account_collection']
+        log.debug(f'Running MongoDB aggregation {pipeline=}...')
+        cursor = await md_collection.aggregate(pipeline)
+        debits = Aggregator()
+        async for row in cursor:
+            description = html.unescape(row['_id'])
+            charge_local_currency = float(row['total'])
             if app_config.getboolean('app', 'demo_mode'):
                 log.warning(f'Demo mode enabled! Generating fake description and amount for Telegram user {user.id}.')
                 description = random.choice(random_words).strip().title()
                 charge_local_currency = random.uniform(1.0, charge_local_currency)
-            total_debit += charge_local_currency
-            if description not in costs.keys():
-                costs[description] = charge_local_currency
-            else:
-                costs[description] += charge_local_currency
+            await debits.add(key=description, amount=charge_local_currency, count=row['count'])
+        i = debits.count
+        total_debit = debits.total
         account_info = loads(account.account_info)
         account_name = account_info['productName']
         account_number = account_info['accountNumber']
         date_string = date.strftime("%d %B %Y")
         caption = f'{account_name} ({account_number}) has {i} debits coming to a total of {locale.currency(total_debit)} since {date_string}.'
         if i > 0:
-            to_plot = {'Merchant': [], 'Total': []}
-            for merchant, amount_mind in costs.items():
-                to_plot['Merchant'].append(merchant)
-                to_plot['Total'].append(amount_mind)
             # output totals
             if app_config.getboolean('app', 'demo_mode'):
                 log.warning(f'Demo mode enabled! Generating fake account number and amount for Telegram user {user.id}.')
                 account_number = random.randint(10010000000, 10020000000)
             log.debug(f'Generating graphic of account activity...')
-            df = pd.DataFrame(to_plot)
-            # plot the top n
-            top_n = 15
-            fig = px.pie(df.nlargest(top_n, 'Total'), values='Total', names='Merchant', title=f'Top {top_n} {account_name} debits since {date_string}')
-            img_bytes = fig.to_image(format="png")
-            await update.message.reply_photo(photo=img_bytes, caption=caption)
+            chart: Optional[Chart] = await chart_renderer.pie(to_plot=debits.to_plot(n=top_n), title=f'Top {top_n} {account_name} debits since {date_string}')
+            if chart:
+                message = await update.message.reply_photo(photo=chart.photo, caption=caption)
+                chart_renderer.uploaded(chart=chart, message=message)
+            else:
+                await update.message.reply_markdown(text=caption)
         else:
             await update.message.reply_markdown(text=caption)
     return ConversationHandler.END
 
 
+@timed_handler
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     db_user: User = await validate(command_name='history', update=update)
     if db_user is None:
@@ -278,6 +303,7 @@ async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+@timed_handler
 async def account_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     db_user: User = await validate(command_name='account_history', update=update)
@@ -290,61 +316,82 @@ async def account_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         parse_mode=ParseMode.MARKDOWN)
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
-    mongodb_query: dict = {}
     log.debug(f'{query.data=}')
-    account_id = query.data.split(':')[1]
-    log.debug(f'Telegram user {user.id} selects account ID {account_id}')
+    callback_data = query.data.split(':')
+    account_selection = callback_data[1]
+    periods_ago = int(callback_data[2]) if len(callback_data) > 2 else 0
+    log.debug(f'Telegram user {user.id} selects account ID {account_selection} ({periods_ago} periods ago)')
     # fetch associated transaction data
-    if account_id != DEFAULT_ALL:
-        mongodb_query['accountId'] = {
-            "$eq": account_id
-        }
-    date = get_datetime_a_month_ago()
-    start_date = date.strftime('%Y-%m-%d')
-    mongodb_query['transactionDate'] = {
-        "$gte": start_date
-    }
-    projection = {}
-    sort = []
-    md_collection: Collection = context.bot_data['mongodb_account_collection']
-    log.debug(f'Fetching data from MongoDB collection: {mongodb_query=}...')
-    cursor = md_collection.find(mongodb_query, projection=projection, sort=sort)
-
-    costs = {}
-    for tran in cursor:
-        log.debug(f'{tran=}')
-        if tran['type'] == 'CREDIT':
-            continue
-        tran_amnt = float(tran['amount'])
-        if tran_amnt == 0:
-            continue
+    account_id = account_selection
+    account_ids: List[str] = [account_id]
+    if account_id == DEFAULT_ALL:
+        account_id = None
+        accounts: Optional[Sequence[Account]] = await get_accounts(telegram_user_id=user.id, user_id=db_user.id)
+        account_ids = [account.account_id for account in accounts] if accounts else []
+    # the history of an account is incomplete until its first sync or backfill finishes
+    synced: bool = len(account_ids) > 0
+    for subject_account_id in account_ids:
+        if await get_sync_watermark(telegram_user_id=user.id, user_id=db_user.id, account_id=subject_account_id) is None:
+            synced = False
+            break
+    period_start, period_end = get_report_period(interval=DEFAULT_INTERVAL, periods_ago=periods_ago)
+    costs = await get_period_aggregate(
+        telegram_user_id=user.id,
+        user_id=db_user.id,
+        report_name='account_history',
+        subjects=account_ids,
+        period_start=period_start,
+        period_end=period_end,
+        cacheable=synced,
+        compute=lambda: account_history_costs(
+            context=context,
+            telegram_user_id=user.id,
+            account_id=account_id,
+            start_date=period_start.strftime('%Y-%m-%d'),
+            end_date=period_end.strftime('%Y-%m-%d') if period_end else None))
+    period_description = describe_report_period(period_start=period_start, period_end=period_end)
+    messages = [f'{period_description[:1].upper()}{period_description[1:]}:']
+    for tran_detail, tran_amnt in costs.top():
+        messages.append(f'`{locale.currency(tran_amnt)}` *{tran_detail}*')
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("Previous Month", callback_data=f'{ACTION_ACCOUNT_HISTORY}:{account_selection}:{periods_ago+1}')
+    ]])
+    await query.edit_message_text(
+        text='\n'.join(messages),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=reply_markup
+    )
+    return ConversationHandler.END
+
+
+async def account_history_costs(context: ContextTypes.DEFAULT_TYPE, telegram_user_id: int, account_id: Optional[str], start_date: str, end_date: Optional[str]) -> Aggregator:
+    pipeline = account_history_pipeline(account_id=account_id, start_date=start_date, end_date=end_date)
+    md_collection: AsyncCollection = context.bot_data['mongodb_account_collection']
+    log.debug(f'Running MongoDB aggregation {pipeline=}...')
+    cursor = await md_collection.aggregate(pipeline)
+
+    costs = Aggregator()
+    async for row in cursor:
+        log.debug(f'{row=}')
+        tran_amnt = float(row['total'])
         if app_config.getboolean('app', 'demo_mode'):
-            log.warning(f'Demo mode enabled! Generating fake amount for Telegram user {user.id}.')
+            log.warning(f'Demo mode enabled! Generating fake amount for Telegram user {telegram_user_id}.')
             tran_amnt = random.uniform(1.0, tran_amnt)
-        tran_detail = tran['transactionType']
+        tran_detail = row['_id'].get('transactionType')
         if tran_detail is None:
-            tran_detail: str = tran['description']
+            tran_detail: str = row['_id']['description']
             tran_detail = tran_detail.title().replace('*', ' ')
         else:
             tran_detail = split_camel_case(s=tran_detail)
         if app_config.getboolean('app', 'demo_mode'):
-            log.warning(f'Demo mode enabled! Generating fake transaction type {user.id}.')
+            log.warning(f'Demo mode enabled! Generating fake transaction type {telegram_user_id}.')
             if tran_detail.startswith('Cross-Border Card Fee'):
                 tran_detail = 'Cross-Border Card Fee'
-        if tran_detail not in costs:
-            costs[tran_detail] = tran_amnt
-        else:
-            costs[tran_detail] += tran_amnt
-    messages = [f'Since `{start_date}`:']
-    for tran_detail, tran_amnt in costs.items():
-        messages.append(f'`{locale.currency(tran_amnt)}` *{tran_detail}*')
-    await query.edit_message_text(
-        text='\n'.join(messages),
-        parse_mode=ParseMode.MARKDOWN
-    )
-    return ConversationHandler.END
+        await costs.add(key=tran_detail, amount=tran_amnt, count=row['count'])
+    return costs
 
 
+@timed_handler
 async def cards(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     db_user: User = await validate(command_name='cards', update=update)
     if db_user is None:
@@ -386,6 +433,7 @@ async def cards(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+@timed_handler
 async def card_report_interval(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
     user: TelegramUser = update.effective_user
@@ -419,6 +467,7 @@ async def card_report_interval(update: Update, context: ContextTypes.DEFAULT_TYP
     return ConversationHandler.END
 
 
+@timed_handler
 async def card_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
     user: TelegramUser = update.effective_user
@@ -427,19 +476,22 @@ async def card_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     # CallbackQueries need to be answered, even if no notification to the user is needed
     # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
     await query.answer()
-    await query.edit_message_text(text=f'{emoji.emojize(":hourglass_not_done:")}', parse_mode=ParseMode.MARKDOWN)
 
     callback_data = query.data.split(':')
     card_id = callback_data[1]
     interval = callback_data[2]
-    date = None
-    if interval == DEFAULT_INTERVAL:
-        date = get_datetime_a_month_ago()
+    periods_ago = int(callback_data[3]) if len(callback_data) > 3 else 0
+    if query.message.photo or len(callback_data) > 3:
+        # an earlier report stays in place, and a chart has no text to edit
+        status_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=f'{emoji.emojize(":hourglass_not_done:")}', parse_mode=ParseMode.MARKDOWN)
     else:
-        date = get_last_of_day(day=int(interval))
-    start_date = date.strftime('%Y-%m-%d')
+        await query.edit_message_text(text=f'{emoji.emojize(":hourglass_not_done:")}', parse_mode=ParseMode.MARKDOWN)
+        status_message = query.message
+    period_start, period_end = get_report_period(interval=interval, periods_ago=periods_ago)
+    start_date = period_start.strftime('%Y-%m-%d')
+    end_date = period_end.strftime('%Y-%m-%d') if period_end else None
 
-    log.debug(f'Telegram user {user.id} selects card ID {card_id} with interval {interval} ({start_date})')
+    log.debug(f'Telegram user {user.id} selects card ID {card_id} with interval {interval} ({start_date} to {end_date})')
     cards: Sequence[Card] = []
     account_numbers = []
     card_ids = []
@@ -459,77 +511,86 @@ async def card_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
             await add_interval_setting(user_id=db_user.id, report_interval_type=REPORT_INTERVAL_TYPE_MONTH, report_interval_days=31, card_id=int(card.card_id))
         else:
             await add_interval_setting(user_id=db_user.id, report_interval_type=REPORT_INTERVAL_TYPE_DATE, report_interval_days=int(interval), card_id=int(card.card_id))
+    notification_contexts.invalidate(telegram_user_id=user.id)
 
-    log.debug(f'Running MongoDB query: {account_numbers=}, {card_ids=}')
+    log.debug(f'Running MongoDB aggregation: {account_numbers=}, {card_ids=}')
     # fetch associated transaction data
-    reference = {
-        "$not": { "$regex": "^simulation*" }
-    }
-    if app_config.getboolean('app', 'demo_mode'):
+    simulation_only: bool = app_config.getboolean('app', 'demo_mode')
+    if simulation_only:
         log.warning(f'Demo mode enabled! Using simulation references only for Telegram user {user.id}.')
-        reference = {
-            "$regex": "^simulation*"
-        }
-    mongo_query = {
-        "accountNumber": {
-            "$in": account_numbers
-        },
-        "card.id" : {
-            "$in": card_ids
-        },
-        "type": "card",
-        "dateTime": {
-            "$gte": start_date
-        },
-        "reference": reference
-    }
-    projection = {}
-    sort = []
-    md_collection: Collection = context.bot_data['mongodb_card_collection']
-    log.debug(f'Fetching data from MongoDB collection...')
-    cursor = md_collection.find(mongo_query, projection=projection, sort=sort)
-    costs = {}
-    i=0
-    for doc in cursor:
-        reference: str = doc['reference']
-        cents_amount = int(doc['centsAmount'])
-        if cents_amount == 0:
-            continue
-        i+=1
-        charge_cents_local_currency = await local_currency(
-            charge_cents=cents_amount,
-            charge_currency=str(doc['currencyCode']).upper(),
-            charge_date=str(doc['dateTime']).split('T')[0])
-        merchant = doc['merchant']['name']
-        if merchant not in costs.keys():
-            costs[merchant] = charge_cents_local_currency
-        else:
-            costs[merchant] += charge_cents_local_currency
+    charges = await get_period_aggregate(
+        telegram_user_id=user.id,
+        user_id=db_user.id,
+        report_name='card_report_simulation' if simulation_only else 'card_report',
+        subjects=card_ids,
+        period_start=period_start,
+        period_end=period_end,
+        compute=lambda: card_charges(
+            context=context,
+            account_numbers=account_numbers,
+            card_ids=card_ids,
+            start_date=start_date,
+            end_date=end_date,
+            simulation_only=simulation_only))
+    i = charges.count
     log.debug(f'{i} transactions fetched.')
-    to_plot = {'Merchant': [], 'Total': []}
-    total_charges: float = 0.0
-    for merchant, amount_mind in costs.items():
-        to_plot['Merchant'].append(merchant)
-        to_plot['Total'].append(amount_mind)
-        total_charges += amount_mind
     # switch to major denomination
-    total_charges = total_charges / 100.0
-    date_string = date.strftime("%d %B %Y")
-    caption = f'{i} charges coming to a total of {locale.currency(total_charges)} since {date_string}.'
+    total_charges = charges.total / 100.0
+    period_description = describe_report_period(period_start=period_start, period_end=period_end)
+    caption = f'{i} charges coming to a total of {locale.currency(total_charges)} {period_description}.'
+    if charges.excluded > 0:
+        caption += f' {charges.excluded} charges without a currency rate are left out.'
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("Previous Period", callback_data=f'{ACTION_CARD_REPORT}:{card_id}:{interval}:{periods_ago+1}')
+    ]])
     # remove the emoji
-    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.effective_message.id)
+    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status_message.message_id)
+    chart: Optional[Chart] = None
     if i > 0:
         top_n = 15
-        df = pd.DataFrame(to_plot)
         card_labels = ','.join(sorted(card_names))
-        fig = px.pie(df.nlargest(top_n, 'Total'), values='Total', names='Merchant', title=f'Top {top_n} charges on {card_labels} since {date_string}')
-        img_bytes = fig.to_image(format="png")
-        await context.bot.send_photo(chat_id=update.effective_chat.id, photo=img_bytes, caption=caption)
+        chart = await chart_renderer.pie(to_plot=charges.to_plot(n=top_n), title=f'Top {top_n} charges on {card_labels} {period_description}')
+    if chart:
+        message = await context.bot.send_photo(chat_id=update.effective_chat.id, photo=chart.photo, caption=caption, reply_markup=reply_markup)
+        chart_renderer.uploaded(chart=chart, message=message)
     else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=caption, parse_mode=ParseMode.MARKDOWN)
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
     return ConversationHandler.END
 
 
+async def card_charges(context: ContextTypes.DEFAULT_TYPE, account_numbers: List[str], card_ids: List[str], start_date: str, end_date: Optional[str], simulation_only: bool) -> Aggregator:
+    md_collection: AsyncCollection = context.bot_data['mongodb_card_collection']
+    rates_collection: AsyncCollection = context.bot_data['mongodb_rates_collection']
+    # rates must be in place before the report pipeline looks them up
+    cursor = await md_collection.aggregate(card_rate_keys_pipeline(
+        account_numbers=account_numbers,
+        card_ids=card_ids,
+        start_date=start_date,
+        simulation_only=simulation_only,
+        end_date=end_date))
+    rate_keys = [(row['_id']['currencyCode'], row['_id']['rateDate']) async for row in cursor]
+    await materialize_rates(rates_collection=rates_collection, rate_keys=rate_keys)
+    pipeline = card_charges_pipeline(
+        account_numbers=account_numbers,
+        card_ids=card_ids,
+        start_date=start_date,
+        simulation_only=simulation_only,
+        rates_collection=rates_collection.name,
+        end_date=end_date)
+    log.debug(f'Fetching data from MongoDB collection...')
+    cursor = await md_collection.aggregate(pipeline)
+    charges = Aggregator()
+    async for row in cursor:
+        converted = row['count'] - row['unconverted']
+        if row['unconverted'] > 0:
+            log.warning(f"{row['unconverted']} charges from {row['merchantName']} have no currency rate and are left out of the report.")
+            charges.exclude(count=row['unconverted'])
+        if converted > 0:
+            charges.put(key=row['_id'], amount=row['localCents'], count=converted, label=row['merchantName'])
+    return charges
+
+
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     response_message = None
     reply_markup = None
@@ -571,6 +632,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+@timed_handler
 async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     db_user: User = await validate(command_name='refresh', update=update)
@@ -582,45 +644,45 @@ async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         text=f'{emoji.emojize(":hourglass_not_done:")}',
         parse_mode=ParseMode.MARKDOWN)
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    access_token: Optional[Tuple] = await get_access_token(telegram_user_id=user.id, user_id=db_user.id)
-    creds = loads(db_user.investec_credentials)
-    client = InvestecOpenApiClient(
-        client_id=db_user.investec_client_id,
-        secret=creds['secret'],
-        api_key=creds['api_key'],
-        additional_headers={'Accept-Encoding': 'gzip, deflate, br'},
-        access_token=access_token)
-    log.debug(f'Fetching Investec accounts for Telegram user {user.id}...')
-    response = client.get_accounts()
-    log.debug(f'Accounts: {response!s}')
+    client: Optional[PooledInvestecClient] = investec_clients.get(user=db_user)
+    if client is None:
+        access_token: Optional[Tuple] = await get_access_token(telegram_user_id=user.id, user_id=db_user.id)
+        client = investec_clients.put(user=db_user, access_token=access_token)
+    log.debug(f'Fetching Investec accounts and cards for Telegram user {user.id}...')
+    # the API client blocks, so keep it off the event loop; the calls share the client's token and connections
+    loop = asyncio.get_running_loop()
+    account_info, card_info = await asyncio.gather(
+        loop.run_in_executor(None, client.get_accounts),
+        loop.run_in_executor(None, client.get_cards))
+    log.debug(f'Accounts: {account_info!s}')
+    log.debug(f'Cards: {card_info!s}')
+    access_token = client.unpersisted_token()
+    if access_token:
+        log.debug(f'Persisting access token...')
+        await update_access_token(
+            telegram_user_id=user.id,
+            user_id=db_user.id,
+            access_token=access_token[0],
+            access_token_expiry=access_token[1])
     await add_accounts(
         telegram_user_id=user.id,
         user_id=db_user.id,
-        account_info=response)
-    account_count = len(response)
-    if client.access_token and client.access_token_expiry:
-        if access_token is None or client.access_token != access_token[0]:
-            log.debug(f'Persisting access token...')
-            await update_access_token(
-                telegram_user_id=user.id,
-                user_id=db_user.id,
-                access_token=client.access_token,
-                access_token_expiry=client.access_token_expiry)
-    log.debug(f'Fetching Investec cards for Telegram user {user.id}...')
-    response = client.get_cards()
-    log.debug(f'Cards: {response!s}')
+        account_info=account_info)
+    account_count = len(account_info)
     await add_cards(
         telegram_user_id=user.id,
         user_id=db_user.id,
-        card_info=response)
-    card_count = len(response)
-    influxdb.write('bot', 'refresh', 1)
+        card_info=card_info)
+    card_count = len(card_info)
+    notification_contexts.invalidate(telegram_user_id=user.id)
+    influxdb.count('bot', 'refresh')
     await query.edit_message_text(
         text=f'Profile refresh complete. {account_count} account(s) and {card_count} card(s).',
         parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
 
+@timed_handler
 async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     db_user: User = await validate(command_name='show_profile', update=update)
@@ -655,7 +717,7 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         for card in cards:
             info: dict = loads(card.card_info)
             card_summary += f'{emoji.emojize(":credit_card:")} {info["EmbossedName"]} ({info["CardNumber"]})\n'
-    influxdb.write('bot', 'show_profile', 1)
+    influxdb.count('bot', 'show_profile')
     if accounts is None and cards is None:
         response_message = f'{account_summary}{card_summary}\nTry a profile refresh.'
     else:
@@ -666,6 +728,7 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     return ConversationHandler.END
 
 
+@timed_handler
 async def forget(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     db_user: User = await validate(command_name='forget', update=update)
@@ -680,13 +743,14 @@ async def forget(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     # TODO
 
-    influxdb.write('bot', 'forget', 1)
+    influxdb.count('bot', 'forget')
     await query.edit_message_text(
         text='Not implemented.',
         parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
 
+@timed_handler
 async def registration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     await validate(command_name='registration', update=update, validate_registration=False)
@@ -706,13 +770,14 @@ async def registration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             telegram_user_id=user.id,
             investec_client_id=investec_client_id,
             investec_credentials=dumps(investec_credentials))
-        #influxdb.write('bot', 'registration_oauth', 1)
+        #influxdb.count('bot', 'registration_oauth')
         await query.edit_message_text(
             text=f'User registration completed.',
             parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
 
+@timed_handler
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     response_message = None
     reply_markup = None
@@ -754,6 +819,7 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ACTION_SETTINGS_UPDATE
 
 
+@timed_handler
 async def askpayday(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     log.info(f'Asking Telegram user {user.id} for pay day preference...')
@@ -774,6 +840,7 @@ async def askpayday(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ACTION_SETTINGS_UPDATE
 
 
+@timed_handler
 async def askbillcycleday(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     log.info(f'Asking Telegram user {user.id} for billing cycle day preference...')
@@ -793,6 +860,7 @@ async def askbillcycleday(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ACTION_SETTINGS_UPDATE
 
 
+@timed_handler
 async def resetdefaultday(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     log.info(f'Resetting default day for Telegram user {user.id}...')
@@ -804,12 +872,14 @@ async def resetdefaultday(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if db_user is None:
         return ConversationHandler.END
     await delete_interval_setting(user_id=db_user.id)
+    notification_contexts.invalidate(telegram_user_id=user.id)
     await query.edit_message_text(
         text=f'Reporting interval is reset for all cards. Query each one to set the default.',
         parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
 
+@timed_handler
 async def update_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     db_user: User = await validate(command_name='update_settings', update=update)
@@ -852,10 +922,12 @@ async def update_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         elif save_billing_cycle_day:
             await add_user_setting(user_id=db_user.id, bill_cycle_day_of_month=day)
             del context.user_data[USER_DATA_KEY_BILL_CYCLE_DAY]
+        notification_contexts.invalidate(telegram_user_id=user.id)
     await update.message.reply_text(f'Settings updated.')
     return ConversationHandler.END
 
 
+@timed_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user: TelegramUser = update.effective_user
     db_user: User = await validate(command_name='help', update=update)
@@ -871,12 +943,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     return ConversationHandler.END
 
 
+@timed_handler
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     log.info(f'Incoming message from Telegram user ID {update.effective_user.id}.')
     await update.message.reply_text(update.message.text)
     return ConversationHandler.END
 
 
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     # CallbackQueries need to be answered, even if no notification to the user is needed
@@ -898,99 +972,204 @@ async def telegram_error_handler(update: Update, context: ContextTypes.DEFAULT_T
     return ConversationHandler.END
 
 
-async def transaction_update(update: TransactionUpdate, context: CustomContext) -> None:
-    influxdb.write('bot', 'transaction_update', 1)
-    chat_member: TelegramChatMember = await context.bot.get_chat_member(chat_id=update.user_id, user_id=update.user_id)
+async def seed_card_totals(md_collection: AsyncCollection, account_number: str, card_id: str, start_date: str, simulation_only: bool) -> CardTotals:
+    log.debug(f'Seeding running totals for card ID {card_id} from {start_date}: {account_number=}')
+    mongo_query = {
+        "accountNumber": {
+            "$eq": account_number
+        },
+        "card.id" : {
+            "$eq": card_id
+        },
+        "type": "card",
+        "isSimulation": simulation_only,
+        "transactedAt": {
+            "$gte": datetime.strptime(start_date, '%Y-%m-%d')
+        }
+    }
+    projection = {
+        "reference": 1,
+        "centsAmount": 1,
+        "currencyCode": 1,
+        "rateDate": 1,
+        "merchantKey": 1
+    }
+    cursor = md_collection.find(mongo_query, projection=projection)
+    card_totals = CardTotals(card_id=card_id, start_date=start_date, convert=local_currency)
+    i=0
+    async for doc in cursor:
+        cents_amount = int(doc['centsAmount'])
+        if cents_amount == 0:
+            continue
+        i+=1
+        await card_totals.add(
+            reference=str(doc['reference']),
+            merchant=doc['merchantKey'],
+            charge_cents=cents_amount,
+            charge_currency=str(doc['currencyCode']).upper(),
+            charge_date=doc['rateDate'])
+    log.info(f'Seeded running totals for card ID {card_id} from {start_date} with {i} charges.')
+    influxdb.count('bot', 'card_totals_seeded', i)
+    return card_totals
+
+
+async def build_notification_context(context: CustomContext, telegram_user_id: int, card_id: int) -> Optional[NotificationContext]:
+    chat_member: TelegramChatMember = await context.bot.get_chat_member(chat_id=telegram_user_id, user_id=telegram_user_id)
     user: TelegramUser = chat_member.user
-    log.debug(f'Transaction for Telegram user ID {user.id}.')
+    log.debug(f'Building notification context for Telegram user ID {user.id} and card ID {card_id}.')
     db_user: Optional[User] = await get_user(telegram_user_id=user.id)
     if db_user is None:
-        return
-    tran_event: dict = update.payload
-    log.debug(f'Transaction details {tran_event!s} (DB ID: {update.db_id!s}).')
-    card_id = tran_event['card']['id']
+        return None
     # user settings for interval type
     billing_cycle_day: int = app_config.getint('app', 'default_bill_cycle_day_of_month')
     db_user_setting: UserSetting = await get_user_setting(user_id=db_user.id)
     if db_user_setting is not None and db_user_setting.bill_cycle_day_of_month is not None:
         billing_cycle_day: int = db_user_setting.bill_cycle_day_of_month
     date = get_last_of_day(day=int(billing_cycle_day))
+    # the billing cycle rolls over a month after it starts
+    expiry = (date + relativedelta(months=1)).replace(hour=0, minute=0, second=0, microsecond=0)
     # interval configuration
-    db_interval_setting: IntervalSetting = await get_interval_setting(user_id=db_user.id, card_id=int(card_id))
+    db_interval_setting: IntervalSetting = await get_interval_setting(user_id=db_user.id, card_id=card_id)
     if db_interval_setting:
         if db_interval_setting.report_interval_type == REPORT_INTERVAL_TYPE_MONTH:
             date = get_datetime_a_month_ago()
-    start_date = date.strftime('%Y-%m-%d')
-    log.debug(f'Telegram user {user.id} has a card event for card ID {card_id}, searching others from {start_date}.')
-    card: Optional[Card] = await get_card(telegram_user_id=user.id, user_id=db_user.id, card_id=int(card_id))
+            # a month ago moves every day
+            expiry = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    card: Optional[Card] = await get_card(telegram_user_id=user.id, user_id=db_user.id, card_id=card_id)
     if card is None:
         log.debug(f'No card for Telegram user ID {user.id}.')
-        return
+        return None
     card_info = loads(card.card_info)
-    account_number: str = card_info['AccountNumber']
-    card_name: str = str(card_info['EmbossedName']).title()
+    return NotificationContext(
+        telegram_user_id=user.id,
+        user_id=db_user.id,
+        first_name=user.first_name,
+        card_id=card_id,
+        card_name=str(card_info['EmbossedName']).title(),
+        account_number=card_info['AccountNumber'],
+        start_date=date.strftime('%Y-%m-%d'),
+        expiry=expiry)
+
+
+@timed_handler
+async def transaction_update(update: TransactionUpdate, context: CustomContext) -> None:
+    influxdb.count('bot', 'transaction_update')
+    if update.trace:
+        update.trace.finish('update_queue.wait')
+    tran_event: dict = update.payload
+    coalesce_secs: float = app_config.getfloat('app', 'notification_coalesce_secs')
+    if coalesce_secs <= 0:
+        await transaction_notify(updates=[update], context=context)
+        return
+    coalesce_key = (update.user_id, str(tran_event['card']['id']), tran_event['merchantKey'])
+    if update.trace:
+        update.trace.begin('coalesce.wait')
+    if coalesce_key in pending_notifications:
+        log.debug(f'Coalescing transaction for Telegram user ID {update.user_id} into pending notification {coalesce_key}.')
+        pending_notifications[coalesce_key].append(update)
+        return
+    pending_notifications[coalesce_key] = [update]
+    # do not hold up the update queue for the duration of the window
+    context.application.create_task(
+        transaction_coalesce(coalesce_key=coalesce_key, coalesce_secs=coalesce_secs, context=context),
+        update=update)
+
+
+async def transaction_coalesce(coalesce_key: Tuple[int, str, str], coalesce_secs: float, context: CustomContext) -> None:
+    await asyncio.sleep(coalesce_secs)
+    updates: List[TransactionUpdate] = pending_notifications.pop(coalesce_key)
+    merged = len(updates) - 1
+    if merged > 0:
+        log.info(f'Coalesced {len(updates)} transactions for notification {coalesce_key}.')
+        influxdb.count('bot', 'transaction_coalesced', merged)
+    await transaction_notify(updates=updates, context=context)
+
+
+@timed_handler
+async def transaction_notify(updates: List[TransactionUpdate], context: CustomContext) -> None:
+    traces: List[Trace] = [u.trace for u in updates if u.trace]
+    for trace in traces:
+        trace.finish('coalesce.wait')
+        trace.begin('transaction_notify', coalesced=len(updates))
+    try:
+        await notify_charges(updates=updates, context=context, traces=traces)
+    finally:
+        for trace in traces:
+            trace.end()
+
+
+async def notify_charges(updates: List[TransactionUpdate], context: CustomContext, traces: List[Trace]) -> None:
+    # all updates share Telegram user, card and merchant
+    update: TransactionUpdate = updates[0]
+    tran_event: dict = update.payload
+    log.debug(f'Transaction details {tran_event!s} (DB IDs: {[u.db_id for u in updates]!s}).')
+    card_id = tran_event['card']['id']
+    notification: Optional[NotificationContext] = notification_contexts.get(telegram_user_id=update.user_id, card_id=int(card_id))
+    if notification is None:
+        notification = await build_notification_context(context=context, telegram_user_id=update.user_id, card_id=int(card_id))
+        if notification is None:
+            return
+        notification_contexts.put(notification_context=notification)
+    start_date = notification.start_date
+    account_number = notification.account_number
+    log.debug(f'Telegram user {update.user_id} has a card event for card ID {card_id}, searching others from {start_date}.')
     merchant_name: str = tran_event['merchant']['name']
-    log.debug(f'Running MongoDB query: {account_number=}, {card_id=}, {start_date=}, {merchant_name=}')
-    # fetch associated transaction data
-    reference = {
-        "$not": { "$regex": "^simulation*" }
-    }
-    if app_config.getboolean('app', 'demo_mode'):
-        log.warning(f'Demo mode enabled! Using simulation references only for Telegram user {user.id}.')
-        reference = {
-            "$regex": "^simulation*"
-        }
-    mongo_query = {
-        "accountNumber": {
-            "$eq": account_number
-        },
-        "card.id" : {
-            "$eq": card_id
-        },
-        "type": "card",
-        "dateTime": {
-            "$gte": start_date
-        },
-        "merchant.name": {
-            "$eq": merchant_name
-        },
-        "reference": reference
-    }
-    if update.db_id:
-        log.debug(f'Adding MongoDB query filter for {update.db_id!s}.')
-        mongo_query["_id"] = {
-            "$ne": update.db_id
-        }
-    projection = {}
-    sort = []
-    md_collection: Collection = context.application.bot_data['mongodb_card_collection']
-    log.debug(f'Fetching data from MongoDB collection {md_collection!r}...')
-    cursor = md_collection.find(mongo_query, projection=projection, sort=sort)
-    total_charges: float = await local_currency(
-        charge_cents=int(tran_event['centsAmount']),
-        charge_currency=str(tran_event['currencyCode']).upper(),
-        charge_date=str(tran_event['dateTime']).split('T')[0])
-    i=1
-    for doc in cursor:
-        log.debug(f'MongoDB result: {doc!s}')
-        doc_id: ObjectId = doc['_id']
-        if doc_id == update.db_id:
-            log.warning(f'Database item {doc_id} is supposed to already be filtered.')
-            continue
-        reference: str = doc['reference']
-        cents_amount = int(doc['centsAmount'])
-        if cents_amount == 0:
-            continue
-        i+=1
-        charge_cents_local_currency = await local_currency(
-            charge_cents=cents_amount,
-            charge_currency=str(doc['currencyCode']).upper(),
-            charge_date=str(doc['dateTime']).split('T')[0])
-        total_charges += charge_cents_local_currency
+    merchant: str = tran_event['merchantKey']
+    simulation_only: bool = app_config.getboolean('app', 'demo_mode')
+    if simulation_only:
+        log.warning(f'Demo mode enabled! Using simulation references only for Telegram user {update.user_id}.')
+    md_collection: AsyncCollection = context.application.bot_data['mongodb_card_collection']
+    card_key = str(card_id)
+    # reported on, but kept out of the running totals as reports exclude it
+    excluded = Aggregator(convert=local_currency)
+    async with running_totals.lock(card_id=card_key):
+        card_totals: Optional[CardTotals] = running_totals.get(card_id=card_key, start_date=start_date)
+        if card_totals is None:
+            # checked before seeding, as documents may be normalized during the query
+            normalized = normalization_complete.is_set()
+            card_totals = await seed_card_totals(
+                md_collection=md_collection,
+                account_number=account_number,
+                card_id=card_key,
+                start_date=start_date,
+                simulation_only=simulation_only)
+            if normalized:
+                running_totals.put(card_totals=card_totals)
+            else:
+                # seeded again once older documents are normalized
+                log.debug(f'Not retaining running totals for card ID {card_key} until normalization is complete.')
+        for u in updates:
+            reference = str(u.payload['reference'])
+            cents_amount = int(u.payload['centsAmount'])
+            if card_totals.seen(reference=reference) or cents_amount == 0:
+                continue
+            if u.payload['rateDate'] < start_date:
+                log.warning(f'Ignoring transaction {reference} dated before the reporting interval starting {start_date}.')
+                continue
+            charge_currency = str(u.payload['currencyCode']).upper()
+            if u.payload['isSimulation'] == simulation_only:
+                await card_totals.add(
+                    reference=reference,
+                    merchant=merchant,
+                    charge_cents=cents_amount,
+                    charge_currency=charge_currency,
+                    charge_date=u.payload['rateDate'])
+            else:
+                await excluded.add(key=merchant, amount=cents_amount, currency=charge_currency, rate_date=u.payload['rateDate'])
+        i, total_charges = card_totals.get(merchant=merchant)
+    i += excluded.count
+    total_charges += excluded.total
     # switch to major denomination
     total_charges = total_charges / 100.0
-    log.debug(f'Sending message to Telegram user ID {user.id} about {i} transactions across the reporting interval.')
+    new_charges = ''
+    if len(updates) > 1:
+        new_charges = f' ({len(updates)} new)'
+    log.debug(f'Sending message to Telegram user ID {update.user_id} about {i} transactions across the reporting interval.')
+    for trace in traces:
+        trace.begin('telegram.send_message')
     await context.bot.send_message(
         chat_id=update.user_id,
-        text=f"{user.first_name}, your card <b>{card_name}</b> has <b>{i} charge(s)</b> since {start_date} from <i>{html.unescape(merchant_name)}</i> coming to a total of <b>{locale.currency(total_charges)}</b>.",
+        text=f"{notification.first_name}, your card <b>{notification.card_name}</b> has <b>{i} charge(s)</b>{new_charges} since {start_date} from <i>{html.unescape(merchant_name)}</i> coming to a total of <b>{locale.currency(total_charges)}</b>.",
         parse_mode=ParseMode.HTML)
+    for trace in traces:
+        trace.finish('telegram.send_message')
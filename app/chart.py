@@ -0,0 +1,123 @@
+import asyncio
+import multiprocessing
+import time
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from typing import Dict, List, Optional, Set
+
+from tailucas_pylib import log
+
+from telegram import Message
+
+from .chartcache import Chart, ChartCache
+from .influx import influxdb
+from .latency import PHASE_RENDER, timed_phase
+from .render import BACKENDS, BACKEND_PLOTLY, render_pie, warm_up, worker_ready
+
+
+# how long each readiness check occupies a worker while the pool warms up
+WORKER_READY_HOLD_SECS = 0.1
+
+
+class ChartRenderer(object):
+    """
+    Renders charts in a pool of worker processes so that the event loop is
+    not held up for the duration of a render. Each worker starts its
+    renderer once and reuses it. Workers are started and warmed up before
+    the first report, because the spawned workers are otherwise started
+    only as renders are submitted.
+    """
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pool_size: int = 1
+        self._backend: str = BACKEND_PLOTLY
+        self._render_timeout_secs: float = 30.0
+        self._cache = ChartCache()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # fresh interpreters, rather than forks of a process with running threads
+        return ProcessPoolExecutor(
+            max_workers=self._pool_size,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=warm_up,
+            initargs=(self._backend,))
+
+    def start(self, pool_size: int, render_timeout_secs: float, backend: str, cache_max_entries: int, cache_max_bytes: int) -> None:
+        if backend not in BACKENDS:
+            raise AssertionError(f'Chart backend {backend} is not one of {BACKENDS}.')
+        self._pool_size = pool_size
+        self._render_timeout_secs = render_timeout_secs
+        self._backend = backend
+        self._cache.configure(max_entries=cache_max_entries, max_bytes=cache_max_bytes)
+        log.info(f'Starting {pool_size} chart rendering workers using {backend}...')
+        self._executor = self._create_executor()
+        self._warm_up()
+
+    def _warm_up(self) -> None:
+        # a worker answers only once its initializer has loaded the renderer
+        start = time.perf_counter()
+        deadline = start + self._render_timeout_secs
+        ready: Set[int] = set()
+        try:
+            while len(ready) < self._pool_size and time.perf_counter() < deadline:
+                checks = [self._executor.submit(worker_ready, WORKER_READY_HOLD_SECS) for _ in range(self._pool_size)]
+                for check in checks:
+                    ready.add(check.result(timeout=max(0.0, deadline - time.perf_counter())))
+        except TimeoutError:
+            pass
+        if len(ready) < self._pool_size:
+            log.warning(f'Only {len(ready)} of {self._pool_size} chart rendering workers were ready after {self._render_timeout_secs}s.')
+        else:
+            log.info(f'Warmed up {len(ready)} chart rendering workers in {time.perf_counter()-start:.2f}s.')
+        influxdb.observe('chart', 'warm_up_secs', time.perf_counter() - start)
+
+    def _recycle(self) -> None:
+        # a render that overran cannot be cancelled, so replace the workers
+        executor = self._executor
+        self._executor = self._create_executor()
+        processes = list((executor._processes or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    @timed_phase(PHASE_RENDER)
+    async def pie(self, to_plot: Dict[str, List], title: str) -> Optional[Chart]:
+        key = ChartCache.key(to_plot=to_plot, title=title, backend=self._backend)
+        chart = self._cache.get(key=key)
+        if chart:
+            log.debug(f'Using cached chart {key} (uploaded: {chart.file_id is not None}).')
+            influxdb.count('chart', 'cache_hit')
+            return chart
+        influxdb.count('chart', 'cache_miss')
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            img_bytes, render_secs = await asyncio.wait_for(
+                loop.run_in_executor(self._executor, render_pie, to_plot, title, self._backend),
+                timeout=self._render_timeout_secs)
+        except asyncio.TimeoutError:
+            log.warning(f'Chart rendering exceeded {self._render_timeout_secs}s, restarting rendering workers.')
+            influxdb.count('chart', 'render_timeout')
+            self._recycle()
+            return None
+        elapsed_secs = time.perf_counter() - start
+        log.debug(f'Rendered chart in {render_secs:.3f}s ({elapsed_secs:.3f}s elapsed).')
+        influxdb.observe('chart', 'render_secs', render_secs)
+        influxdb.observe('chart', 'render_wait_secs', elapsed_secs - render_secs)
+        chart = Chart(key=key, img_bytes=img_bytes)
+        self._cache.put(chart=chart)
+        return chart
+
+    def uploaded(self, chart: Chart, message: Message) -> None:
+        # Telegram file IDs are reusable by the same bot in any chat
+        if message.photo:
+            self._cache.uploaded(chart=chart, file_id=message.photo[-1].file_id)
+
+    def shutdown(self) -> None:
+        if self._executor:
+            log.info('Stopping chart rendering workers...')
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+chart_renderer = ChartRenderer()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Compares chart rendering backends. Each backend runs in its own fresh
+process so that memory figures are not shared between them.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import time
+
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from .aggregate import Aggregator
+from .render import BACKENDS, render_pie, warm_up
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return 0
+
+
+def _child_pids(pid: int) -> List[int]:
+    children = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+    except FileNotFoundError:
+        pass
+    return children
+
+
+def process_tree_rss_kb(pid: int) -> int:
+    # includes renderer subprocesses, such as kaleido's headless browser
+    return _rss_kb(pid) + sum(process_tree_rss_kb(child) for child in _child_pids(pid))
+
+
+def sample_charges(merchants: int, top_n: int) -> Dict[str, List]:
+    charges = Aggregator()
+    for i in range(merchants):
+        charges.put(key=f'Merchant {i}', amount=random.uniform(1.0, 5000.0))
+    return charges.to_plot(n=top_n)
+
+
+def benchmark(backend: str, iterations: int, merchants: int, top_n: int, output_dir: Optional[str]) -> Dict:
+    pid = os.getpid()
+    baseline_rss_kb = process_tree_rss_kb(pid)
+    start = time.perf_counter()
+    warm_up(backend)
+    cold_start_secs = time.perf_counter() - start
+    latencies = []
+    img_bytes = b''
+    for i in range(iterations):
+        img_bytes, render_secs = render_pie(sample_charges(merchants=merchants, top_n=top_n), f'Top {top_n} charges since 1 January 2024', backend)
+        latencies.append(render_secs)
+    if output_dir:
+        with open(os.path.join(output_dir, f'{backend}.png'), 'wb') as f:
+            f.write(img_bytes)
+    latencies.sort()
+    return {
+        'backend': backend,
+        'cold_start_ms': cold_start_secs * 1000,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'baseline_rss_mb': baseline_rss_kb / 1024,
+        'rss_mb': process_tree_rss_kb(pid) / 1024,
+        'png_kb': len(img_bytes) / 1024
+    }
+
+
+def init_cli() -> Namespace:
+    parser: ArgumentParser = argparse.ArgumentParser(description='Compare chart rendering backends by latency and memory.')
+    parser.add_argument('-b', '--backend', action='append', dest='backends', choices=BACKENDS, help='Backend to include (default: all)')
+    parser.add_argument('-n', action='store', dest='iterations', type=int, default=50, help='Charts to render per backend')
+    parser.add_argument('--merchants', action='store', type=int, default=40, help='Merchants in each sample data set')
+    parser.add_argument('--top-n', action='store', dest='top_n', type=int, default=15, help='Slices per chart')
+    parser.add_argument('-o', action='store', dest='output_dir', help='Directory in which to save a sample chart per backend')
+    return parser.parse_args()
+
+
+def main():
+    args = init_cli()
+    backends = args.backends or BACKENDS
+    results = []
+    for backend in backends:
+        # a fresh interpreter per backend, as in the application's rendering workers
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results.append(executor.submit(benchmark, backend, args.iterations, args.merchants, args.top_n, args.output_dir).result())
+    columns = ['backend', 'cold_start_ms', 'p50_ms', 'p95_ms', 'max_ms', 'baseline_rss_mb', 'rss_mb', 'png_kb']
+    print(''.join(f'{column:>16}' for column in columns))
+    for result in results:
+        print(f"{result['backend']:>16}" + ''.join(f'{result[column]:>16.1f}' for column in columns[1:]))
+
+
+if __name__ == "__main__":
+    main()
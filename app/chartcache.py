@@ -0,0 +1,83 @@
+"""
+The chart cache, kept apart from the renderer so that it can be used
+without the rendering workers or the Telegram client.
+"""
+import hashlib
+import json
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+
+@dataclass
+class Chart:
+    key: str
+    img_bytes: Optional[bytes] = None
+    # set once Telegram has the image
+    file_id: Optional[str] = None
+
+    @property
+    def photo(self) -> Union[str, bytes]:
+        # an uploaded image is sent by reference rather than uploaded again
+        return self.file_id or self.img_bytes
+
+    @property
+    def size(self) -> int:
+        return len(self.img_bytes) if self.img_bytes else 0
+
+
+class ChartCache(object):
+    """
+    Charts keyed by a hash of what they show, least recently used first,
+    and bounded by entry count and image bytes held.
+    """
+    def __init__(self):
+        self._charts: OrderedDict[str, Chart] = OrderedDict()
+        self._max_entries: int = 0
+        self._max_bytes: int = 0
+        self._size: int = 0
+
+    def configure(self, max_entries: int, max_bytes: int) -> None:
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._evict()
+
+    @staticmethod
+    def key(to_plot: Dict[str, List], title: str, backend: str) -> str:
+        series = sorted(zip(to_plot['Merchant'], [round(total, 2) for total in to_plot['Total']]))
+        content = json.dumps([backend, title, series], separators=(',', ':'))
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Chart]:
+        chart = self._charts.get(key)
+        if chart:
+            self._charts.move_to_end(key)
+        return chart
+
+    def put(self, chart: Chart) -> None:
+        if self._max_entries <= 0:
+            return
+        self.discard(key=chart.key)
+        self._charts[chart.key] = chart
+        self._size += chart.size
+        self._evict()
+
+    def uploaded(self, chart: Chart, file_id: str) -> None:
+        if chart.file_id:
+            return
+        if self._charts.get(chart.key) is chart:
+            self._size -= chart.size
+        chart.file_id = file_id
+        # the image bytes are no longer needed
+        chart.img_bytes = None
+
+    def discard(self, key: str) -> None:
+        chart = self._charts.pop(key, None)
+        if chart:
+            self._size -= chart.size
+
+    def _evict(self) -> None:
+        while len(self._charts) > self._max_entries or self._size > self._max_bytes:
+            _, chart = self._charts.popitem(last=False)
+            self._size -= chart.size
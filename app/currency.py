@@ -2,7 +2,7 @@ import requests
 from bson.json_util import loads
 from datetime import datetime
 from requests.exceptions import RequestException
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from tailucas_pylib import (
     creds,
@@ -14,6 +14,11 @@ from tailucas_pylib.zmq import zmq_socket
 import zmq
 from zmq.asyncio import Socket
 
+from pymongo import UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
+
+from .latency import PHASE_CURRENCY, timed_phase
+
 
 URL_WORKER_CURRENCY_CONVERTER = 'inproc://currency-converter'
 URL_WEB_CONVERTER_PREFIX = 'http://api.exchangerate.host/'
@@ -27,45 +32,64 @@ class CurrencyConverter(ZmqWorker):
         self._int_curr_symbol: str = int_curr_symbol
         self._currency_symbol: str = currency_symbol
 
+    def _rate(self, currency: str, date: Optional[str], function_path: str) -> Tuple[float, Optional[Dict]]:
+        if currency == self._int_curr_symbol:
+            return 1, None
+        if date:
+            currency_map_key = f'{currency}:{date}'
+        else:
+            today = datetime.today()
+            currency_map_key = f'{currency}:{today.strftime("%Y-%m-%d")}'
+        if currency_map_key in self._currency_map.keys():
+            rate = self._currency_map[currency_map_key]
+            log.debug(f'Returning previously fetched {function_path} rate {rate} for {currency} to {self._int_curr_symbol}.')
+            return rate, None
+        log.debug(f'Making request to convert {self._int_curr_symbol} to {currency} for {function_path}.')
+        params = {
+            'amount': 1,
+            'source': currency,
+            'currencies': self._int_curr_symbol
+        }
+        if date:
+            params['date'] = date
+        error_message = f'Issue with request to {URL_WEB_CONVERTER_PREFIX}'
+        try:
+            params['access_key'] = creds.exchangerate_host
+            response = requests.get(
+                url=URL_WEB_CONVERTER_PREFIX+function_path,
+                params=params)
+            response.raise_for_status()
+        except RequestException as e:
+            raise AssertionError(error_message) from e
+        data = response.json()
+        request_success = False
+        if 'success' in data:
+            request_success = data['success']
+        if not request_success:
+            if 'error' in data and 'info' in data['error']:
+                error_message = data['error']['info']
+            raise AssertionError(error_message)
+        log.debug(f'Currency response is {data}')
+        rate = float(data['quotes'][f'{currency}{self._int_curr_symbol}'])
+        self._currency_map[currency_map_key] = rate
+        return rate, data
+
     def process_message(self, message: Dict) -> Dict:
         log.debug(f'Processing {message=}')
+        if 'rates' in message:
+            # many rate keys in one request, one rate per key in the same order
+            rates = []
+            for currency, date in message['rates']:
+                function_path = 'historical' if date else 'live'
+                rate, _ = self._rate(currency=currency, date=date, function_path=function_path)
+                rates.append(rate)
+            return {
+                'int_curr_symbol': self._int_curr_symbol,
+                'currency_symbol': self._currency_symbol,
+                'rates': rates,
+            }
         params = message['params']
-        params['currencies'] = self._int_curr_symbol
-        currency = params['source']
-        rate = 1
-        data = None
-        if currency != self._int_curr_symbol:
-            if 'date' in params:
-                currency_map_key = f'{currency}:{params["date"]}'
-            else:
-                today = datetime.today()
-                currency_map_key = f'{currency}:{today.strftime("%Y-%m-%d")}'
-            function_path = message['function_path']
-            if currency_map_key not in self._currency_map.keys():
-                log.debug(f'Making request to convert {self._int_curr_symbol} to {currency} for {function_path}.')
-                error_message = f'Issue with request to {URL_WEB_CONVERTER_PREFIX}'
-                try:
-                    params['access_key'] = creds.exchangerate_host
-                    response = requests.get(
-                        url=URL_WEB_CONVERTER_PREFIX+function_path,
-                        params=params)
-                    response.raise_for_status()
-                except RequestException as e:
-                    raise AssertionError(error_message) from e
-                data = response.json()
-                request_success = False
-                if 'success' in data:
-                    request_success = data['success']
-                if not request_success:
-                    if 'error' in data and 'info' in data['error']:
-                        error_message = data['error']['info']
-                    raise AssertionError(error_message)
-                log.debug(f'Currency response is {data}')
-                rate = float(data['quotes'][f'{currency}{self._int_curr_symbol}'])
-                self._currency_map[currency_map_key] = rate
-            else:
-                rate = self._currency_map[currency_map_key]
-                log.debug(f'Returning previously fetched {function_path} rate {rate} for {currency} to {self._int_curr_symbol}.')
+        rate, data = self._rate(currency=params['source'], date=params.get('date'), function_path=message['function_path'])
         return {
             'int_curr_symbol': self._int_curr_symbol,
             'currency_symbol': self._currency_symbol,
@@ -74,6 +98,7 @@ class CurrencyConverter(ZmqWorker):
         }
 
 
+@timed_phase(PHASE_CURRENCY)
 async def local_currency(charge_cents: int, charge_currency: str, charge_date: Optional[str] = None) -> float:
     currency_converter: Socket = zmq_socket(zmq.REQ, is_async=True)
     currency_converter.connect(addr=URL_WORKER_CURRENCY_CONVERTER)
@@ -96,4 +121,49 @@ async def local_currency(charge_cents: int, charge_currency: str, charge_date: O
     int_curr_symbol = response['int_curr_symbol']
     currency_symbol = response['currency_symbol']
     log.debug(f'Converted {charge_cents}c {charge_currency} to {charge_cents_local_currency}c {int_curr_symbol} ({currency_symbol}) ({rate=})')
-    return charge_cents_local_currency
\ No newline at end of file
+    return charge_cents_local_currency
+
+
+@timed_phase(PHASE_CURRENCY)
+async def local_rates(rate_keys: List[Tuple[str, Optional[str]]]) -> Dict[Tuple[str, Optional[str]], float]:
+    """
+    Local currency rates for (currency, rate date) keys in a single request.
+    """
+    if len(rate_keys) == 0:
+        return {}
+    currency_converter: Socket = zmq_socket(zmq.REQ, is_async=True)
+    currency_converter.connect(addr=URL_WORKER_CURRENCY_CONVERTER)
+    await currency_converter.send_pyobj({'rates': rate_keys})
+    response = await currency_converter.recv_pyobj()
+    currency_converter.close()
+    log.debug(f'Fetched {len(rate_keys)} rates to {response["int_curr_symbol"]}.')
+    return dict(zip(rate_keys, response['rates']))
+
+
+@timed_phase(PHASE_CURRENCY)
+async def materialize_rates(rates_collection: AsyncCollection, rate_keys: List[Tuple[str, str]]) -> int:
+    """
+    Ensure that the rates collection has a rate for each (currency, rate date)
+    key so that report pipelines can convert to local currency server-side.
+    """
+    if len(rate_keys) == 0:
+        return 0
+    query = {"$or": [{"currency": currency, "date": date} for currency, date in rate_keys]}
+    existing = set()
+    async for doc in rates_collection.find(query, projection={"_id": 0, "currency": 1, "date": 1}):
+        existing.add((doc['currency'], doc['date']))
+    missing = [rate_key for rate_key in rate_keys if rate_key not in existing]
+    if len(missing) == 0:
+        return 0
+    rates = await local_rates(rate_keys=missing)
+    fetched_at = datetime.now()
+    updates = [
+        UpdateOne(
+            {"currency": currency, "date": date},
+            {"$set": {"rate": rate, "fetchedAt": fetched_at}},
+            upsert=True)
+        for (currency, date), rate in rates.items()
+    ]
+    await rates_collection.bulk_write(updates, ordered=False)
+    log.debug(f'Stored {len(updates)} rates in MongoDB collection {rates_collection.name}.')
+    return len(updates)
@@ -3,7 +3,7 @@ import asyncio
 from . import APP_NAME
 
 from asyncio import AbstractEventLoop
-from bson.json_util import dumps
+from bson.json_util import dumps, loads
 from datetime import datetime, timedelta
 from os import path
 from typing import Dict, List, Tuple, Optional, Sequence
@@ -14,6 +14,7 @@ from tailucas_pylib import (
 )
 
 from .crypto import encrypt, decrypt, digest
+from .latency import PHASE_SQLITE, timed_phase
 
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
@@ -97,6 +98,47 @@ class DbCard(Base):
     card_info = Column(JSON)
     UniqueConstraint(user_id, card_id)
 
+
+class DbPeriodReport(Base):
+    __tablename__ = 'period_report'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
+    # digest of the report name and the cards or accounts reported on
+    report_key = Column(String(96), index=True)
+    period_start = Column(DateTime, nullable=False)
+    period_end = Column(DateTime, nullable=False)
+    report = Column(JSON)
+    created = Column(DateTime, nullable=False)
+    UniqueConstraint(user_id, report_key, period_start, period_end)
+
+
+class DbSyncWatermark(Base):
+    __tablename__ = 'sync_watermark'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
+    account_id = Column(String(32), index=True)
+    # newest transaction in MongoDB for the account
+    last_posted_order = Column(Integer)
+    last_posting_date = Column(String(10))
+    last_sync = Column(DateTime, nullable=False)
+    UniqueConstraint(user_id, account_id)
+
+
+class DbBackfillWindow(Base):
+    __tablename__ = 'backfill_window'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
+    account_id = Column(String(32), index=True)
+    # fetched and stored date window of account history
+    window_start = Column(String(10), nullable=False)
+    window_end = Column(String(10), nullable=False)
+    transactions = Column(Integer, nullable=False)
+    # newest transaction in the window
+    last_posted_order = Column(Integer)
+    last_posting_date = Column(String(10))
+    completed = Column(DateTime, nullable=False)
+    UniqueConstraint(user_id, account_id, window_start)
+
 """
 DTOs
 """
@@ -163,6 +205,31 @@ class Card:
 """
 Implementation
 """
+class PeriodReport:
+    def __init__(self, telegram_user_id: int, db: DbPeriodReport) -> None:
+        self.period_start: datetime = db.period_start
+        self.period_end: datetime = db.period_end
+        self.report: Dict = loads(decrypt(header=str(telegram_user_id), payload=str(db.report)))
+        self.created: datetime = db.created
+
+
+class SyncWatermark:
+    def __init__(self, db: DbSyncWatermark) -> None:
+        self.account_id: str = db.account_id
+        self.last_posted_order: Optional[int] = db.last_posted_order
+        self.last_posting_date: Optional[str] = db.last_posting_date
+        self.last_sync: datetime = db.last_sync
+
+
+class BackfillWindow:
+    def __init__(self, db: DbBackfillWindow) -> None:
+        self.window_start: str = db.window_start
+        self.window_end: str = db.window_end
+        self.transactions: int = db.transactions
+        self.last_posted_order: Optional[int] = db.last_posted_order
+        self.last_posting_date: Optional[str] = db.last_posting_date
+
+
 class AppDB:
     def __init__(self, db_session: AsyncSession):
         self.db_session: AsyncSession = db_session
@@ -211,6 +278,18 @@ class AppDB:
         r: Result = await self.db_session.execute(select(DbCard).where((DbCard.user_id==user_id) & (DbCard.card_id == card_id)))
         return r.scalars().one_or_none()
 
+    async def _get_db_period_report(self, user_id: int, report_key: str, period_start: datetime, period_end: datetime) -> Optional[DbPeriodReport]:
+        r: Result = await self.db_session.execute(select(DbPeriodReport).where((DbPeriodReport.user_id==user_id) & (DbPeriodReport.report_key==report_key) & (DbPeriodReport.period_start==period_start) & (DbPeriodReport.period_end==period_end)))
+        return r.scalars().one_or_none()
+
+    async def _get_db_sync_watermark(self, user_id: int, account_id: str) -> Optional[DbSyncWatermark]:
+        r: Result = await self.db_session.execute(select(DbSyncWatermark).where((DbSyncWatermark.user_id==user_id) & (DbSyncWatermark.account_id==account_id)))
+        return r.scalars().one_or_none()
+
+    async def _get_db_backfill_windows(self, user_id: int, account_id: str) -> Sequence[DbBackfillWindow]:
+        r: Result = await self.db_session.execute(select(DbBackfillWindow).where((DbBackfillWindow.user_id==user_id) & (DbBackfillWindow.account_id==account_id)))
+        return r.scalars().all()
+
     async def _get_db_cards(self, user_id: int) -> Sequence[DbCard]:
         r: Result = await self.db_session.execute(select(DbCard).where(DbCard.user_id==user_id))
         return r.scalars().all()
@@ -417,21 +496,84 @@ class AppDB:
             self.db_session.add(db_card)
         await self.db_session.flush()
 
+    async def get_period_report(self, telegram_user_id: int, user_id: int, report_key: str, period_start: datetime, period_end: datetime) -> Optional[PeriodReport]:
+        log.debug(f'Fetching report {report_key} for {period_start} to {period_end} for Telegram user {telegram_user_id} (DB user {user_id})...')
+        db = await self._get_db_period_report(user_id=user_id, report_key=report_key, period_start=period_start, period_end=period_end)
+        if db is None:
+            return None
+        return PeriodReport(telegram_user_id=telegram_user_id, db=db)
+
+    async def add_period_report(self, telegram_user_id: int, user_id: int, report_key: str, period_start: datetime, period_end: datetime, report: Dict) -> None:
+        log.debug(f'Saving report {report_key} for {period_start} to {period_end} for Telegram user {telegram_user_id} (DB user {user_id}).')
+        db_report = await self._get_db_period_report(user_id=user_id, report_key=report_key, period_start=period_start, period_end=period_end)
+        if db_report is None:
+            db_report = DbPeriodReport(
+                user_id=user_id,
+                report_key=report_key,
+                period_start=period_start,
+                period_end=period_end)
+        db_report.report = encrypt(header=str(telegram_user_id), payload=dumps(report))
+        db_report.created = datetime.now()
+        self.db_session.add(db_report)
+        await self.db_session.flush()
+
+    async def get_sync_watermark(self, telegram_user_id: int, user_id: int, account_id: str) -> Optional[SyncWatermark]:
+        log.debug(f'Fetching sync watermark for account ID {account_id} for Telegram user {telegram_user_id} (DB user {user_id})...')
+        db = await self._get_db_sync_watermark(user_id=user_id, account_id=account_id)
+        if db is None:
+            return None
+        return SyncWatermark(db=db)
+
+    async def update_sync_watermark(self, telegram_user_id: int, user_id: int, account_id: str, last_posted_order: Optional[int], last_posting_date: Optional[str]) -> None:
+        log.debug(f'Updating sync watermark for account ID {account_id} for Telegram user {telegram_user_id} (DB user {user_id}) to posted order {last_posted_order}.')
+        db_watermark = await self._get_db_sync_watermark(user_id=user_id, account_id=account_id)
+        if db_watermark is None:
+            db_watermark = DbSyncWatermark(
+                user_id=user_id,
+                account_id=account_id)
+        db_watermark.last_posted_order = last_posted_order
+        db_watermark.last_posting_date = last_posting_date
+        db_watermark.last_sync = datetime.now()
+        self.db_session.add(db_watermark)
+        await self.db_session.flush()
+
+    async def get_backfill_windows(self, telegram_user_id: int, user_id: int, account_id: str) -> List[BackfillWindow]:
+        log.debug(f'Fetching backfill progress for account ID {account_id} for Telegram user {telegram_user_id} (DB user {user_id})...')
+        db_windows: Sequence[DbBackfillWindow] = await self._get_db_backfill_windows(user_id=user_id, account_id=account_id)
+        return [BackfillWindow(db=db) for db in db_windows]
+
+    async def add_backfill_window(self, telegram_user_id: int, user_id: int, account_id: str, window_start: str, window_end: str, transactions: int, last_posted_order: Optional[int], last_posting_date: Optional[str]) -> None:
+        log.debug(f'Saving backfill of {window_start} to {window_end} for account ID {account_id} for Telegram user {telegram_user_id} (DB user {user_id}).')
+        db_window = DbBackfillWindow(
+            user_id=user_id,
+            account_id=account_id,
+            window_start=window_start,
+            window_end=window_end,
+            transactions=transactions,
+            last_posted_order=last_posted_order,
+            last_posting_date=last_posting_date,
+            completed=datetime.now())
+        self.db_session.add(db_window)
+        await self.db_session.flush()
+
 """
 Module Methods
 """
+@timed_phase(PHASE_SQLITE)
 async def get_users() -> Optional[Sequence[User]]:
     async with async_session() as session:
         async with session.begin():
             db = AppDB(session)
             return await db.get_users()
 
+@timed_phase(PHASE_SQLITE)
 async def get_user(telegram_user_id: int) -> Optional[User]:
     async with async_session() as session:
         async with session.begin():
             db = AppDB(session)
             return await db.get_user(telegram_user_id=telegram_user_id)
 
+@timed_phase(PHASE_SQLITE)
 async def add_user(telegram_user_id: int, user_id: int, investec_client_id: str, investec_credentials: str) -> None:
     async with async_session() as session:
         async with session.begin():
@@ -442,12 +584,14 @@ async def add_user(telegram_user_id: int, user_id: int, investec_client_id: str,
                 investec_client_id=investec_client_id,
                 investec_credentials=investec_credentials)
 
+@timed_phase(PHASE_SQLITE)
 async def get_user_from_card(card_id: int) -> Optional[User]:
     async with async_session() as session:
         async with session.begin():
             db = AppDB(session)
             return await db.get_user_from_card(card_id=card_id)
 
+@timed_phase(PHASE_SQLITE)
 async def add_user_setting(user_id: int, pay_day_of_month: Optional[int]=None, bill_cycle_day_of_month: Optional[int]=None) -> None:
     async with async_session() as session:
         async with session.begin():
@@ -457,12 +601,14 @@ async def add_user_setting(user_id: int, pay_day_of_month: Optional[int]=None, b
                 pay_day_of_month=pay_day_of_month,
                 bill_cycle_day_of_month=bill_cycle_day_of_month)
 
+@timed_phase(PHASE_SQLITE)
 async def get_user_setting(user_id: int) -> Optional[UserSetting]:
     async with async_session() as session:
         async with session.begin():
             db = AppDB(session)
             return await db.get_user_setting(user_id=user_id)
 
+@timed_phase(PHASE_SQLITE)
 async def add_interval_setting(user_id: int, report_interval_type: int, report_interval_days: int, account_id: Optional[str]=None, card_id: Optional[int]=None) -> None:
     async with async_session() as session:
         async with session.begin():
@@ -474,6 +620,7 @@ async def add_interval_setting(user_id: int, report_interval_type: int, report_i
                 account_id=account_id,
                 card_id=card_id)
 
+@timed_phase(PHASE_SQLITE)
 async def get_interval_setting(user_id: int, account_id: Optional[str]=None, card_id: Optional[int]=None) -> Optional[IntervalSetting]:
     async with async_session() as session:
         async with session.begin():
@@ -483,6 +630,7 @@ async def get_interval_setting(user_id: int, account_id: Optional[str]=None, car
                 account_id=account_id,
                 card_id=card_id)
 
+@timed_phase(PHASE_SQLITE)
 async def delete_interval_setting(user_id: int, account_id: Optional[str]=None, card_id: Optional[int]=None) -> None:
     async with async_session() as session:
         async with session.begin():
@@ -492,6 +640,7 @@ async def delete_interval_setting(user_id: int, account_id: Optional[str]=None,
                 account_id=account_id,
                 card_id=card_id)
 
+@timed_phase(PHASE_SQLITE)
 async def get_access_token(telegram_user_id: int, user_id: int) -> Optional[Tuple[str, datetime]]:
     async with async_session() as session:
         async with session.begin():
@@ -500,6 +649,7 @@ async def get_access_token(telegram_user_id: int, user_id: int) -> Optional[Tupl
                 telegram_user_id=telegram_user_id,
                 user_id=user_id)
 
+@timed_phase(PHASE_SQLITE)
 async def update_access_token(telegram_user_id: int, user_id: int, access_token: str, access_token_expiry: datetime) -> None:
     async with async_session() as session:
         async with session.begin():
@@ -510,6 +660,7 @@ async def update_access_token(telegram_user_id: int, user_id: int, access_token:
                 access_token=access_token,
                 access_token_expiry=access_token_expiry)
 
+@timed_phase(PHASE_SQLITE)
 async def get_account(telegram_user_id: int, user_id: int, account_id: str) -> Optional[Account]:
     async with async_session() as session:
         async with session.begin():
@@ -519,6 +670,7 @@ async def get_account(telegram_user_id: int, user_id: int, account_id: str) -> O
                 user_id=user_id,
                 account_id=account_id)
 
+@timed_phase(PHASE_SQLITE)
 async def get_accounts(telegram_user_id: int, user_id: int) -> Optional[Sequence[Account]]:
     async with async_session() as session:
         async with session.begin():
@@ -527,6 +679,7 @@ async def get_accounts(telegram_user_id: int, user_id: int) -> Optional[Sequence
                 telegram_user_id=telegram_user_id,
                 user_id=user_id)
 
+@timed_phase(PHASE_SQLITE)
 async def add_accounts(telegram_user_id: int, user_id: int, account_info: List[Dict[str, str]]) -> None:
     async with async_session() as session:
         async with session.begin():
@@ -536,6 +689,7 @@ async def add_accounts(telegram_user_id: int, user_id: int, account_info: List[D
                 user_id=user_id,
                 account_info=account_info)
 
+@timed_phase(PHASE_SQLITE)
 async def get_card(telegram_user_id: int, user_id: int, card_id) -> Optional[Card]:
     async with async_session() as session:
         async with session.begin():
@@ -545,6 +699,7 @@ async def get_card(telegram_user_id: int, user_id: int, card_id) -> Optional[Car
                 user_id=user_id,
                 card_id=card_id)
 
+@timed_phase(PHASE_SQLITE)
 async def get_cards(telegram_user_id: int, user_id: int) -> Optional[Sequence[Card]]:
     async with async_session() as session:
         async with session.begin():
@@ -553,6 +708,7 @@ async def get_cards(telegram_user_id: int, user_id: int) -> Optional[Sequence[Ca
                 telegram_user_id=telegram_user_id,
                 user_id=user_id)
 
+@timed_phase(PHASE_SQLITE)
 async def add_cards(telegram_user_id: int, user_id: int, card_info: List[Dict[str, str]]) -> None:
     async with async_session() as session:
         async with session.begin():
@@ -562,6 +718,78 @@ async def add_cards(telegram_user_id: int, user_id: int, card_info: List[Dict[st
                 user_id=user_id,
                 card_info=card_info)
 
+@timed_phase(PHASE_SQLITE)
+async def get_period_report(telegram_user_id: int, user_id: int, report_key: str, period_start: datetime, period_end: datetime) -> Optional[PeriodReport]:
+    async with async_session() as session:
+        async with session.begin():
+            db = AppDB(session)
+            return await db.get_period_report(
+                telegram_user_id=telegram_user_id,
+                user_id=user_id,
+                report_key=report_key,
+                period_start=period_start,
+                period_end=period_end)
+
+@timed_phase(PHASE_SQLITE)
+async def add_period_report(telegram_user_id: int, user_id: int, report_key: str, period_start: datetime, period_end: datetime, report: Dict) -> None:
+    async with async_session() as session:
+        async with session.begin():
+            db = AppDB(session)
+            return await db.add_period_report(
+                telegram_user_id=telegram_user_id,
+                user_id=user_id,
+                report_key=report_key,
+                period_start=period_start,
+                period_end=period_end,
+                report=report)
+
+@timed_phase(PHASE_SQLITE)
+async def get_sync_watermark(telegram_user_id: int, user_id: int, account_id: str) -> Optional[SyncWatermark]:
+    async with async_session() as session:
+        async with session.begin():
+            db = AppDB(session)
+            return await db.get_sync_watermark(
+                telegram_user_id=telegram_user_id,
+                user_id=user_id,
+                account_id=account_id)
+
+@timed_phase(PHASE_SQLITE)
+async def update_sync_watermark(telegram_user_id: int, user_id: int, account_id: str, last_posted_order: Optional[int], last_posting_date: Optional[str]) -> None:
+    async with async_session() as session:
+        async with session.begin():
+            db = AppDB(session)
+            return await db.update_sync_watermark(
+                telegram_user_id=telegram_user_id,
+                user_id=user_id,
+                account_id=account_id,
+                last_posted_order=last_posted_order,
+                last_posting_date=last_posting_date)
+
+@timed_phase(PHASE_SQLITE)
+async def get_backfill_windows(telegram_user_id: int, user_id: int, account_id: str) -> List[BackfillWindow]:
+    async with async_session() as session:
+        async with session.begin():
+            db = AppDB(session)
+            return await db.get_backfill_windows(
+                telegram_user_id=telegram_user_id,
+                user_id=user_id,
+                account_id=account_id)
+
+@timed_phase(PHASE_SQLITE)
+async def add_backfill_window(telegram_user_id: int, user_id: int, account_id: str, window_start: str, window_end: str, transactions: int, last_posted_order: Optional[int], last_posting_date: Optional[str]) -> None:
+    async with async_session() as session:
+        async with session.begin():
+            db = AppDB(session)
+            return await db.add_backfill_window(
+                telegram_user_id=telegram_user_id,
+                user_id=user_id,
+                account_id=account_id,
+                window_start=window_start,
+                window_end=window_end,
+                transactions=transactions,
+                last_posted_order=last_posted_order,
+                last_posting_date=last_posting_date)
+
 async def db_startup():
     log.info(f'Database startup {db_tablespace}...')
     # create db tables
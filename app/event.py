@@ -40,14 +40,19 @@ from .database import (
     get_user_from_card,
     User
 )
+from .tracing import Trace
+from .transaction import request_sync
+from .normalize import normalize_card_transaction
 
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 @dataclass
 class TransactionUpdate:
     user_id: int
     db_id: ObjectId
     payload: dict
+    # from SQS receipt to notification
+    trace: Optional[Trace] = None
 
 
 class CustomContext(CallbackContext[ExtBot, dict, dict, dict]):
@@ -68,17 +73,34 @@ class CustomContext(CallbackContext[ExtBot, dict, dict, dict]):
 
 class SQSEvent(AppThread):
 
-    def __init__(self, application: Application, mongodb_collection: Collection, queue_url: str, do_db_mutations: bool, remove_queued_messages: bool):
+    def __init__(self, application: Application, mongodb_collection: Collection, queue_url: str, do_db_mutations: bool, remove_queued_messages: bool, sqs_client=None, trigger_history_sync: bool = False):
         super().__init__(name=self.__class__.__name__)
         self._application: Application = application
         self._mongodb_collection: Collection = mongodb_collection
         self._queue_url = queue_url
         self._do_db_mutations = do_db_mutations
         self._remove_queued_messages = remove_queued_messages
+        # boto3 SQS client or a stand-in such as FakeSQS
+        self._sqs_client = sqs_client
+        # only when the transaction history thread is running
+        self._trigger_history_sync = trigger_history_sync
 
-    async def create_event(self, telegram_user_id: int, db_record_id: ObjectId, payload: dict):
+    async def create_event(self, telegram_user_id: int, db_record_id: ObjectId, payload: dict, trace: Optional[Trace] = None):
         log.debug(f'Generating bot event for Telegram user {telegram_user_id}...')
-        await self._application.update_queue.put(TransactionUpdate(user_id=telegram_user_id, db_id=db_record_id, payload=payload))
+        if trace:
+            trace.begin('update_queue.wait')
+        await self._application.update_queue.put(TransactionUpdate(user_id=telegram_user_id, db_id=db_record_id, payload=payload, trace=trace))
+
+    def start_trace(self, message: dict, received_ns: int) -> Trace:
+        attributes = message.get('Attributes', {})
+        # when SQS accepted the message, in epoch milliseconds
+        sent_ns = int(attributes.get('SentTimestamp', received_ns // 1_000_000)) * 1_000_000
+        trace = Trace('transaction', start_ns=sent_ns, **{'messaging.system': 'aws_sqs', 'messaging.message.id': message.get('MessageId')})
+        trace.add('sqs.queued', start_ns=sent_ns, end_ns=received_ns, **{
+            'sqs.message_age_ms': (received_ns - sent_ns) / 1_000_000,
+            'sqs.receive_count': int(attributes.get('ApproximateReceiveCount', 1))
+        })
+        return trace
 
     def unwrap_db_message(self, m: dict) -> Tuple[bool, dict]:
         if 'detail' in m.keys():
@@ -94,10 +116,26 @@ class SQSEvent(AppThread):
             return (True, None)
         return (False, m)
 
+    def delete_messages(self, sqs, messages: List[dict]):
+        if len(messages) == 0:
+            return
+        log.debug(f'Removing {len(messages)} messages from queue.')
+        # at most 10 entries per batch, matching MaxNumberOfMessages on receive
+        entries = [{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages)]
+        response = sqs.delete_message_batch(QueueUrl=self._queue_url, Entries=entries)
+        if 'Failed' in response:
+            for failure in response['Failed']:
+                message_handle = entries[int(failure['Id'])]['ReceiptHandle']
+                log.warning(f"Unable to remove message {message_handle} from queue: {failure.get('Code')} {failure.get('Message')}")
+
     def run(self):
         sqs_queue_name = self._queue_url.split('/')[-1]
-        log.info(f'Creating SQS client for queue {sqs_queue_name}')
-        sqs = boto3_session.client('sqs')
+        sqs = self._sqs_client
+        if sqs is None:
+            log.info(f'Creating SQS client for queue {sqs_queue_name}')
+            sqs = boto3_session.client('sqs')
+        else:
+            log.info(f'Using provided SQS client {sqs!r} for queue {sqs_queue_name}')
         while not threads.shutting_down:
             try:
                 # Take the messages off the queue
@@ -109,55 +147,79 @@ class SQSEvent(AppThread):
                     VisibilityTimeout=30,
                     WaitTimeSeconds=10
                 )
+                received_ns = time.time_ns()
                 if 'Messages' in response.keys():
-                    for message in response['Messages']:
-                        db_origin, doc = self.unwrap_db_message(m=loads(message['Body']))
-                        if doc and 'accountNumber' in doc and 'card' in doc:
-                            doc_ref = doc['reference']
-                            card_id = int(doc['card']['id'])
-                            date_str = doc['dateTime']
-                            log.info(f'Transaction {doc_ref} on card {card_id} dated {date_str}.')
-                            # simulation event
-                            sim_ref = 'simulation'
-                            if doc_ref == sim_ref:
-                                unix_ts = time.mktime(datetime.fromisoformat(date_str).timetuple())
-                                new_ref = f'{sim_ref}_{int(unix_ts)}'
-                                log.warning(f'Updating simulation reference to {new_ref} based on date {date_str}.')
-                                doc['reference'] = new_ref
-                            db: User = asyncio.run(get_user_from_card(card_id=card_id))
-                            # ensure that the event is on the application queue
-                            if db:
-                                log.info(f'Card {card_id} belongs to Telegram user {db.telegram_user_id}.')
-                                # but first, if the message is not of DB origin, then write it to the DB
-                                duplicate_event = False
-                                db_id: ObjectId = None
-                                if not db_origin:
-                                    if self._do_db_mutations:
-                                        log.info(f'Inserting transaction event {doc_ref} into MongoDB collection...')
-                                        try:
-                                            ir: InsertOneResult = self._mongodb_collection.insert_one(doc)
-                                            db_id = ir.inserted_id
-                                            log.debug(f'Inserted transaction event {doc_ref} into MongDB with ID {db_id!s} (acknowledged? {ir.acknowledged})')
-                                        except DuplicateKeyError:
-                                            log.warning(f'Discarding duplicate transaction event {doc_ref} dated {date_str}.')
-                                            duplicate_event = True
+                    processed_messages: List[dict] = []
+                    try:
+                        for message in response['Messages']:
+                            db_origin, doc = self.unwrap_db_message(m=loads(message['Body']))
+                            if doc and 'accountNumber' in doc and 'card' in doc:
+                                trace: Trace = self.start_trace(message=message, received_ns=received_ns)
+                                doc_ref = doc['reference']
+                                card_id = int(doc['card']['id'])
+                                date_str = doc['dateTime']
+                                log.info(f'Transaction {doc_ref} on card {card_id} dated {date_str}.')
+                                try:
+                                    # simulation event
+                                    sim_ref = 'simulation'
+                                    if doc_ref == sim_ref:
+                                        unix_ts = time.mktime(datetime.fromisoformat(date_str).timetuple())
+                                        new_ref = f'{sim_ref}_{int(unix_ts)}'
+                                        log.warning(f'Updating simulation reference to {new_ref} based on date {date_str}.')
+                                        doc['reference'] = new_ref
+                                    # ingest enrichment for indexed report filters
+                                    normalized_fields = normalize_card_transaction(doc=doc)
+                                except (KeyError, ValueError):
+                                    # redelivery would fail the same way
+                                    log.warning(f'Discarding transaction event {doc_ref} that cannot be normalized: {doc!s}.', exc_info=True)
+                                    trace.end(outcome='malformed')
+                                    processed_messages.append(message)
+                                    continue
+                                with trace.span('route', card_id=card_id):
+                                    db: User = asyncio.run(get_user_from_card(card_id=card_id))
+                                # ensure that the event is on the application queue
+                                if db:
+                                    log.info(f'Card {card_id} belongs to Telegram user {db.telegram_user_id}.')
+                                    # but first, if the message is not of DB origin, then write it to the DB
+                                    duplicate_event = False
+                                    db_id: ObjectId = None
+                                    if db_origin:
+                                        if self._do_db_mutations and '_id' in doc:
+                                            log.debug(f'Normalizing transaction event {doc_ref} in MongoDB collection...')
+                                            with trace.span('mongo.update'):
+                                                self._mongodb_collection.update_one({'_id': doc['_id']}, {'$set': normalized_fields})
                                     else:
-                                        log.warning(f'Not inserting transaction into MongoDB collection due to feature flag or config.')
-                                if not duplicate_event:
-                                    log.info(f'Creating notification event for Telegram user {db.telegram_user_id}')
-                                    asyncio.run(self.create_event(telegram_user_id=db.telegram_user_id, db_record_id=db_id, payload=doc))
+                                        if self._do_db_mutations:
+                                            log.info(f'Inserting transaction event {doc_ref} into MongoDB collection...')
+                                            try:
+                                                with trace.span('mongo.insert'):
+                                                    ir: InsertOneResult = self._mongodb_collection.insert_one(doc)
+                                                db_id = ir.inserted_id
+                                                log.debug(f'Inserted transaction event {doc_ref} into MongDB with ID {db_id!s} (acknowledged? {ir.acknowledged})')
+                                            except DuplicateKeyError:
+                                                log.warning(f'Discarding duplicate transaction event {doc_ref} dated {date_str}.')
+                                                duplicate_event = True
+                                                trace.end(outcome='duplicate')
+                                        else:
+                                            log.warning(f'Not inserting transaction into MongoDB collection due to feature flag or config.')
+                                    if not duplicate_event:
+                                        log.info(f'Creating notification event for Telegram user {db.telegram_user_id}')
+                                        asyncio.run(self.create_event(telegram_user_id=db.telegram_user_id, db_record_id=db_id, payload=doc, trace=trace))
+                                        if self._trigger_history_sync:
+                                            # card activity posts to the user's accounts soon after
+                                            request_sync(telegram_user_id=db.telegram_user_id)
+                                else:
+                                    log.warning(f'Ignoring event {doc_ref} for card {card_id} without an associated user.')
+                                    trace.end(outcome='no_user')
                             else:
-                                log.warning(f'Ignoring event {doc_ref} for card {card_id} without an associated user.')
-                        else:
-                            log.warning(f'Ignoring event {doc_ref} without transaction detail: {doc!s}.')
-                        # de-queue the processed message
-                        message_handle = message['ReceiptHandle']
+                                log.warning(f'Ignoring event {doc_ref} without transaction detail: {doc!s}.')
+                            processed_messages.append(message)
+                    finally:
+                        # de-queue the processed messages
                         if self._remove_queued_messages:
-                            log.debug(f'Removing message {message_handle} from queue.')
-                            # remove the message from the queue
-                            sqs.delete_message(QueueUrl=self._queue_url, ReceiptHandle=message_handle)
+                            self.delete_messages(sqs=sqs, messages=processed_messages)
                         else:
-                            log.warning(f'Not removing message {message_handle} from queue due to feature flag or config.')
+                            log.warning(f'Not removing {len(processed_messages)} messages from queue due to feature flag or config.')
             except (bcece, bccte, WriteError):
                 log.warning(f'SQS', exc_info=True)
                 threads.interruptable_sleep.wait(10)
@@ -0,0 +1,89 @@
+"""
+Bookkeeping for the account transaction history sync that needs nothing
+from the application runtime: which fetched transactions are new, how
+they are written, how far the sync watermark may advance and which date
+windows a backfill fetches.
+"""
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import AbstractSet, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
+
+
+# E11000, for an upsert that raced another insert of the same transaction
+DUPLICATE_KEY_ERROR = 11000
+
+
+@dataclass
+class UpsertResult:
+    upserted: int
+    matched: int
+    # stored by a concurrent upsert
+    duplicates: int = 0
+    # index of each transaction that could not be written, with the reason
+    failed: Dict[int, str] = field(default_factory=dict)
+
+
+def unseen_transactions(response: List[Dict], last_post: Optional[int]) -> List[Dict]:
+    updates: List[Dict] = []
+    for tran in response:
+        posted_order: int = int(tran['postedOrder'])
+        if posted_order == 0:
+            # pending transactions have no stable key and are stored once posted
+            continue
+        if last_post and posted_order <= last_post:
+            continue
+        updates.append(tran)
+    return updates
+
+
+def upsert_transactions(collection: Collection, updates: List[Dict]) -> UpsertResult:
+    """
+    Stores the transactions, keyed on the unique account posting order
+    so that overlapping fetches and retries are harmless.
+    """
+    operations = []
+    for tran in updates:
+        key = {'accountId': tran['accountId'], 'postedOrder': tran['postedOrder']}
+        fields = {name: value for name, value in tran.items() if name not in key}
+        operations.append(UpdateOne(key, {'$setOnInsert': fields}, upsert=True))
+    try:
+        result: BulkWriteResult = collection.bulk_write(operations, ordered=False)
+        return UpsertResult(upserted=result.upserted_count, matched=result.matched_count)
+    except BulkWriteError as e:
+        upsert_result = UpsertResult(upserted=e.details['nUpserted'], matched=e.details['nMatched'])
+        for write_error in e.details['writeErrors']:
+            if write_error['code'] == DUPLICATE_KEY_ERROR:
+                upsert_result.duplicates += 1
+            else:
+                upsert_result.failed[write_error['index']] = write_error['errmsg']
+        return upsert_result
+
+
+def watermark(updates: List[Dict], failed: AbstractSet[int]) -> Tuple[Optional[int], Optional[str]]:
+    """
+    The newest transaction that a watermark may advance to: the newest
+    stored transaction that is older than every failed one, so that
+    failed transactions are fetched again on the next sync.
+    """
+    first_failed: Optional[int] = min((int(updates[i]['postedOrder']) for i in failed), default=None)
+    stored = [tran for i, tran in enumerate(updates) if i not in failed and (first_failed is None or int(tran['postedOrder']) < first_failed)]
+    newest = max(stored, key=lambda tran: int(tran['postedOrder']), default=None)
+    if newest is None:
+        return None, None
+    return int(newest['postedOrder']), newest['postingDate']
+
+
+def backfill_windows(today: date, backfill_days: int, window_days: int) -> List[Tuple[date, date]]:
+    # aligned to fixed boundaries so that a resumed backfill sees the same windows
+    first = (today - timedelta(days=backfill_days)).toordinal()
+    ordinal = first - first % window_days
+    windows: List[Tuple[date, date]] = []
+    while ordinal <= today.toordinal():
+        windows.append((date.fromordinal(ordinal), date.fromordinal(ordinal + window_days - 1)))
+        ordinal += window_days
+    return windows
@@ -0,0 +1,123 @@
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from typing import Dict, List, Optional, Tuple
+
+from tailucas_pylib import log
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+from .pipeline import (
+    account_debits_pipeline,
+    account_history_pipeline,
+    card_charges_match
+)
+
+
+CARD_INDEXES: List[IndexModel] = [
+    # makes DuplicateKeyError on insert a reliable de-duplication signal
+    IndexModel([("reference", ASCENDING)], name='reference_unique', unique=True),
+    # card reports and notification totals
+    IndexModel([("accountNumber", ASCENDING), ("card.id", ASCENDING), ("isSimulation", ASCENDING), ("transactedAt", ASCENDING)], name='card_transacted_at'),
+]
+
+RATES_INDEXES: List[IndexModel] = [
+    # report pipelines look up one rate per currency and date
+    IndexModel([("currency", ASCENDING), ("date", ASCENDING)], name='currency_date_unique', unique=True),
+]
+
+ACCOUNT_INDEXES: List[IndexModel] = [
+    # latest posted transaction per account, and de-duplication of synced transactions;
+    # pending transactions are not yet ordered
+    IndexModel(
+        [("accountId", ASCENDING), ("postedOrder", DESCENDING)],
+        name='account_posted_order_unique',
+        unique=True,
+        partialFilterExpression={"postedOrder": {"$gt": 0}}),
+    # account debits report
+    IndexModel([("accountId", ASCENDING), ("transactedAt", ASCENDING)], name='account_transacted_at'),
+    # account history report across all accounts
+    IndexModel([("transactedAt", ASCENDING), ("accountId", ASCENDING)], name='transacted_at'),
+]
+
+
+def provision_indexes(collection: Collection, indexes: List[IndexModel]) -> None:
+    for index in indexes:
+        index_name = index.document['name']
+        try:
+            log.info(f'Ensuring index {index_name} on MongoDB collection {collection.name}...')
+            collection.create_indexes([index])
+        except OperationFailure as e:
+            # existing duplicates or a conflicting index definition; do not prevent startup
+            log.warning(f'Unable to create index {index_name} on MongoDB collection {collection.name} (code {e.code}): {e.details!s}. Try "mongotool --fix-duplicates".')
+
+
+def _plan_stages(plan) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+def _query_shapes(card_sample: Optional[dict], account_sample: Optional[dict]) -> List[Tuple[str, str, Dict, Optional[List]]]:
+    start_date = (datetime.now() - relativedelta(months=1)).strftime('%Y-%m-%d')
+    shapes = []
+    if card_sample:
+        account_number = card_sample['accountNumber']
+        card_id = card_sample['card']['id']
+        card_report = card_charges_match(account_numbers=[account_number], card_ids=[card_id], start_date=start_date, simulation_only=False)
+        shapes.append(('card', 'card_report', card_report, None))
+        shapes.append(('card', 'transaction_totals', {
+            "accountNumber": {"$eq": account_number},
+            "card.id": {"$eq": card_id},
+            "type": "card",
+            "isSimulation": False,
+            "transactedAt": {"$gte": datetime.strptime(start_date, '%Y-%m-%d')}
+        }, None))
+        shapes.append(('card', 'duplicate_event', {"reference": card_sample['reference']}, None))
+    if account_sample:
+        account_id = account_sample['accountId']
+        shapes.append(('account', 'sync_last_posted', {"accountId": {"$eq": account_id}}, [("postedOrder", DESCENDING)]))
+        accounts = account_debits_pipeline(account_id=account_id, start_date=start_date)
+        shapes.append(('account', 'accounts', accounts[0]['$match'], None))
+        account_history = account_history_pipeline(account_id=account_id, start_date=start_date)
+        shapes.append(('account', 'account_history', account_history[0]['$match'], None))
+        all_history = account_history_pipeline(account_id=None, start_date=start_date)
+        shapes.append(('account', 'account_history_all', all_history[0]['$match'], None))
+    return shapes
+
+
+def index_advisor(card_collection: Collection, account_collection: Collection) -> int:
+    """
+    Explain each query shape used by the application against a sample document
+    and report the shapes that need a collection scan.
+    """
+    collections = {
+        'card': card_collection,
+        'account': account_collection
+    }
+    shapes = _query_shapes(
+        card_sample=card_collection.find_one({"type": "card"}),
+        account_sample=account_collection.find_one())
+    collscans = 0
+    for collection_key, shape_name, query, sort in shapes:
+        collection: Collection = collections[collection_key]
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain: dict = cursor.limit(1).explain()
+        stages = _plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))
+        if 'COLLSCAN' in stages:
+            collscans += 1
+            log.warning(f'Query {shape_name} on MongoDB collection {collection.name} uses a collection scan: {stages}')
+        else:
+            log.info(f'Query {shape_name} on MongoDB collection {collection.name} uses plan {stages}')
+    log.info(f'Index advisor checked {len(shapes)} queries and found {collscans} collection scans.')
+    return collscans
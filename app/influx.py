@@ -1,34 +1,182 @@
+import random
+import threading
+
+from datetime import datetime, timezone
+
 from . import APP_NAME
 
+from typing import Dict, List, Tuple
+
 from tailucas_pylib import (
     app_config,
     creds,
     device_name_base,
-    log
+    log,
+    threads
 )
+from tailucas_pylib.app import AppThread
 
 from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import WriteApi, ASYNCHRONOUS
+from influxdb_client.client.write_api import WriteApi, SYNCHRONOUS
+
+
+# reported for every histogram alongside count, sum, min and max
+PERCENTILES = [50, 95, 99]
+
+
+class Histogram(object):
+    """
+    Observations of a value between flushes. Count, sum, min and max are
+    exact; percentiles come from a bounded uniform sample.
+    """
+    def __init__(self, max_samples: int):
+        self._max_samples = max_samples
+        self.samples: List[float] = []
+        self.count: int = 0
+        self.total: float = 0.0
+        self.min: float = float('inf')
+        self.max: float = float('-inf')
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.samples) < self._max_samples:
+            self.samples.append(value)
+        else:
+            # reservoir sampling keeps every observation equally likely to be held
+            i = random.randrange(self.count)
+            if i < self._max_samples:
+                self.samples[i] = value
+
+    def percentile(self, p: int) -> float:
+        ranked = sorted(self.samples)
+        return ranked[min(len(ranked) - 1, max(0, round(p / 100 * len(ranked)) - 1))]
 
 
 class InfluxDB(object):
+    """
+    Metrics are aggregated in memory and written to InfluxDB in batches,
+    either on an interval or once enough series are pending. Points that
+    cannot be written are retained up to a bound, beyond which the oldest
+    are dropped and counted.
+    """
     def __init__(self) -> None:
         self._influxdb_bucket = app_config.get('influxdb', 'bucket')
+        self.flush_interval_secs: int = app_config.getint('influxdb', 'flush_interval_secs')
+        self._flush_size: int = app_config.getint('influxdb', 'flush_size')
+        self._max_buffer: int = app_config.getint('influxdb', 'max_buffer')
+        self._histogram_max_samples: int = app_config.getint('influxdb', 'histogram_max_samples')
         log.info(f'Starting InfluxDB client to {creds.influxdb_url} using bucket {creds.influxdb_org}::{self._influxdb_bucket}...')
         self._influxdb = InfluxDBClient(
             url=creds.influxdb_url,
             token=creds.influxdb_token,
-            org=creds.influxdb_org)
-        self._influxdb_rw: WriteApi = self._influxdb.write_api(write_options=ASYNCHRONOUS)
+            org=creds.influxdb_org,
+            timeout=app_config.getint('influxdb', 'write_timeout_ms'))
+        # writes happen only on the flushing thread, so no background write tasks accumulate
+        self._influxdb_rw: WriteApi = self._influxdb.write_api(write_options=SYNCHRONOUS)
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self._gauges: Dict[Tuple[str, str], float] = {}
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        # points not yet accepted by InfluxDB
+        self._buffer: List[Point] = []
+        self._dropped: int = 0
+        self._flush_lock = threading.Lock()
+        self.flush_needed = threading.Event()
+
+    def _pending(self) -> int:
+        return len(self._counters) + len(self._gauges) + len(self._histograms)
+
+    def _recorded(self) -> None:
+        if self._pending() >= self._flush_size:
+            self.flush_needed.set()
 
+    def count(self, point_name: str, field_name: str, value: int = 1) -> None:
+        with self._lock:
+            key = (point_name, field_name)
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._recorded()
+
+    def gauge(self, point_name: str, field_name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[(point_name, field_name)] = value
+            self._recorded()
+
+    def observe(self, point_name: str, field_name: str, value: float) -> None:
+        with self._lock:
+            key = (point_name, field_name)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(max_samples=self._histogram_max_samples)
+                self._histograms[key] = histogram
+            histogram.observe(value)
+            self._recorded()
+
+    def _point(self, point_name: str, timestamp: datetime) -> Point:
+        # stamped when collected, so that points retried later keep their time
+        return Point(point_name).tag("application", APP_NAME).tag("device", device_name_base).time(timestamp)
+
+    def _collect(self) -> List[Point]:
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            gauges, self._gauges = self._gauges, {}
+            histograms, self._histograms = self._histograms, {}
+            dropped, self._dropped = self._dropped, 0
+        if dropped > 0:
+            counters[('metrics', 'dropped')] = counters.get(('metrics', 'dropped'), 0) + dropped
+        now = datetime.now(timezone.utc)
+        points: List[Point] = []
+        for (point_name, field_name), value in counters.items():
+            points.append(self._point(point_name, now).field(field_name, value))
+        for (point_name, field_name), value in gauges.items():
+            points.append(self._point(point_name, now).field(field_name, value))
+        for (point_name, field_name), histogram in histograms.items():
+            point = self._point(point_name, now) \
+                .field(f'{field_name}_count', histogram.count) \
+                .field(f'{field_name}_sum', histogram.total) \
+                .field(f'{field_name}_min', histogram.min) \
+                .field(f'{field_name}_max', histogram.max)
+            for p in PERCENTILES:
+                point = point.field(f'{field_name}_p{p}', histogram.percentile(p))
+            points.append(point)
+        return points
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            self.flush_needed.clear()
+            points = self._buffer + self._collect()
+            self._buffer = []
+            if len(points) == 0:
+                return
+            try:
+                log.debug(f'Writing {len(points)} InfluxDB points for application={APP_NAME}, device={device_name_base}.')
+                self._influxdb_rw.write(bucket=self._influxdb_bucket, record=points)
+            except Exception:
+                log.warning(f'Unable to post {len(points)} points to InfluxDB.', exc_info=True)
+                overflow = len(points) - self._max_buffer
+                if overflow > 0:
+                    # keep the most recent
+                    points = points[overflow:]
+                    with self._lock:
+                        self._dropped += overflow
+                self._buffer = points
+
+    def close(self) -> None:
+        self.flush()
+        self._influxdb.close()
 
-    def write(self, point_name: str, field_name: str, field_value):
-        try:
-            log.debug(f'Writing InfluxDB point {point_name=}, application={APP_NAME}, device={device_name_base}: {field_name}={field_value!s}')
-            self._influxdb_rw.write(
-                bucket=self._influxdb_bucket,
-                record=Point(point_name).tag("application", APP_NAME).tag("device", device_name_base).field(field_name, field_value))
-        except Exception:
-            log.warning(f'Unable to post to InfluxDB.', exc_info=True)
 
 influxdb = InfluxDB()
+
+
+class InfluxDBFlusher(AppThread):
+
+    def __init__(self):
+        AppThread.__init__(self, name=self.__class__.__name__)
+
+    def run(self):
+        while not threads.shutting_down:
+            influxdb.flush_needed.wait(timeout=influxdb.flush_interval_secs)
+            influxdb.flush()
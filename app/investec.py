@@ -0,0 +1,175 @@
+import asyncio
+import json
+import requests
+import threading
+
+from bson.json_util import loads
+from datetime import datetime, timedelta
+from requests.auth import HTTPBasicAuth
+from typing import Dict, List, Optional, Tuple
+
+from tailucas_pylib import log, threads
+from tailucas_pylib.app import AppThread
+
+from investec_api_python import InvestecOpenApiClient
+
+from .database import User, update_access_token
+
+
+class PooledInvestecClient(InvestecOpenApiClient):
+    """
+    An Investec API client that reuses its HTTP connections across requests
+    and is safe to share between threads. The access token is refreshed
+    under a lock, ahead of its expiry.
+    """
+    def __init__(self, user: User, access_token: Optional[Tuple[str, datetime]], refresh_margin: timedelta):
+        creds = loads(user.investec_credentials)
+        InvestecOpenApiClient.__init__(
+            self,
+            client_id=user.investec_client_id,
+            secret=creds['secret'],
+            api_key=creds['api_key'],
+            additional_headers={'Accept-Encoding': 'gzip, deflate, br'},
+            access_token=access_token)
+        self.user_id: int = user.id
+        self.telegram_user_id: int = user.telegram_user_id
+        self.credentials_digest: str = user.investec_credentials_digest
+        self._refresh_margin: timedelta = refresh_margin
+        self._session = requests.Session()
+        self._token_lock = threading.Lock()
+        # the token last written to the database
+        self._persisted_token: Optional[str] = access_token[0] if access_token else None
+
+    def token_expiring(self) -> bool:
+        return self._access_token is None or self._token_expiry is None or self._token_expiry - self._refresh_margin <= datetime.now()
+
+    def refresh_token(self, if_expiring: bool = False) -> str:
+        with self._token_lock:
+            if if_expiring and not self.token_expiring():
+                # refreshed by another thread while waiting
+                return self._access_token
+            url = f'{self._url}/identity/v2/oauth2/token'
+            headers = self._get_base_headers(additional={'Content-Type': 'application/x-www-form-urlencoded', 'x-api-key': self._api_key})
+            log.debug(f'Refreshing access token for Telegram user {self.telegram_user_id}...')
+            response = self._session.post(
+                url,
+                auth=HTTPBasicAuth(self._client_id, self._secret),
+                headers=headers,
+                data='grant_type=client_credentials')
+            response.raise_for_status()
+            token = response.json()
+            self._access_token = token['access_token']
+            self._token_expiry = datetime.now() + timedelta(seconds=token['expires_in'])
+            return self._access_token
+
+    def unpersisted_token(self) -> Optional[Tuple[str, datetime]]:
+        # hand out a new token once, for the caller to write to the database
+        with self._token_lock:
+            if self._access_token is None or self._access_token == self._persisted_token:
+                return None
+            self._persisted_token = self._access_token
+            return (self._access_token, self._token_expiry)
+
+    def _get_token(self) -> str:
+        if self.token_expiring():
+            return self.refresh_token(if_expiring=True)
+        return self._access_token
+
+    def _query_api_get(self, url: str, params: Optional[Dict[str, str]]=None) -> Dict:
+        headers = self._get_request_headers()
+        log.debug(f'GET {url}')
+        response = self._session.get(
+            url=url,
+            headers=headers,
+            params=params)
+        response.raise_for_status()
+        return response.json()['data']
+
+    def _query_api_post(self, url: str, data: str) -> Dict:
+        headers = self._get_request_headers(additional={'Content-Type': 'application/json'})
+        req_data = json.dumps(data)
+        log.debug(f'POST {url} ({len(req_data)} bytes)')
+        response = self._session.post(
+            url=url,
+            headers=headers,
+            data=req_data)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self) -> None:
+        self._session.close()
+
+
+class InvestecClients(object):
+    """
+    One long-lived API client per user, shared by the transaction history
+    sync and the bot handlers.
+    """
+    def __init__(self):
+        self._clients: Dict[int, PooledInvestecClient] = {}
+        self._lock = threading.Lock()
+        self._refresh_margin = timedelta(minutes=5)
+
+    def configure(self, refresh_margin_secs: int) -> None:
+        self._refresh_margin = timedelta(seconds=refresh_margin_secs)
+
+    def get(self, user: User) -> Optional[PooledInvestecClient]:
+        with self._lock:
+            client = self._clients.get(user.id)
+            if client and client.credentials_digest != user.investec_credentials_digest:
+                # credentials were replaced
+                del self._clients[user.id]
+                client.close()
+                return None
+            return client
+
+    def put(self, user: User, access_token: Optional[Tuple[str, datetime]]) -> PooledInvestecClient:
+        with self._lock:
+            client = self._clients.get(user.id)
+            if client and client.credentials_digest == user.investec_credentials_digest:
+                return client
+            if client:
+                client.close()
+            client = PooledInvestecClient(user=user, access_token=access_token, refresh_margin=self._refresh_margin)
+            self._clients[user.id] = client
+            return client
+
+    def clients(self) -> List[PooledInvestecClient]:
+        with self._lock:
+            return list(self._clients.values())
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+investec_clients = InvestecClients()
+
+
+class TokenRefresher(AppThread):
+
+    def __init__(self, check_interval_secs: int):
+        AppThread.__init__(self, name=self.__class__.__name__)
+        self._check_interval_secs: int = check_interval_secs
+
+    def run(self):
+        while not threads.shutting_down:
+            for client in investec_clients.clients():
+                if not client.token_expiring():
+                    continue
+                try:
+                    client.refresh_token(if_expiring=True)
+                except requests.RequestException:
+                    log.warning(f'Cannot refresh access token for Telegram user {client.telegram_user_id}.', exc_info=True)
+                    continue
+                access_token = client.unpersisted_token()
+                if access_token:
+                    log.info(f'Refreshed access token for Telegram user {client.telegram_user_id} (expires {access_token[1]}).')
+                    asyncio.run(update_access_token(
+                        telegram_user_id=client.telegram_user_id,
+                        user_id=client.user_id,
+                        access_token=access_token[0],
+                        access_token_expiry=access_token[1]))
+            threads.interruptable_sleep.wait(self._check_interval_secs)
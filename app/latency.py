@@ -0,0 +1,100 @@
+"""
+Wall time of bot handlers, broken down by the phases of work that they
+wait on. Phases are summed per handler invocation and may nest, such as
+the MongoDB queries made while converting currency. Outside of a timed
+handler, phase timings are ignored.
+"""
+import time
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from pymongo.monitoring import (
+    CommandFailedEvent,
+    CommandListener,
+    CommandStartedEvent,
+    CommandSucceededEvent
+)
+
+from telegram.request import HTTPXRequest
+
+from .influx import influxdb
+
+
+PHASE_SQLITE = 'sqlite'
+PHASE_MONGO = 'mongo'
+PHASE_CURRENCY = 'currency'
+PHASE_RENDER = 'render'
+PHASE_TELEGRAM = 'telegram'
+
+# time spent per phase by the handler running in the current task
+_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar('handler_phases', default=None)
+
+
+def record_phase(phase: str, secs: float) -> None:
+    phases = _phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + secs
+
+
+@asynccontextmanager
+async def phase(name: str) -> AsyncIterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - start)
+
+
+def timed_phase(name: str) -> Callable:
+    def decorator(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            async with phase(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_handler(handler: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        phases: Dict[str, float] = {}
+        token = _phases.set(phases)
+        start = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _phases.reset(token)
+            influxdb.observe('handler', f'{handler.__name__}_secs', elapsed)
+            for name, secs in phases.items():
+                influxdb.observe('handler', f'{handler.__name__}_{name}_secs', secs)
+    return wrapper
+
+
+class MongoCommandTimer(CommandListener):
+    """
+    Attributes MongoDB command time to the handler that issued it. The
+    asynchronous client publishes events from the issuing task.
+    """
+    def started(self, event: CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: CommandSucceededEvent) -> None:
+        record_phase(PHASE_MONGO, event.duration_micros / 1_000_000)
+
+    def failed(self, event: CommandFailedEvent) -> None:
+        record_phase(PHASE_MONGO, event.duration_micros / 1_000_000)
+
+
+class TimedRequest(HTTPXRequest):
+    """
+    Attributes Bot API calls, such as sending messages and photos, to the
+    handler that made them.
+    """
+    async def do_request(self, *args, **kwargs):
+        async with phase(PHASE_TELEGRAM):
+            return await super().do_request(*args, **kwargs)
@@ -0,0 +1,106 @@
+import html
+import re
+import threading
+
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from tailucas_pylib import log, threads
+from tailucas_pylib.app import AppThread
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+from pymongo.results import BulkWriteResult
+
+
+SIMULATION_REFERENCE = 'simulation'
+# marks a document as normalized
+NORMALIZED_FIELD = 'rateDate'
+
+# set once existing documents carry the normalized fields, until when
+# results filtered on them may undercount and must not be retained
+normalization_complete = threading.Event()
+
+
+def merchant_key(name: str) -> str:
+    # variants of the same merchant differ in case, escaping, padding and separators
+    key = html.unescape(name).replace('*', ' ')
+    return re.sub(r'\s+', ' ', key).strip().casefold()
+
+
+def _naive_datetime(date_str: str) -> datetime:
+    # keep the wall-clock time as recorded so that date comparisons match the original string
+    return datetime.fromisoformat(date_str).replace(tzinfo=None)
+
+
+def normalize_card_transaction(doc: dict) -> Dict:
+    date_str = str(doc['dateTime'])
+    fields = {
+        'transactedAt': _naive_datetime(date_str=date_str),
+        'rateDate': date_str.split('T')[0],
+        'isSimulation': str(doc['reference']).startswith(SIMULATION_REFERENCE),
+        'merchantKey': merchant_key(name=doc['merchant']['name']),
+    }
+    doc.update(fields)
+    return fields
+
+
+def normalize_account_transaction(doc: dict) -> Dict:
+    date_str = str(doc['transactionDate'])
+    fields = {
+        'transactedAt': _naive_datetime(date_str=date_str),
+        'rateDate': date_str.split('T')[0],
+        'isSimulation': False,
+        'merchantKey': merchant_key(name=str(doc['description'])),
+    }
+    doc.update(fields)
+    return fields
+
+
+def backfill(collection: Collection, normalize: Callable[[dict], Dict], batch_size: int) -> int:
+    log.info(f'Normalizing existing documents in MongoDB collection {collection.name}...')
+    cursor = collection.find({NORMALIZED_FIELD: {"$exists": False}}, batch_size=batch_size)
+    updated = 0
+    updates: List[UpdateOne] = []
+    for doc in cursor:
+        if threads.shutting_down:
+            break
+        try:
+            fields = normalize(doc)
+        except (KeyError, ValueError):
+            log.warning(f'Cannot normalize document {doc["_id"]!s} in MongoDB collection {collection.name}.', exc_info=True)
+            continue
+        updates.append(UpdateOne({'_id': doc['_id']}, {'$set': fields}))
+        if len(updates) >= batch_size:
+            result: BulkWriteResult = collection.bulk_write(updates, ordered=False)
+            updated += result.modified_count
+            updates = []
+    if len(updates) > 0:
+        result: BulkWriteResult = collection.bulk_write(updates, ordered=False)
+        updated += result.modified_count
+    cursor.close()
+    log.info(f'Normalized {updated} documents in MongoDB collection {collection.name}.')
+    return updated
+
+
+class NormalizationBackfill(AppThread):
+
+    def __init__(self, card_collection: Collection, account_collection: Collection, batch_size: int):
+        AppThread.__init__(self, name=self.__class__.__name__)
+        self._card_collection: Collection = card_collection
+        self._account_collection: Collection = account_collection
+        self._batch_size: int = batch_size
+
+    def run(self):
+        try:
+            # only documents without normalized fields are visited, so this is a no-op once complete
+            backfill(collection=self._card_collection, normalize=normalize_card_transaction, batch_size=self._batch_size)
+            backfill(collection=self._account_collection, normalize=normalize_account_transaction, batch_size=self._batch_size)
+            if not threads.shutting_down:
+                normalization_complete.set()
+        except PyMongoError:
+            log.warning(f'Normalization backfill is incomplete and resumes on next startup.', exc_info=True)
+        finally:
+            # a one-off thread, not one for the thread nanny to watch
+            self.untrack()
@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+
+@dataclass
+class NotificationContext:
+    telegram_user_id: int
+    user_id: int
+    first_name: str
+    card_id: int
+    card_name: str
+    account_number: str
+    start_date: str
+    # start of the next reporting period
+    expiry: datetime
+
+
+class NotificationContexts(object):
+    """
+    Everything a card event notification needs before it can query for totals,
+    built once per card and dropped on settings or card changes, or when the
+    reporting period rolls over.
+    """
+    def __init__(self):
+        self._contexts: Dict[Tuple[int, int], NotificationContext] = {}
+
+    def get(self, telegram_user_id: int, card_id: int) -> Optional[NotificationContext]:
+        key = (telegram_user_id, card_id)
+        notification_context = self._contexts.get(key)
+        if notification_context is None:
+            return None
+        if datetime.now() >= notification_context.expiry:
+            del self._contexts[key]
+            return None
+        return notification_context
+
+    def put(self, notification_context: NotificationContext) -> None:
+        self._contexts[(notification_context.telegram_user_id, notification_context.card_id)] = notification_context
+
+    def invalidate(self, telegram_user_id: int) -> None:
+        for key in [k for k in self._contexts.keys() if k[0] == telegram_user_id]:
+            del self._contexts[key]
+
+
+notification_contexts = NotificationContexts()
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+
+from typing import Optional, Tuple
+
+
+DEFAULT_INTERVAL = '_month_'
+
+
+def get_datetime_a_month_ago() -> datetime:
+    now = datetime.now()
+    a_month_ago = now - relativedelta(months=1)
+    return a_month_ago
+
+
+def get_last_of_day(day: int) -> datetime:
+    now = datetime.now()
+    if now.day >= day:
+        this_month = now.replace(day=day)
+        return this_month
+    else:
+        previous_month = (now - relativedelta(months=1)).replace(day=day)
+        return previous_month
+
+
+def get_report_period(interval: str, periods_ago: int) -> Tuple[datetime, Optional[datetime]]:
+    # the current period is open and runs to now, earlier periods are closed
+    if interval == DEFAULT_INTERVAL:
+        if periods_ago == 0:
+            return get_datetime_a_month_ago(), None
+        # earlier periods are calendar months
+        current = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        current = get_last_of_day(day=int(interval))
+        if periods_ago == 0:
+            return current, None
+        current = current.replace(hour=0, minute=0, second=0, microsecond=0)
+    # offsets from the current period keep month-end billing days aligned
+    return current - relativedelta(months=periods_ago), current - relativedelta(months=periods_ago-1)
+
+
+def describe_report_period(period_start: datetime, period_end: Optional[datetime]) -> str:
+    if period_end is None:
+        return f'since {period_start.strftime("%d %B %Y")}'
+    return f'from {period_start.strftime("%d %B %Y")} to {(period_end - timedelta(days=1)).strftime("%d %B %Y")}'
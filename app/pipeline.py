@@ -0,0 +1,149 @@
+"""
+MongoDB aggregation pipelines for reports. Filtering and grouping happen
+server-side so that only one row per group is returned. Ranking does not:
+reports keep every group so that the Aggregator can sum everything outside
+the top entries into an "Other" total, and closed-period reports are cached
+whole.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+def _start_of(start_date: str) -> datetime:
+    # report periods are whole days, compared against the normalized transactedAt
+    return datetime.strptime(start_date, '%Y-%m-%d')
+
+
+def _period(start_date: str, end_date: Optional[str]) -> Dict:
+    # closed periods exclude their end date, open periods run to now
+    period = {
+        "$gte": _start_of(start_date)
+    }
+    if end_date:
+        period["$lt"] = _start_of(end_date)
+    return period
+
+
+def account_debits_pipeline(account_id: str, start_date: Optional[str]) -> List[Dict]:
+    match = {
+        "accountId": account_id,
+        "type": {
+            "$ne": "CREDIT"
+        },
+        "amount": {
+            "$ne": 0
+        }
+    }
+    if start_date:
+        match["transactedAt"] = {
+            "$gte": _start_of(start_date)
+        }
+    return [
+        {"$match": match},
+        {"$project": {"_id": 0, "description": 1, "amount": 1}},
+        {"$group": {
+            "_id": "$description",
+            "total": {"$sum": {"$toDouble": "$amount"}},
+            "count": {"$sum": 1}
+        }}
+    ]
+
+
+def account_history_pipeline(account_id: Optional[str], start_date: str, end_date: Optional[str] = None) -> List[Dict]:
+    match = {
+        "transactedAt": _period(start_date, end_date),
+        "type": {
+            "$ne": "CREDIT"
+        },
+        "amount": {
+            "$ne": 0
+        }
+    }
+    if account_id:
+        match["accountId"] = account_id
+    return [
+        {"$match": match},
+        {"$project": {"_id": 0, "transactionType": 1, "description": 1, "amount": 1}},
+        {"$group": {
+            # the description is only needed to label untyped transactions
+            "_id": {
+                "transactionType": "$transactionType",
+                "description": {
+                    "$cond": [{"$eq": [{"$ifNull": ["$transactionType", None]}, None]}, "$description", None]
+                }
+            },
+            "total": {"$sum": {"$toDouble": "$amount"}},
+            "count": {"$sum": 1}
+        }},
+        {"$sort": {"total": -1}}
+    ]
+
+
+def card_charges_match(account_numbers: List[str], card_ids: List[str], start_date: str, simulation_only: bool, end_date: Optional[str] = None) -> Dict:
+    return {
+        "accountNumber": {
+            "$in": account_numbers
+        },
+        "card.id" : {
+            "$in": card_ids
+        },
+        "type": "card",
+        "isSimulation": simulation_only,
+        "transactedAt": _period(start_date, end_date),
+        "centsAmount": {
+            "$ne": 0
+        }
+    }
+
+
+def card_rate_keys_pipeline(account_numbers: List[str], card_ids: List[str], start_date: str, simulation_only: bool, end_date: Optional[str] = None) -> List[Dict]:
+    return [
+        {"$match": card_charges_match(account_numbers, card_ids, start_date, simulation_only, end_date)},
+        {"$group": {
+            "_id": {
+                "currencyCode": {"$toUpper": "$currencyCode"},
+                "rateDate": "$rateDate"
+            }
+        }}
+    ]
+
+
+def card_charges_pipeline(account_numbers: List[str], card_ids: List[str], start_date: str, simulation_only: bool, rates_collection: str, end_date: Optional[str] = None) -> List[Dict]:
+    return [
+        {"$match": card_charges_match(account_numbers, card_ids, start_date, simulation_only, end_date)},
+        {"$project": {"_id": 0, "merchant.name": 1, "merchantKey": 1, "centsAmount": 1, "currencyCode": 1, "rateDate": 1}},
+        # conversion is linear, so one rate lookup per currency and rate date suffices
+        {"$group": {
+            "_id": {
+                "merchant": "$merchantKey",
+                "currencyCode": {"$toUpper": "$currencyCode"},
+                "rateDate": "$rateDate"
+            },
+            "merchantName": {"$first": "$merchant.name"},
+            "cents": {"$sum": "$centsAmount"},
+            "count": {"$sum": 1}
+        }},
+        {"$lookup": {
+            "from": rates_collection,
+            "let": {"currency": "$_id.currencyCode", "date": "$_id.rateDate"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$currency", "$$currency"]},
+                    {"$eq": ["$date", "$$date"]}
+                ]}}},
+                {"$project": {"_id": 0, "rate": 1}}
+            ],
+            "as": "rate"
+        }},
+        {"$set": {
+            "rate": {"$arrayElemAt": ["$rate.rate", 0]}
+        }},
+        {"$group": {
+            "_id": "$_id.merchant",
+            "merchantName": {"$first": "$merchantName"},
+            # local currency cents; charges without a rate are left out and counted
+            "localCents": {"$sum": {"$multiply": ["$cents", "$rate"]}},
+            "count": {"$sum": "$count"},
+            "unconverted": {"$sum": {"$cond": [{"$eq": [{"$ifNull": ["$rate", None]}, None]}, "$count", 0]}}
+        }}
+    ]
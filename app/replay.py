@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import builtins
+import locale
+import os
+import random
+import statistics
+import threading
+import time
+import uuid
+
+from argparse import ArgumentParser, Namespace
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+# setup builtins used by pylib init
+from . import APP_NAME
+builtins.SENTRY_EXTRAS = []
+AWS_REGION = os.environ['AWS_DEFAULT_REGION']
+influx_creds_section = 'local'
+
+
+class CredsConfig:
+    sentry_dsn: f'opitem:"Sentry" opfield:{APP_NAME}.dsn' = None  # type: ignore
+    aes_sym_key: f'opitem:"AES.{APP_NAME}" opfield:.password' = None # type: ignore
+    influxdb_org: f'opitem:"InfluxDB" opfield:{influx_creds_section}.org' = None # type: ignore
+    influxdb_token: f'opitem:"InfluxDB" opfield:{APP_NAME}.token' = None # type: ignore
+    influxdb_url: f'opitem:"InfluxDB" opfield:{influx_creds_section}.url' = None # type: ignore
+    mongodb_user: f'opitem:"MongoDB" opfield:{APP_NAME}.user' = None # type: ignore
+    mongodb_password: f'opitem:"MongoDB" opfield:{APP_NAME}.pwd' = None # type: ignore
+    aws_akid: f'opitem:"AWS.{APP_NAME}" opfield:{AWS_REGION}.akid' = None # type: ignore
+    aws_sak: f'opitem:"AWS.{APP_NAME}" opfield:{AWS_REGION}.sak' = None # type: ignore
+    exchangerate_host: f'opitem:"exchangerate.host" opfield:.credential' = None # type: ignore
+
+# do not replace a configuration already loaded by the application
+if not hasattr(builtins, 'creds_config'):
+    builtins.creds_config = CredsConfig()
+
+from bson.json_util import dumps, loads
+
+from tailucas_pylib import (
+    app_config,
+    creds,
+    log,
+    threads
+)
+from tailucas_pylib.threads import die
+
+from pymongo import AsyncMongoClient, MongoClient
+from pymongo.collection import Collection
+
+from telegram import ChatMember, ChatMemberMember
+from telegram import User as TelegramUser
+
+from .bot import transaction_update
+from .currency import CurrencyConverter
+from .event import SQSEvent, TransactionUpdate
+from .sqs import FakeSQS
+from .tracing import Span, SpanExporter, TraceExporter, tracer
+
+
+REPLAY_QUEUE_URL = 'https://sqs.local/000000000000/replay'
+SIMULATION_REFERENCE = 'simulation'
+SYNTHETIC_MERCHANTS = [
+    'Corner Cafe',
+    'Fuel Stop',
+    'Grocer',
+    'Parking Garage',
+    'Streaming Service',
+    'Toll Road',
+]
+
+
+def synthetic_transaction(card_id: int, account_number: str, when: datetime, simulation: bool, currency_code: str) -> dict:
+    reference = SIMULATION_REFERENCE
+    if not simulation:
+        reference = f'replay_{uuid.uuid4().hex}'
+    return {
+        'accountNumber': account_number,
+        'dateTime': when.isoformat(timespec='milliseconds'),
+        'centsAmount': random.randint(100, 50000),
+        'currencyCode': currency_code,
+        'type': 'card',
+        'reference': reference,
+        'card': {
+            'id': str(card_id)
+        },
+        'merchant': {
+            'name': random.choice(SYNTHETIC_MERCHANTS),
+            'city': 'Cape Town',
+            'country': {
+                'code': 'ZA',
+                'alpha3': 'ZAF',
+                'name': 'South Africa'
+            },
+            'category': {
+                'code': '5499',
+                'key': 'misc_food_stores',
+                'name': 'Misc Food Stores'
+            }
+        }
+    }
+
+
+def wrap_db_message(doc: dict) -> dict:
+    # EventBridge envelope as produced by a MongoDB database trigger
+    return {
+        'version': '0',
+        'id': str(uuid.uuid4()),
+        'detail-type': 'MongoDB Database Trigger for replay',
+        'source': 'replay',
+        'time': datetime.now(tz=timezone.utc).isoformat(),
+        'resources': [],
+        'detail': {
+            'operationType': 'insert',
+            'fullDocument': doc
+        }
+    }
+
+
+def update_key(doc: dict) -> Tuple[str, str]:
+    return (str(doc['card']['id']), str(doc['dateTime']))
+
+
+class UpdateRecorder(object):
+    """
+    Stands in for the Telegram application update queue, timing each
+    transaction update against the time that its message was sent. This
+    ends where the bot would pick the update up, so bot-side notification
+    and the Telegram send are not included; see NotificationRecorder.
+    """
+    def __init__(self, expected: int):
+        self._lock = threading.Lock()
+        self._sent: Dict[Tuple[str, str], List[float]] = {}
+        self._expected: int = expected
+        self.latencies: List[float] = []
+        self.first_sent: Optional[float] = None
+        self.last_enqueued: Optional[float] = None
+        self.complete = threading.Event()
+
+    def sent(self, doc: dict):
+        now = time.time()
+        with self._lock:
+            if self.first_sent is None:
+                self.first_sent = now
+            self._sent.setdefault(update_key(doc=doc), []).append(now)
+
+    async def put(self, update: TransactionUpdate):
+        now = time.time()
+        with self._lock:
+            sent_times = self._sent.get(update_key(doc=update.payload))
+            if not sent_times:
+                log.warning(f'Update for unknown transaction {update.payload.get("reference")}.')
+                return
+            self.latencies.append(now - sent_times.pop(0))
+            self.last_enqueued = now
+            if len(self.latencies) >= self._expected:
+                self.complete.set()
+
+
+class ReplayApplication(object):
+    def __init__(self, recorder: UpdateRecorder):
+        self.update_queue: UpdateRecorder = recorder
+
+
+class NotificationRecorder(SpanExporter):
+    """
+    Receives the spans of finished transaction traces, timing each
+    notification from the time that its message was sent to the end of
+    the Telegram send. Traces that end without a notification, such as
+    duplicates, count towards completion but not towards the latencies.
+    """
+    def __init__(self, expected: int):
+        self._lock = threading.Lock()
+        self._expected: int = expected
+        self._finished: int = 0
+        self.latencies: List[float] = []
+        self.first_sent: Optional[float] = None
+        self.last_notified: Optional[float] = None
+        self.complete = threading.Event()
+
+    def export(self, spans: List[Span]) -> None:
+        roots: Dict[str, Span] = {span.trace_id: span for span in spans if span.parent_id is None}
+        with self._lock:
+            for span in spans:
+                if span.name != 'telegram.send_message' or span.end_ns is None:
+                    continue
+                root = roots[span.trace_id]
+                self.latencies.append((span.end_ns - root.start_ns) / 1_000_000_000)
+                if self.first_sent is None or root.start_ns / 1_000_000_000 < self.first_sent:
+                    self.first_sent = root.start_ns / 1_000_000_000
+                if self.last_notified is None or span.end_ns / 1_000_000_000 > self.last_notified:
+                    self.last_notified = span.end_ns / 1_000_000_000
+            self._finished += len(roots)
+            if self._finished >= self._expected:
+                self.complete.set()
+
+
+class ReplayBot(object):
+    """
+    Stands in for the Telegram bot on the notification path. Notifications
+    are built but not sent, so the Telegram API round trip is not included.
+    """
+    async def get_chat_member(self, chat_id: int, user_id: int) -> ChatMember:
+        return ChatMemberMember(user=TelegramUser(id=user_id, first_name='Replay', is_bot=False))
+
+    async def send_message(self, chat_id: int, text: str, **kwargs: Any) -> None:
+        log.debug(f'Notification for Telegram user {chat_id}: {text}')
+
+
+class ReplayContext(object):
+    def __init__(self, application: 'NotifyingApplication'):
+        self.application: NotifyingApplication = application
+        self.bot: ReplayBot = application.bot
+
+
+class ReplayUpdateQueue(object):
+    def __init__(self, loop: asyncio.AbstractEventLoop, updates: asyncio.Queue):
+        self._loop = loop
+        self._updates = updates
+
+    async def put(self, update: TransactionUpdate):
+        # called from the event thread
+        self._loop.call_soon_threadsafe(self._updates.put_nowait, update)
+
+
+class NotifyingApplication(object):
+    """
+    Stands in for the Telegram application, handing transaction updates one
+    at a time to the bot's notification path on an event loop of its own.
+    """
+    def __init__(self, md_async_conn: AsyncMongoClient):
+        self._md_async_conn = md_async_conn
+        md_async_db = md_async_conn[app_config.get('mongodb', 'db_name')]
+        self.bot_data: Dict[str, Any] = {
+            'mongodb_card_collection': md_async_db[app_config.get('mongodb', 'card_collection_name')]
+        }
+        self.bot = ReplayBot()
+        self._loop = asyncio.new_event_loop()
+        self._updates: asyncio.Queue = asyncio.Queue()
+        self.update_queue = ReplayUpdateQueue(loop=self._loop, updates=self._updates)
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def create_task(self, coroutine, update: Optional[object] = None) -> asyncio.Task:
+        return self._loop.create_task(coroutine)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._handle_updates())
+
+    async def _handle_updates(self) -> None:
+        context = ReplayContext(application=self)
+        while not threads.shutting_down:
+            try:
+                update: TransactionUpdate = await asyncio.wait_for(self._updates.get(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            try:
+                await transaction_update(update=update, context=context)
+            except Exception:
+                log.warning(f'Unable to notify transaction {update.payload.get("reference")}.', exc_info=True)
+        await self._md_async_conn.close()
+
+
+def load_messages(args: Namespace) -> List[dict]:
+    docs: List[dict] = []
+    if args.input_file:
+        log.info(f'Loading recorded transactions from {args.input_file}...')
+        with open(args.input_file, 'r') as file:
+            recorded = loads(file.read())
+        for item in recorded:
+            if 'detail' in item:
+                # already an EventBridge envelope
+                docs.append(item)
+                continue
+            if not args.db_origin:
+                # let the event handler insert its own copy
+                item.pop('_id', None)
+            docs.append(item)
+    else:
+        if args.card_id is None or args.account_number is None:
+            raise RuntimeError('Synthetic transactions need a card ID and account number.')
+        start = datetime.now(tz=timezone.utc) - timedelta(seconds=args.count)
+        for i in range(args.count):
+            # unique to the second so that simulation references remain unique
+            docs.append(synthetic_transaction(
+                card_id=args.card_id,
+                account_number=args.account_number,
+                when=start + timedelta(seconds=i),
+                simulation=args.simulation,
+                currency_code=args.currency_code))
+    messages = []
+    for doc in docs:
+        if args.db_origin and 'detail' not in doc:
+            doc = wrap_db_message(doc=doc)
+        messages.append(doc)
+    return messages
+
+
+def feed(fake_sqs: FakeSQS, recorder: UpdateRecorder, messages: List[dict], rate: float):
+    start = time.monotonic()
+    for i, message in enumerate(messages):
+        delay = start + (i / rate) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        doc = message
+        if 'detail' in message:
+            doc = message['detail']['fullDocument']
+        recorder.sent(doc=doc)
+        fake_sqs.send_message(QueueUrl=REPLAY_QUEUE_URL, MessageBody=dumps(message))
+    log.info(f'Sent {len(messages)} messages in {time.monotonic()-start:.3f}s.')
+
+
+def report(latencies: List[float], first_sent: float, last_recorded: float, stage: str):
+    recorded = len(latencies)
+    elapsed = last_recorded - first_sent
+    throughput = recorded / elapsed if elapsed > 0 else float(recorded)
+    latencies_ms = sorted(l * 1000 for l in latencies)
+    if len(latencies_ms) > 1:
+        percentiles = statistics.quantiles(latencies_ms, n=100, method='inclusive')
+        p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
+    else:
+        p50 = p95 = p99 = latencies_ms[0]
+    log.info(f'Throughput {throughput:.1f} messages/s over {elapsed:.3f}s.')
+    log.info(f'Event to {stage} latency p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms max={latencies_ms[-1]:.1f}ms.')
+
+
+def init_cli() -> Namespace:
+    parser: ArgumentParser = argparse.ArgumentParser(description='Replay card transactions through SQS event handling.')
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument('-f', action='store', dest='input_file', help='JSON-encoded list of recorded transactions (as produced by mongotool --dump-collection)')
+    source_group.add_argument('-n', action='store', dest='count', type=int, help='Number of synthetic transactions to generate')
+    parser.add_argument('--card-id', action='store', dest='card_id', type=int, help='Registered card ID for synthetic transactions')
+    parser.add_argument('--account-number', action='store', dest='account_number', help='Account number for synthetic transactions')
+    parser.add_argument('--currency-code', action='store', dest='currency_code', default='zar', help='Currency code for synthetic transactions')
+    parser.add_argument('--simulation', action='store_true', default=False, help='Use simulation references for synthetic transactions')
+    parser.add_argument('--db-origin', action='store_true', default=False, help='Wrap transactions in the EventBridge database trigger envelope')
+    parser.add_argument('--rate', action='store', type=float, default=10.0, help='Messages per second to send')
+    parser.add_argument('--visibility-timeout', action='store', type=int, default=30, help='Visibility timeout of the fake queue')
+    parser.add_argument('--insert', action='store_true', default=False, help='Insert transactions into the configured MongoDB card collection')
+    parser.add_argument('--notify', action='store_true', default=False, help='Run the bot notification path against a stand-in Telegram bot and report event to notification latency')
+    parser.add_argument('--timeout', action='store', type=float, default=60.0, help='Seconds to wait for transaction updates after sending')
+    return parser.parse_args()
+
+
+def main():
+    args = init_cli()
+    messages = load_messages(args=args)
+    recorder = UpdateRecorder(expected=len(messages))
+    notification_recorder: Optional[NotificationRecorder] = None
+    application = ReplayApplication(recorder=recorder)
+    fake_sqs = FakeSQS(queue_url=REPLAY_QUEUE_URL, visibility_timeout=args.visibility_timeout)
+    md_conn: Optional[MongoClient] = None
+    md_card_collection: Optional[Collection] = None
+    try:
+        if args.insert or args.notify:
+            mongodb_connection_string = app_config.get('mongodb', 'conn_string')
+            db_url = mongodb_connection_string.replace('__USER__', creds.mongodb_user).replace('__PASSWORD__', creds.mongodb_password)
+        if args.insert:
+            md_conn = MongoClient(db_url)
+            md_card_collection = md_conn[app_config.get('mongodb', 'db_name')][app_config.get('mongodb', 'card_collection_name')]
+        if args.notify:
+            # notifications convert charges to the local currency
+            locale.setlocale(locale.LC_ALL, os.environ['LC_ALL'])
+            conv = locale.localeconv()
+            currency_converter = CurrencyConverter(
+                int_curr_symbol=str(conv['int_curr_symbol']).rstrip(),
+                currency_symbol=str(conv['currency_symbol']))
+            currency_converter.start()
+            # the notification time is taken from the end of the send span
+            notification_recorder = NotificationRecorder(expected=len(messages))
+            tracer.configure(exporters=[notification_recorder], queue_size=len(messages))
+            trace_exporter = TraceExporter(batch_size=app_config.getint('tracing', 'export_batch_size'))
+            trace_exporter.start()
+            application = NotifyingApplication(md_async_conn=AsyncMongoClient(db_url))
+            application.start()
+        sqs_events = SQSEvent(
+            application=application,
+            mongodb_collection=md_card_collection,
+            queue_url=REPLAY_QUEUE_URL,
+            do_db_mutations=args.insert,
+            remove_queued_messages=True,
+            sqs_client=fake_sqs)
+        sqs_events.start()
+        log.info(f'Replaying {len(messages)} transactions at {args.rate} messages/s...')
+        feed(fake_sqs=fake_sqs, recorder=recorder, messages=messages, rate=args.rate)
+        complete = notification_recorder.complete if notification_recorder else recorder.complete
+        if not complete.wait(timeout=args.timeout):
+            log.warning(f'Timed out after {args.timeout}s waiting for transaction updates ({fake_sqs.queue_depth} messages still queued).')
+        if notification_recorder:
+            log.info(f'Notified {len(notification_recorder.latencies)} of {len(messages)} transactions.')
+            if len(notification_recorder.latencies) > 0:
+                report(
+                    latencies=notification_recorder.latencies,
+                    first_sent=notification_recorder.first_sent,
+                    last_recorded=notification_recorder.last_notified,
+                    stage='notification')
+        else:
+            log.info(f'Enqueued {len(recorder.latencies)} of {len(messages)} transaction updates.')
+            if len(recorder.latencies) > 0:
+                report(
+                    latencies=recorder.latencies,
+                    first_sent=recorder.first_sent,
+                    last_recorded=recorder.last_enqueued,
+                    stage='enqueue')
+    finally:
+        die()
+        if md_conn:
+            md_conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+
+@dataclass
+class FakeMessage:
+    message_id: str
+    body: str
+    sent_timestamp: int
+    visible_at: float = 0.0
+    receive_count: int = 0
+    first_receive_timestamp: Optional[int] = None
+    receipt_handle: Optional[str] = None
+    message_attributes: Dict = field(default_factory=dict)
+
+
+class FakeSQS(object):
+    """
+    In-process stand-in for the subset of the boto3 SQS client used by `SQSEvent`.
+    Messages received and not deleted become visible again after the visibility timeout,
+    and a new receipt handle is issued on every receive, as with the real service.
+    """
+    def __init__(self, queue_url: str, visibility_timeout: int = 30):
+        self._queue_url: str = queue_url
+        self._visibility_timeout: int = visibility_timeout
+        self._messages: OrderedDict[str, FakeMessage] = OrderedDict()
+        self._handles: Dict[str, str] = {}
+        self._lock = threading.Condition()
+        self.sent_count: int = 0
+        self.received_count: int = 0
+        self.deleted_count: int = 0
+
+    @property
+    def queue_depth(self) -> int:
+        with self._lock:
+            return len(self._messages)
+
+    def _check_queue(self, queue_url: str):
+        if queue_url != self._queue_url:
+            raise ClientError(
+                error_response={'Error': {'Code': 'AWS.SimpleQueueService.NonExistentQueue', 'Message': f'No queue {queue_url}.'}},
+                operation_name='ReceiveMessage')
+
+    def send_message(self, QueueUrl: str, MessageBody: str, DelaySeconds: int = 0, MessageAttributes: Optional[Dict] = None) -> Dict:
+        self._check_queue(queue_url=QueueUrl)
+        message = FakeMessage(
+            message_id=str(uuid.uuid4()),
+            body=MessageBody,
+            sent_timestamp=int(time.time() * 1000),
+            visible_at=time.monotonic() + DelaySeconds,
+            message_attributes=MessageAttributes or {})
+        with self._lock:
+            self._messages[message.message_id] = message
+            self.sent_count += 1
+            self._lock.notify_all()
+        return {'MessageId': message.message_id}
+
+    def _visible(self, now: float) -> List[FakeMessage]:
+        return [m for m in self._messages.values() if m.visible_at <= now]
+
+    def receive_message(self, QueueUrl: str, AttributeNames: Optional[List[str]] = None, MaxNumberOfMessages: int = 1, MessageAttributeNames: Optional[List[str]] = None, VisibilityTimeout: Optional[int] = None, WaitTimeSeconds: int = 0) -> Dict:
+        self._check_queue(queue_url=QueueUrl)
+        if VisibilityTimeout is None:
+            VisibilityTimeout = self._visibility_timeout
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                visible = self._visible(now=now)
+                if len(visible) > 0 or now >= deadline:
+                    break
+                # wake up for new messages or for the next visibility expiry
+                wait_for = deadline - now
+                pending = [m.visible_at - now for m in self._messages.values()]
+                if len(pending) > 0:
+                    wait_for = min(wait_for, max(min(pending), 0.01))
+                self._lock.wait(timeout=wait_for)
+            response_messages = []
+            now_ms = int(time.time() * 1000)
+            for message in visible[:MaxNumberOfMessages]:
+                if message.receipt_handle:
+                    # earlier handles are no longer valid
+                    del self._handles[message.receipt_handle]
+                message.receipt_handle = str(uuid.uuid4())
+                self._handles[message.receipt_handle] = message.message_id
+                message.visible_at = now + VisibilityTimeout
+                message.receive_count += 1
+                if message.first_receive_timestamp is None:
+                    message.first_receive_timestamp = now_ms
+                response_message = {
+                    'MessageId': message.message_id,
+                    'ReceiptHandle': message.receipt_handle,
+                    'Body': message.body,
+                }
+                if AttributeNames:
+                    response_message['Attributes'] = {
+                        'SentTimestamp': str(message.sent_timestamp),
+                        'ApproximateReceiveCount': str(message.receive_count),
+                        'ApproximateFirstReceiveTimestamp': str(message.first_receive_timestamp),
+                    }
+                if MessageAttributeNames and message.message_attributes:
+                    response_message['MessageAttributes'] = message.message_attributes
+                response_messages.append(response_message)
+            self.received_count += len(response_messages)
+        response = {}
+        if len(response_messages) > 0:
+            response['Messages'] = response_messages
+        return response
+
+    def _delete(self, receipt_handle: str) -> bool:
+        message_id = self._handles.pop(receipt_handle, None)
+        if message_id is None:
+            return False
+        del self._messages[message_id]
+        self.deleted_count += 1
+        return True
+
+    def delete_message(self, QueueUrl: str, ReceiptHandle: str) -> Dict:
+        self._check_queue(queue_url=QueueUrl)
+        with self._lock:
+            if not self._delete(receipt_handle=ReceiptHandle):
+                raise ClientError(
+                    error_response={'Error': {'Code': 'ReceiptHandleIsInvalid', 'Message': f'Invalid receipt handle {ReceiptHandle}.'}},
+                    operation_name='DeleteMessage')
+        return {}
+
+    def delete_message_batch(self, QueueUrl: str, Entries: List[Dict]) -> Dict:
+        self._check_queue(queue_url=QueueUrl)
+        if len(Entries) > 10:
+            raise ClientError(
+                error_response={'Error': {'Code': 'AWS.SimpleQueueService.TooManyEntriesInBatchRequest', 'Message': f'{len(Entries)} entries.'}},
+                operation_name='DeleteMessageBatch')
+        successful = []
+        failed = []
+        with self._lock:
+            for entry in Entries:
+                if self._delete(receipt_handle=entry['ReceiptHandle']):
+                    successful.append({'Id': entry['Id']})
+                else:
+                    failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid', 'Message': 'Invalid receipt handle.'})
+        response = {'Successful': successful}
+        if len(failed) > 0:
+            response['Failed'] = failed
+        return response
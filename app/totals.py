@@ -0,0 +1,66 @@
+import asyncio
+
+from typing import Dict, Optional, Set, Tuple
+
+from .aggregate import Aggregator, Converter
+
+
+class CardTotals(object):
+    """
+    Charge count and local currency total (in cents) per merchant for one card
+    over one reporting period.
+    """
+    def __init__(self, card_id: str, start_date: str, convert: Converter):
+        self.card_id: str = card_id
+        self.start_date: str = start_date
+        self._merchants = Aggregator(convert=convert)
+        self._references: Set[str] = set()
+
+    def seen(self, reference: str) -> bool:
+        return reference in self._references
+
+    async def add(self, reference: str, merchant: str, charge_cents: int, charge_currency: str, charge_date: str) -> bool:
+        # events are delivered at least once and may already be in the seed query
+        if reference in self._references:
+            return False
+        self._references.add(reference)
+        await self._merchants.add(key=merchant, amount=charge_cents, currency=charge_currency, rate_date=charge_date)
+        return True
+
+    def get(self, merchant: str) -> Tuple[int, float]:
+        return self._merchants.get(key=merchant)
+
+
+class RunningTotals(object):
+    """
+    Card totals for the current reporting period of each card. A card is
+    seeded once from the database and then maintained as events arrive.
+    Totals for a new period replace those of the previous one.
+    """
+    def __init__(self):
+        self._cards: Dict[str, CardTotals] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def lock(self, card_id: str) -> asyncio.Lock:
+        # serialize seeding and updates per card
+        if card_id not in self._locks:
+            self._locks[card_id] = asyncio.Lock()
+        return self._locks[card_id]
+
+    def get(self, card_id: str, start_date: str) -> Optional[CardTotals]:
+        card_totals = self._cards.get(card_id)
+        if card_totals is None or card_totals.start_date != start_date:
+            return None
+        return card_totals
+
+    def put(self, card_totals: CardTotals) -> None:
+        self._cards[card_totals.card_id] = card_totals
+
+    def invalidate(self, card_id: Optional[str] = None) -> None:
+        if card_id is None:
+            self._cards.clear()
+        else:
+            self._cards.pop(card_id, None)
+
+
+running_totals = RunningTotals()
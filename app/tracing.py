@@ -0,0 +1,291 @@
+import json
+import os
+import queue
+import requests
+import secrets
+import sys
+import time
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+from tailucas_pylib import log, threads
+from tailucas_pylib.app import AppThread
+
+from .influx import influxdb
+
+
+EXPORTER_CONSOLE = 'console'
+EXPORTER_FILE = 'file'
+EXPORTER_OTLP = 'otlp'
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CONSUMER = 5
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    start_ns: int
+    end_ns: Optional[int] = None
+    kind: int = SPAN_KIND_INTERNAL
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1_000_000
+
+    def end(self, end_ns: Optional[int] = None) -> None:
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': round(self.duration_ms, 3),
+            'attributes': self.attributes
+        }
+
+
+class Trace(object):
+    """
+    The spans of one transaction event, from the moment SQS accepted it to
+    the Telegram notification. A trace is handed between threads with the
+    event that it describes and is only touched by one of them at a time.
+    """
+    def __init__(self, name: str, start_ns: Optional[int] = None, **attributes):
+        self.trace_id: str = secrets.token_hex(16)
+        self.spans: List[Span] = []
+        self._open: Dict[str, Span] = {}
+        self._ended: bool = False
+        self.root: Span = self._span(name=name, parent_id=None, start_ns=start_ns, kind=SPAN_KIND_CONSUMER, attributes=attributes)
+
+    def _span(self, name: str, parent_id: Optional[str], start_ns: Optional[int], kind: int, attributes: Dict[str, Any]) -> Span:
+        span = Span(
+            trace_id=self.trace_id,
+            span_id=secrets.token_hex(8),
+            parent_id=parent_id,
+            name=name,
+            start_ns=start_ns or time.time_ns(),
+            kind=kind,
+            attributes=attributes)
+        self.spans.append(span)
+        return span
+
+    def add(self, name: str, start_ns: int, end_ns: int, **attributes) -> Span:
+        span = self._span(name=name, parent_id=self.root.span_id, start_ns=start_ns, kind=SPAN_KIND_INTERNAL, attributes=attributes)
+        span.end(end_ns=end_ns)
+        return span
+
+    def begin(self, name: str, **attributes) -> Span:
+        # for spans that end in another function, or another thread
+        span = self._span(name=name, parent_id=self.root.span_id, start_ns=None, kind=SPAN_KIND_INTERNAL, attributes=attributes)
+        self._open[name] = span
+        return span
+
+    def finish(self, name: str, **attributes) -> None:
+        span = self._open.pop(name, None)
+        if span:
+            span.attributes.update(attributes)
+            span.end()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        span = self._span(name=name, parent_id=self.root.span_id, start_ns=None, kind=SPAN_KIND_INTERNAL, attributes=attributes)
+        try:
+            yield span
+        finally:
+            span.end()
+
+    def end(self, **attributes) -> None:
+        if self._ended:
+            return
+        self._ended = True
+        end_ns = time.time_ns()
+        for span in self._open.values():
+            span.end(end_ns=end_ns)
+        self._open.clear()
+        self.root.attributes.update(attributes)
+        self.root.end(end_ns=end_ns)
+        tracer.export(trace=self)
+
+
+class SpanExporter(ABC):
+    @abstractmethod
+    def export(self, spans: List[Span]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class ConsoleSpanExporter(SpanExporter):
+
+    def export(self, spans: List[Span]) -> None:
+        for span in spans:
+            sys.stdout.write(json.dumps(span.to_dict()) + '\n')
+        sys.stdout.flush()
+
+
+class FileSpanExporter(SpanExporter):
+    """
+    Spans as JSON lines, for offline analysis. Once the file reaches its
+    size limit it is rotated, keeping a single previous file.
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self._path = path
+        self._max_bytes = max_bytes
+
+    def export(self, spans: List[Span]) -> None:
+        if os.path.exists(self._path) and os.path.getsize(self._path) >= self._max_bytes:
+            os.replace(self._path, f'{self._path}.1')
+        with open(self._path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict()) + '\n')
+
+
+class OtlpHttpSpanExporter(SpanExporter):
+    """
+    Spans in the OTLP/HTTP JSON encoding, accepted by OpenTelemetry
+    collectors and most tracing backends.
+    """
+    def __init__(self, endpoint: str, service_name: str, timeout_secs: float):
+        self._url = f'{endpoint.rstrip("/")}/v1/traces'
+        self._service_name = service_name
+        self._timeout_secs = timeout_secs
+        self._session = requests.Session()
+
+    @staticmethod
+    def _value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def _attributes(self, attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [{'key': key, 'value': self._value(value)} for key, value in attributes.items() if value is not None]
+
+    def _span(self, span: Span) -> Dict[str, Any]:
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': span.kind,
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns or span.start_ns),
+            'attributes': self._attributes(span.attributes)
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        return otlp_span
+
+    def export(self, spans: List[Span]) -> None:
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': self._attributes({'service.name': self._service_name})},
+                'scopeSpans': [{
+                    'scope': {'name': __name__},
+                    'spans': [self._span(span) for span in spans]
+                }]
+            }]
+        }
+        response = self._session.post(self._url, json=payload, timeout=self._timeout_secs)
+        response.raise_for_status()
+
+    def close(self) -> None:
+        self._session.close()
+
+
+def create_exporters(names: List[str], file_path: str, file_max_bytes: int, otlp_endpoint: str, service_name: str, timeout_secs: float) -> List[SpanExporter]:
+    exporters: List[SpanExporter] = []
+    for name in names:
+        if name == EXPORTER_CONSOLE:
+            exporters.append(ConsoleSpanExporter())
+        elif name == EXPORTER_FILE:
+            exporters.append(FileSpanExporter(path=file_path, max_bytes=file_max_bytes))
+        elif name == EXPORTER_OTLP:
+            exporters.append(OtlpHttpSpanExporter(endpoint=otlp_endpoint, service_name=service_name, timeout_secs=timeout_secs))
+        else:
+            raise AssertionError(f'Trace exporter {name} is not one of {[EXPORTER_CONSOLE, EXPORTER_FILE, EXPORTER_OTLP]}.')
+    return exporters
+
+
+class Tracer(object):
+    """
+    Finished traces wait in a bounded queue for the export thread. When the
+    queue is full, or no exporter is configured, traces are dropped.
+    """
+    def __init__(self):
+        self._exporters: List[SpanExporter] = []
+        self._queue: queue.Queue = queue.Queue(maxsize=1)
+
+    def configure(self, exporters: List[SpanExporter], queue_size: int) -> None:
+        self._exporters = exporters
+        self._queue = queue.Queue(maxsize=queue_size)
+
+    @property
+    def enabled(self) -> bool:
+        return len(self._exporters) > 0
+
+    def export(self, trace: Trace) -> None:
+        if not self.enabled:
+            return
+        log.debug(f'Trace {trace.trace_id} {trace.root.name} took {trace.root.duration_ms:.1f}ms: ' + ', '.join(f'{span.name}={span.duration_ms:.1f}ms' for span in trace.spans[1:]))
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            influxdb.count('tracing', 'dropped')
+
+    def drain(self, max_traces: int, timeout_secs: float) -> List[Trace]:
+        traces: List[Trace] = []
+        try:
+            traces.append(self._queue.get(timeout=timeout_secs))
+            while len(traces) < max_traces:
+                traces.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return traces
+
+    def flush(self, traces: List[Trace]) -> None:
+        spans = [span for trace in traces for span in trace.spans]
+        for exporter in self._exporters:
+            try:
+                exporter.export(spans=spans)
+            except Exception:
+                log.warning(f'Unable to export {len(spans)} spans using {exporter.__class__.__name__}.', exc_info=True)
+                influxdb.count('tracing', 'export_errors')
+
+    def close(self) -> None:
+        for exporter in self._exporters:
+            exporter.close()
+
+
+tracer = Tracer()
+
+
+class TraceExporter(AppThread):
+
+    def __init__(self, batch_size: int):
+        AppThread.__init__(self, name=self.__class__.__name__)
+        self._batch_size = batch_size
+
+    def run(self):
+        while not threads.shutting_down:
+            traces = tracer.drain(max_traces=self._batch_size, timeout_secs=1)
+            if len(traces) > 0:
+                tracer.flush(traces=traces)
+        tracer.close()
@@ -1,10 +1,12 @@
 import asyncio
-from bson.json_util import loads
+import threading
 import time
 import zmq
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
 from requests.exceptions import HTTPError
-from typing import Dict, Optional, Tuple, Sequence, List
+from typing import Any, Dict, Optional, Set, Tuple, Sequence, List
 from zmq.error import ZMQError, ContextTerminated, Again
 
 from tailucas_pylib import log, threads
@@ -19,6 +21,8 @@ from pymongo.cursor import Cursor
 from .database import (
     Account,
     Card,
+    BackfillWindow,
+    SyncWatermark,
     User,
     get_access_token,
     update_access_token,
@@ -29,122 +33,444 @@ from .database import (
     add_accounts,
     get_card,
     get_cards,
-    add_cards
+    add_cards,
+    get_sync_watermark,
+    update_sync_watermark,
+    get_backfill_windows,
+    add_backfill_window
 )
 
-from investec_api_python import InvestecOpenApiClient
+from .history import UpsertResult, backfill_windows, unseen_transactions, upsert_transactions, watermark
+from .influx import influxdb
+from .investec import PooledInvestecClient, investec_clients
+from .normalize import normalize_account_transaction
 
 
 URL_WORKER_TRANSACTION_HISTORY = 'inproc://transaction-history'
 
+# upper bound on how long the scheduler blocks, so that shutdown is noticed
+MAX_POLL_SECS = 30
+IN_FLIGHT_POLL_SECS = 1
+# throttled or failed API requests are retried after 2, 4 and 8 seconds
+API_RETRIES = 3
+API_BACKOFF_SECS = 2
+TOO_MANY_REQUESTS = 429
+
 
 class TransactionHistory(AppThread):
 
-        def __init__(self, mongodb_collection: Collection, sync_interval: int, do_db_mutations: bool):
+        def __init__(self, mongodb_collection: Collection, sync_interval: int, do_db_mutations: bool, sync_concurrency: int, min_sync_interval: int, max_sync_interval: int, backfill_days: int, backfill_window_days: int, backfill_concurrency: int):
             AppThread.__init__(self, name=self.__class__.__name__)
             self._mongodb_collection: Collection = mongodb_collection
-            self._last_sync: Optional[int] = None
+            # starting interval for each account, and how often the account list is reloaded
             self._sync_interval_secs: int = sync_interval
+            # bounds on the interval as it adapts to account activity
+            self._min_interval_secs: int = min(min_sync_interval, sync_interval)
+            self._max_interval_secs: int = max(max_sync_interval, sync_interval)
+            self._accounts: Dict[str, Tuple[User, Account]] = {}
+            self._intervals: Dict[str, float] = {}
+            # monotonic time at which each account is next due
+            self._next_sync: Dict[str, float] = {}
+            self._in_flight: Dict[str, Future] = {}
+            self._last_load: float = 0.0
+            # monotonic time of the last honoured trigger per Telegram user
+            self._last_user_trigger: Dict[int, float] = {}
             self._do_db_mutations = do_db_mutations
+            # bounds concurrent Investec API calls across all users
+            self._sync_concurrency: int = sync_concurrency
+            # history of a new account is fetched in windows, a few at a time
+            self._backfill_days: int = backfill_days
+            self._backfill_window_days: int = backfill_window_days
+            # shared by every backfill so that the window fetches are bounded globally
+            self._backfill_executor = ThreadPoolExecutor(max_workers=backfill_concurrency, thread_name_prefix='TransactionBackfill')
+            # held for each Investec API request, by syncs and backfills alike
+            self._api_slots = threading.BoundedSemaphore(sync_concurrency)
 
-        def run(self):
-            with exception_handler(
-                connect_url=URL_WORKER_TRANSACTION_HISTORY,
-                socket_type=zmq.REP,
-                and_raise=False,
-                shutdown_on_error=True) as zmq_socket:
-                while not threads.shutting_down:
-                    trigger = None
+        def _client(self, user: User) -> PooledInvestecClient:
+            client: Optional[PooledInvestecClient] = investec_clients.get(user=user)
+            if client is None:
+                access_token: Optional[Tuple] = asyncio.run(get_access_token(telegram_user_id=user.telegram_user_id, user_id=user.id))
+                client = investec_clients.put(user=user, access_token=access_token)
+            return client
+
+        def _persist_access_token(self, client: PooledInvestecClient) -> None:
+            access_token: Optional[Tuple] = client.unpersisted_token()
+            if access_token:
+                log.debug(f'Persisting access token...')
+                asyncio.run(update_access_token(
+                    telegram_user_id=client.telegram_user_id,
+                    user_id=client.user_id,
+                    access_token=access_token[0],
+                    access_token_expiry=access_token[1]))
+
+        def _fetch(self, client: PooledInvestecClient, account: Account, **kwargs: Any) -> Optional[List[Dict]]:
+            """
+            Fetches account transactions while holding an API slot. Throttled
+            (429) and server error responses are retried with exponential
+            backoff, honouring Retry-After, without holding the slot. Returns
+            None once the retries are used up; other errors are raised.
+            """
+            for attempt in range(API_RETRIES + 1):
+                with self._api_slots:
                     try:
-                        trigger = zmq_socket.recv_pyobj(flags=zmq.NOBLOCK)
-                    except Again:
-                        # ignore, no data
-                        pass
-                    now = int(time.time())
-                    sync_needed: bool = trigger or self._last_sync is None or now - self._last_sync >= self._sync_interval_secs
-                    if not sync_needed:
-                        # never spin
-                        threads.interruptable_sleep.wait(30)
-                        continue
-                    else:
-                        self._last_sync = now
-                    # fetch registered users
-                    users: Optional[Sequence[User]] = asyncio.run(get_users())
-                    if users is None:
-                        log.info('No users registered.')
-                        continue
-                    else:
-                        log.info(f'Loaded {len(users)} users.')
-                    for user in users:
-                        access_token: Optional[Tuple] = asyncio.run(get_access_token(telegram_user_id=user.telegram_user_id, user_id=user.id))
-                        creds = loads(user.investec_credentials)
-                        client = InvestecOpenApiClient(
-                            client_id=user.investec_client_id,
-                            secret=creds['secret'],
-                            api_key=creds['api_key'],
-                            additional_headers={'Accept-Encoding': 'gzip, deflate, br'},
-                            access_token=access_token)
-                        log.info(f'Fetching accounts for Telegram user {user.telegram_user_id}...')
-                        accounts: Optional[Sequence[Account]] = asyncio.run(get_accounts(telegram_user_id=user.telegram_user_id, user_id=user.id))
-                        if accounts is None:
-                            log.info(f'No accounts for Telegram user {user.telegram_user_id}')
-                            continue
-                        else:
-                            log.info(f'Loaded {len(accounts)} accounts for Telegram user {user.telegram_user_id}.')
-                        for account in accounts:
-                            # fetch latest persisted
-                            mongo_query = {
-                                "accountId": {
-                                    "$eq": account.account_id
-                                }
-                            }
-                            projection = {}
-                            sort = [
-                                ("postedOrder", DESCENDING)
-                            ]
-                            log.debug(f'Fetching data from MongoDB collection...')
-                            last_post: Optional[int] = None
-                            last_date: Optional[str] = None
-                            doc = self._mongodb_collection.find_one(mongo_query, projection=projection, sort=sort)
-                            if doc:
-                                account_id = doc['accountId']
-                                if account_id != account.account_id:
-                                    raise AssertionError(f'Expected account {account.account_id} from MongoDB but got {account_id}.')
-                                last_post = int(doc['postedOrder'])
-                                last_date = doc['postingDate']
-                            log.info(f'Last transaction for account ID {account.account_id} for Telegram user {user.telegram_user_id} is {last_date} (posted order {last_post}). Fetching since...')
-                            response = None
-                            try:
-                                response = client.get_account_transactions(account_id=account.account_id, from_date=last_date)
-                            except HTTPError as e:
-                                raise ResourceWarning(f'Cannot fetch transactions for account {account.account_id}') from e
-                            log.debug(f'Accounts response: {response!s}')
-                            if access_token is None or client.access_token != access_token[0]:
-                                log.debug(f'Persisting access token...')
-                                asyncio.run(update_access_token(
-                                    telegram_user_id=user.telegram_user_id,
-                                    user_id=user.id,
-                                    access_token=client.access_token,
-                                    access_token_expiry=client.access_token_expiry))
-                            log.info(f'Fetched {len(response)} results from API. Collecting keys...')
-                            updates: List = []
-                            for tran in response:
-                                posted_order: int = int(tran['postedOrder'])
-                                if last_post and posted_order <= last_post:
-                                    log.debug(f'Skipping known transaction for account ID {account.account_id} with post order {posted_order}')
-                                    continue
-                                updates.append(tran)
-                            if len(updates) > 0:
-                                if self._do_db_mutations:
-                                    log.info(f'Inserting {len(updates)} into MongoDB collection...')
-                                    self._mongodb_collection.insert_many(updates)
-                                else:
-                                    log.warning(f'Not inserting {len(updates)} into MongoDB collection due to feature flag or config.')
-                            else:
-                                log.info(f'No new records to insert.')
-                    # respond to the trigger
-                    if trigger:
-                        response = None
-                        zmq_socket.send_pyobj(response)
-                    done_now = int(time.time())
-                    log.info(f'Sync completed in {done_now-now}s. Next account history sync is in {self._sync_interval_secs}s.')
+                        return client.get_account_transactions(account_id=account.account_id, **kwargs)
+                    except HTTPError as e:
+                        status: Optional[int] = e.response.status_code if e.response is not None else None
+                        if status is None or (status != TOO_MANY_REQUESTS and status < 500):
+                            raise
+                        retry_after: Optional[str] = e.response.headers.get('Retry-After')
+                influxdb.count('transaction_history', 'api_retries')
+                if attempt == API_RETRIES or threads.shutting_down:
+                    break
+                delay_secs = API_BACKOFF_SECS * 2 ** attempt
+                if retry_after and retry_after.isdigit():
+                    delay_secs = max(delay_secs, int(retry_after))
+                log.warning(f'Investec API responded {status} for account ID {account.account_id} ({kwargs}), retrying in {delay_secs}s...')
+                threads.interruptable_sleep.wait(delay_secs)
+            log.warning(f'Giving up on Investec API request for account ID {account.account_id} ({kwargs}) after {API_RETRIES} retries.')
+            return None
+
+        def _new_transactions(self, account: Account, response: List[Dict], last_post: Optional[int]) -> List[Dict]:
+            updates: List[Dict] = unseen_transactions(response=response, last_post=last_post)
+            log.debug(f'Skipping {len(response)-len(updates)} known or pending transactions for account ID {account.account_id}.')
+            for tran in updates:
+                normalize_account_transaction(doc=tran)
+            return updates
+
+        def _store(self, updates: List[Dict]) -> Tuple[int, Optional[int], Optional[str]]:
+            """
+            Returns the number of transactions that could not be written and
+            the newest transaction that the watermark may advance to.
+            """
+            result: UpsertResult = upsert_transactions(collection=self._mongodb_collection, updates=updates)
+            for index, errmsg in result.failed.items():
+                log.warning(f"Cannot upsert transaction with post order {updates[index]['postedOrder']} for account ID {updates[index]['accountId']}: {errmsg}")
+            log.debug(f'Upserted {result.upserted} and matched {result.matched} of {len(updates)} transactions ({len(result.failed)} failed).')
+            influxdb.count('transaction_history', 'inserted', result.upserted)
+            influxdb.count('transaction_history', 'matched', result.matched)
+            influxdb.count('transaction_history', 'duplicates', result.duplicates)
+            influxdb.count('transaction_history', 'upsert_errors', len(result.failed))
+            last_post, last_date = watermark(updates=updates, failed=result.failed.keys())
+            return len(result.failed), last_post, last_date
+
+        def _backfill_window(self, user: User, account: Account, client: PooledInvestecClient, window_start: date, window_end: date, today: date) -> Tuple[int, Optional[int], Optional[str], bool]:
+            """
+            Returns the number of transactions stored, the newest of them and
+            whether the window is complete, so that the sync watermark can be
+            written.
+            """
+            try:
+                response = self._fetch(
+                    client=client,
+                    account=account,
+                    from_date=window_start.isoformat(),
+                    to_date=min(window_end, today).isoformat())
+            except HTTPError as e:
+                raise ResourceWarning(f'Cannot fetch transactions for account {account.account_id} from {window_start} to {window_end}') from e
+            if response is None:
+                # left unrecorded, so fetched again on the next sync
+                return 0, None, None, False
+            self._persist_access_token(client=client)
+            updates: List = self._new_transactions(account=account, response=response, last_post=None)
+            last_post: Optional[int] = None
+            last_date: Optional[str] = None
+            failed: int = 0
+            if not self._do_db_mutations:
+                log.warning(f'Not inserting {len(updates)} into MongoDB collection due to feature flag or config.')
+                return len(updates), last_post, last_date, True
+            if len(updates) > 0:
+                failed, last_post, last_date = self._store(updates=updates)
+            log.debug(f'Backfilled {len(updates)-failed} transactions from {window_start} to {window_end} for account ID {account.account_id} ({failed} failed).')
+            if window_end < today and failed == 0:
+                # a closed window never needs fetching again
+                asyncio.run(add_backfill_window(
+                    telegram_user_id=user.telegram_user_id,
+                    user_id=user.id,
+                    account_id=account.account_id,
+                    window_start=window_start.isoformat(),
+                    window_end=window_end.isoformat(),
+                    transactions=len(updates),
+                    last_posted_order=last_post,
+                    last_posting_date=last_date))
+            return len(updates) - failed, last_post, last_date, failed == 0
+
+        def _backfill(self, user: User, account: Account, client: PooledInvestecClient, backfilled: List[BackfillWindow]) -> int:
+            """
+            Fetches the history of an account in date windows, a few at a time,
+            storing each window as it arrives. Completed windows are recorded
+            so that an interrupted backfill resumes where it left off. The
+            sync watermark is only written once every window is stored, so a
+            window that could not be fetched, or with transactions that could
+            not be written, is fetched again on the next sync.
+            """
+            start = time.perf_counter()
+            today = date.today()
+            done = {window.window_start for window in backfilled}
+            windows = [window for window in backfill_windows(today=today, backfill_days=self._backfill_days, window_days=self._backfill_window_days) if window[0].isoformat() not in done]
+            log.info(f'Backfilling {len(windows)} windows of {self._backfill_window_days} days for account ID {account.account_id} for Telegram user {user.telegram_user_id} ({len(done)} already done)...')
+            results: List[Tuple[int, Optional[int], Optional[str], bool]] = [(0, window.last_posted_order, window.last_posting_date, True) for window in backfilled]
+            window_fetches = [self._backfill_executor.submit(self._backfill_window, user, account, client, window_start, window_end, today) for window_start, window_end in windows]
+            for window_fetch in window_fetches:
+                results.append(window_fetch.result())
+            transactions = sum(result[0] for result in results)
+            incomplete = sum(1 for result in results if not result[3])
+            if incomplete > 0:
+                log.warning(f'Backfill of account ID {account.account_id} for Telegram user {user.telegram_user_id} could not complete {incomplete} windows; resuming on the next sync.')
+                return transactions
+            last_post: Optional[int] = None
+            last_date: Optional[str] = None
+            newest = max((result for result in results if result[1] is not None), key=lambda result: result[1], default=None)
+            if newest:
+                _, last_post, last_date, _ = newest
+            asyncio.run(update_sync_watermark(
+                telegram_user_id=user.telegram_user_id,
+                user_id=user.id,
+                account_id=account.account_id,
+                last_posted_order=last_post,
+                last_posting_date=last_date))
+            log.info(f'Backfilled account ID {account.account_id} for Telegram user {user.telegram_user_id} in {time.perf_counter()-start:.2f}s ({transactions} transactions).')
+            influxdb.observe('transaction_history', 'backfill_secs', time.perf_counter()-start)
+            return transactions
+
+        def _sync_account(self, user: User, account: Account) -> int:
+            start = time.perf_counter()
+            client = self._client(user=user)
+            last_post: Optional[int] = None
+            last_date: Optional[str] = None
+            watermark: Optional[SyncWatermark] = asyncio.run(get_sync_watermark(
+                telegram_user_id=user.telegram_user_id,
+                user_id=user.id,
+                account_id=account.account_id))
+            if watermark:
+                last_post = watermark.last_posted_order
+                last_date = watermark.last_posting_date
+            else:
+                backfilled: List[BackfillWindow] = asyncio.run(get_backfill_windows(
+                    telegram_user_id=user.telegram_user_id,
+                    user_id=user.id,
+                    account_id=account.account_id))
+                if len(backfilled) == 0:
+                    # cold start, so rebuild the watermark from the latest persisted
+                    mongo_query = {
+                        "accountId": {
+                            "$eq": account.account_id
+                        }
+                    }
+                    projection = {}
+                    sort = [
+                        ("postedOrder", DESCENDING)
+                    ]
+                    log.debug(f'Fetching data from MongoDB collection...')
+                    doc = self._mongodb_collection.find_one(mongo_query, projection=projection, sort=sort)
+                    if doc:
+                        account_id = doc['accountId']
+                        if account_id != account.account_id:
+                            raise AssertionError(f'Expected account {account.account_id} from MongoDB but got {account_id}.')
+                        last_post = int(doc['postedOrder'])
+                        last_date = doc['postingDate']
+                if last_post is None:
+                    # no history yet, or an interrupted backfill
+                    return self._backfill(user=user, account=account, client=client, backfilled=backfilled)
+            log.info(f'Last transaction for account ID {account.account_id} for Telegram user {user.telegram_user_id} is {last_date} (posted order {last_post}). Fetching since...')
+            response = None
+            try:
+                response = self._fetch(client=client, account=account, from_date=last_date)
+            except HTTPError as e:
+                raise ResourceWarning(f'Cannot fetch transactions for account {account.account_id}') from e
+            if response is None:
+                # the watermark is unchanged, and the account is synced less often until the API recovers
+                return 0
+            log.debug(f'Accounts response: {response!s}')
+            self._persist_access_token(client=client)
+            log.info(f'Fetched {len(response)} results from API. Collecting keys...')
+            updates: List = self._new_transactions(account=account, response=response, last_post=last_post)
+            failed: int = 0
+            if len(updates) > 0:
+                if self._do_db_mutations:
+                    log.info(f'Upserting {len(updates)} into MongoDB collection...')
+                    failed, stored_post, stored_date = self._store(updates=updates)
+                    if stored_post is not None:
+                        last_post, last_date = stored_post, stored_date
+                else:
+                    log.warning(f'Not inserting {len(updates)} into MongoDB collection due to feature flag or config.')
+            else:
+                log.info(f'No new records to insert.')
+            asyncio.run(update_sync_watermark(
+                telegram_user_id=user.telegram_user_id,
+                user_id=user.id,
+                account_id=account.account_id,
+                last_posted_order=last_post,
+                last_posting_date=last_date))
+            log.info(f'Synced account ID {account.account_id} for Telegram user {user.telegram_user_id} in {time.perf_counter()-start:.2f}s ({len(updates)-failed} new transactions, {failed} failed).')
+            return len(updates) - failed
+
+        def _load_accounts(self) -> None:
+            # fetch registered users
+            users: Optional[Sequence[User]] = asyncio.run(get_users())
+            if users is None:
+                log.info('No users registered.')
+                users = []
+            else:
+                log.info(f'Loaded {len(users)} users.')
+            accounts: Dict[str, Tuple[User, Account]] = {}
+            for user in users:
+                user_accounts: Optional[Sequence[Account]] = asyncio.run(get_accounts(telegram_user_id=user.telegram_user_id, user_id=user.id))
+                if user_accounts is None:
+                    log.info(f'No accounts for Telegram user {user.telegram_user_id}')
+                    continue
+                for account in user_accounts:
+                    accounts[account.account_id] = (user, account)
+            now = time.monotonic()
+            for account_id in accounts.keys() - self._accounts.keys():
+                # new accounts are synced straight away
+                self._intervals[account_id] = self._sync_interval_secs
+                self._next_sync[account_id] = now
+            for account_id in self._accounts.keys() - accounts.keys():
+                self._intervals.pop(account_id, None)
+                self._next_sync.pop(account_id, None)
+            self._accounts = accounts
+            self._last_load = now
+            log.info(f'Scheduling history sync for {len(accounts)} accounts.')
+
+        def _trigger(self, trigger: Optional[Dict]) -> int:
+            """
+            Brings forward the sync of the accounts named by the trigger: all
+            accounts, those of a Telegram user, or a single account. Targeted
+            accounts are treated as active and so are synced more often until
+            they go quiet again. Triggers for a user are ignored for the
+            minimum sync interval after one is honoured, because a burst of
+            card activity needs only one sync.
+            """
+            telegram_user_id: Optional[int] = trigger.get('telegram_user_id') if trigger else None
+            account_id: Optional[str] = trigger.get('account_id') if trigger else None
+            if telegram_user_id and account_id is None:
+                last_trigger = self._last_user_trigger.get(telegram_user_id)
+                if last_trigger is not None and time.monotonic() - last_trigger < self._min_interval_secs:
+                    log.debug(f'Ignoring history sync trigger for Telegram user {telegram_user_id} within {self._min_interval_secs}s of the last.')
+                    return 0
+                self._last_user_trigger[telegram_user_id] = time.monotonic()
+            known_users = {user.telegram_user_id for user, _ in self._accounts.values()}
+            if (telegram_user_id is None and account_id is None) or (account_id and account_id not in self._accounts) or (telegram_user_id and telegram_user_id not in known_users):
+                # also picks up newly registered users and accounts
+                self._load_accounts()
+            now = time.monotonic()
+            targeted: int = 0
+            for key, (user, account) in self._accounts.items():
+                if account_id and key != account_id:
+                    continue
+                if telegram_user_id and user.telegram_user_id != telegram_user_id:
+                    continue
+                if telegram_user_id or account_id:
+                    self._intervals[key] = self._min_interval_secs
+                self._next_sync[key] = now
+                targeted += 1
+            log.info(f'Triggered history sync of {targeted} accounts ({telegram_user_id=}, {account_id=}).')
+            return targeted
+
+        def _adapt(self, account_id: str, new_transactions: int) -> None:
+            interval = self._intervals.get(account_id, self._sync_interval_secs)
+            if new_transactions > 0:
+                interval = max(self._min_interval_secs, interval / 2)
+            else:
+                interval = min(self._max_interval_secs, interval * 1.5)
+            self._intervals[account_id] = interval
+            if account_id in self._next_sync:
+                self._next_sync[account_id] = time.monotonic() + interval
+            log.debug(f'Next history sync of account ID {account_id} is in {interval:.0f}s.')
+
+        def _collect(self) -> None:
+            for account_id, account_sync in list(self._in_flight.items()):
+                if not account_sync.done():
+                    continue
+                del self._in_flight[account_id]
+                try:
+                    new_transactions = account_sync.result()
+                except Exception:
+                    log.warning(f'Cannot sync account ID {account_id}, backing off.', exc_info=True)
+                    influxdb.count('transaction_history', 'sync_errors')
+                    # a failing account is retried less often, like a quiet one, and the others carry on
+                    new_transactions = 0
+                self._adapt(account_id=account_id, new_transactions=new_transactions)
+
+        @staticmethod
+        def _has_token(user: User) -> bool:
+            client: Optional[PooledInvestecClient] = investec_clients.get(user=user)
+            return client is not None and not client.token_expiring()
+
+        def _awaiting_token(self) -> Set[int]:
+            # users whose in-flight sync is still establishing the access token
+            users: Set[int] = set()
+            for account_id in self._in_flight.keys():
+                if account_id not in self._accounts:
+                    continue
+                user, _ = self._accounts[account_id]
+                if not self._has_token(user=user):
+                    users.add(user.id)
+            return users
+
+        def _dispatch(self, executor: ThreadPoolExecutor) -> None:
+            """
+            Submits due accounts. A user's first account syncs alone to
+            establish or refresh the access token, and the user's other
+            accounts then fan out with that token.
+            """
+            now = time.monotonic()
+            awaiting_token = self._awaiting_token()
+            for account_id, due in self._next_sync.items():
+                if due > now or account_id in self._in_flight:
+                    continue
+                user, account = self._accounts[account_id]
+                if user.id in awaiting_token:
+                    continue
+                self._in_flight[account_id] = executor.submit(self._sync_account, user, account)
+                if not self._has_token(user=user):
+                    awaiting_token.add(user.id)
+
+        def _poll_timeout_ms(self) -> int:
+            now = time.monotonic()
+            awaiting_token = self._awaiting_token()
+            next_due = min((due for account_id, due in self._next_sync.items() if account_id not in self._in_flight and self._accounts[account_id][0].id not in awaiting_token), default=now + MAX_POLL_SECS)
+            wait_secs = min(next_due - now, self._last_load + self._sync_interval_secs - now, MAX_POLL_SECS)
+            if self._in_flight:
+                # pick up completed syncs promptly
+                wait_secs = min(wait_secs, IN_FLIGHT_POLL_SECS)
+            return max(0, int(wait_secs * 1000))
+
+        def run(self):
+            executor = ThreadPoolExecutor(max_workers=self._sync_concurrency, thread_name_prefix='TransactionSync')
+            try:
+                with exception_handler(
+                    connect_url=URL_WORKER_TRANSACTION_HISTORY,
+                    socket_type=zmq.PULL,
+                    and_raise=False,
+                    shutdown_on_error=True) as zmq_socket:
+                    poller = zmq.Poller()
+                    poller.register(zmq_socket, zmq.POLLIN)
+                    self._load_accounts()
+                    while not threads.shutting_down:
+                        events = dict(poller.poll(timeout=self._poll_timeout_ms()))
+                        if zmq_socket in events:
+                            trigger: Optional[Dict] = zmq_socket.recv_pyobj()
+                            self._trigger(trigger=trigger)
+                        self._collect()
+                        if time.monotonic() - self._last_load >= self._sync_interval_secs:
+                            self._load_accounts()
+                        self._dispatch(executor=executor)
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._backfill_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def request_sync(telegram_user_id: Optional[int] = None, account_id: Optional[str] = None) -> bool:
+    """
+    Asks the transaction history thread to sync now, for all accounts or
+    only those of a user or a single account. Never blocks: returns whether
+    the trigger was queued for the thread.
+    """
+    with exception_handler(connect_url=URL_WORKER_TRANSACTION_HISTORY, socket_type=zmq.PUSH, and_raise=False) as zmq_socket:
+        try:
+            zmq_socket.send_pyobj({'telegram_user_id': telegram_user_id, 'account_id': account_id}, flags=zmq.DONTWAIT)
+            return True
+        except Again:
+            log.warning(f'Cannot queue history sync trigger ({telegram_user_id=}, {account_id=}).')
+    return False
@@ -0,0 +1,50 @@
+from app.aggregate import OTHER_LABEL, Aggregator
+
+
+def aggregator() -> Aggregator:
+    charges = Aggregator()
+    charges.put(key='grocer', amount=500.0, count=2, label='Grocer')
+    charges.put(key='fuel', amount=300.0, label='Fuel Stop')
+    charges.put(key='cafe', amount=50.0, label='Corner Cafe')
+    charges.put(key='toll', amount=20.0, label='Toll Road')
+    charges.put(key='grocer', amount=100.0, label='Grocer Again')
+    return charges
+
+
+def test_totals():
+    charges = aggregator()
+    assert (charges.count, charges.total) == (6, 970.0)
+    assert charges.get(key='grocer') == (3, 600.0)
+    assert charges.get(key='unknown') == (0, 0.0)
+
+
+def test_top_without_limit():
+    # the first label seen for a key is the one shown
+    assert aggregator().top() == [('Grocer', 600.0), ('Fuel Stop', 300.0), ('Corner Cafe', 50.0), ('Toll Road', 20.0)]
+
+
+def test_top_sums_the_rest_into_other():
+    assert aggregator().top(n=2) == [('Grocer', 600.0), ('Fuel Stop', 300.0), (OTHER_LABEL, 70.0)]
+
+
+def test_top_has_no_other_when_everything_fits():
+    assert aggregator().top(n=4)[-1] == ('Toll Road', 20.0)
+
+
+def test_no_other_for_a_net_refund():
+    charges = aggregator()
+    charges.put(key='refund', amount=-100.0, label='Refund')
+    assert charges.top(n=2) == [('Grocer', 600.0), ('Fuel Stop', 300.0)]
+
+
+def test_round_trip():
+    charges = aggregator()
+    restored = Aggregator.from_dict(data=charges.to_dict())
+    assert (restored.count, restored.total) == (charges.count, charges.total)
+    assert restored.top(n=2) == charges.top(n=2)
+
+
+def test_excluded_rows_are_not_counted():
+    charges = aggregator()
+    charges.exclude(count=3)
+    assert (charges.count, charges.excluded) == (6, 3)
@@ -0,0 +1,68 @@
+from app.chartcache import Chart, ChartCache
+
+
+def cache(max_entries: int = 10, max_bytes: int = 100) -> ChartCache:
+    charts = ChartCache()
+    charts.configure(max_entries=max_entries, max_bytes=max_bytes)
+    return charts
+
+
+def chart(key: str, size: int) -> Chart:
+    return Chart(key=key, img_bytes=b'x' * size)
+
+
+def test_uploaded_releases_image_bytes():
+    charts = cache(max_bytes=100)
+    first, second = chart('first', 60), chart('second', 30)
+    charts.put(chart=first)
+    charts.put(chart=second)
+    charts.uploaded(chart=first, file_id='file')
+    assert (first.img_bytes, first.photo) == (None, 'file')
+    # room for another image now that the first is sent by reference
+    charts.put(chart=chart('third', 60))
+    assert charts.get(key='first') is first
+    assert charts.get(key='second') is second
+
+
+def test_uploaded_twice_is_counted_once():
+    charts = cache(max_bytes=100)
+    first = chart('first', 60)
+    charts.put(chart=first)
+    charts.uploaded(chart=first, file_id='file')
+    charts.uploaded(chart=first, file_id='other')
+    assert first.file_id == 'file'
+    charts.put(chart=chart('second', 100))
+    # a second release would have let a third image in alongside
+    charts.put(chart=chart('third', 1))
+    assert charts.get(key='second') is None
+
+
+def test_uploaded_after_eviction_leaves_cache_alone():
+    charts = cache(max_bytes=100)
+    evicted = chart('evicted', 60)
+    charts.put(chart=evicted)
+    charts.put(chart=chart('replacement', 100))
+    assert charts.get(key='evicted') is None
+    charts.uploaded(chart=evicted, file_id='file')
+    charts.put(chart=chart('third', 1))
+    assert charts.get(key='replacement') is None
+
+
+def test_discard_after_uploaded():
+    charts = cache(max_bytes=100)
+    first = chart('first', 60)
+    charts.put(chart=first)
+    charts.uploaded(chart=first, file_id='file')
+    charts.discard(key='first')
+    charts.put(chart=chart('full', 100))
+    assert charts.get(key='full') is not None
+
+
+def test_evicts_least_recently_used():
+    charts = cache(max_entries=2, max_bytes=100)
+    charts.put(chart=chart('a', 1))
+    charts.put(chart=chart('b', 1))
+    charts.get(key='a')
+    charts.put(chart=chart('c', 1))
+    assert charts.get(key='b') is None
+    assert charts.get(key='a') is not None
@@ -0,0 +1,80 @@
+from datetime import date
+
+import pytest
+
+from pymongo.errors import BulkWriteError
+
+from app.history import DUPLICATE_KEY_ERROR, backfill_windows, unseen_transactions, upsert_transactions, watermark
+
+
+def transaction(posted_order: int) -> dict:
+    return {
+        'accountId': 'account',
+        'postedOrder': posted_order,
+        'postingDate': f'2026-10-{posted_order:02d}'
+    }
+
+
+class FakeCollection(object):
+    def __init__(self, write_errors: list):
+        self._write_errors = write_errors
+        self.operations = []
+
+    def bulk_write(self, operations, ordered):
+        self.operations = operations
+        raise BulkWriteError({
+            'nUpserted': len(operations) - len(self._write_errors),
+            'nMatched': 0,
+            'writeErrors': self._write_errors
+        })
+
+
+def test_unseen_transactions_skip_pending_and_known():
+    response = [transaction(0), transaction(4), transaction(5), transaction(6)]
+    assert [tran['postedOrder'] for tran in unseen_transactions(response=response, last_post=4)] == [5, 6]
+    assert [tran['postedOrder'] for tran in unseen_transactions(response=response, last_post=None)] == [4, 5, 6]
+
+
+def test_duplicates_are_stored():
+    updates = [transaction(1), transaction(2), transaction(3)]
+    collection = FakeCollection(write_errors=[{'index': 1, 'code': DUPLICATE_KEY_ERROR, 'errmsg': 'E11000 duplicate key'}])
+    result = upsert_transactions(collection=collection, updates=updates)
+    assert len(collection.operations) == 3
+    assert (result.upserted, result.duplicates, result.failed) == (2, 1, {})
+    assert watermark(updates=updates, failed=result.failed.keys()) == (3, '2026-10-03')
+
+
+def test_watermark_stops_below_first_failure():
+    updates = [transaction(5), transaction(3), transaction(1), transaction(4), transaction(2)]
+    collection = FakeCollection(write_errors=[
+        {'index': 0, 'code': DUPLICATE_KEY_ERROR, 'errmsg': 'E11000 duplicate key'},
+        {'index': 3, 'code': 121, 'errmsg': 'Document failed validation'},
+    ])
+    result = upsert_transactions(collection=collection, updates=updates)
+    assert (result.duplicates, result.failed) == (1, {3: 'Document failed validation'})
+    # 5 is stored but lies beyond the failed 4, which must be fetched again
+    assert watermark(updates=updates, failed=result.failed.keys()) == (3, '2026-10-03')
+
+
+def test_watermark_without_stored_transactions():
+    updates = [transaction(2), transaction(1)]
+    assert watermark(updates=updates, failed={1}) == (None, None)
+
+
+@pytest.mark.parametrize('today', [date(2026, 10, 18), date(2026, 1, 1), date(2024, 2, 29)])
+def test_backfill_windows_cover_history(today):
+    windows = backfill_windows(today=today, backfill_days=730, window_days=30)
+    assert windows[0][0] <= date.fromordinal(today.toordinal() - 730) <= windows[0][1]
+    assert windows[-1][0] <= today <= windows[-1][1]
+    for start, end in windows:
+        assert (end - start).days == 29
+    for (_, end), (start, _) in zip(windows, windows[1:]):
+        assert (start - end).days == 1
+
+
+def test_backfill_windows_are_stable_across_days():
+    today = date(2026, 10, 18)
+    windows = backfill_windows(today=today, backfill_days=730, window_days=30)
+    later = backfill_windows(today=date(2026, 11, 30), backfill_days=730, window_days=30)
+    # a resumed backfill finds the windows that were already recorded
+    assert {window for window in later if window[0] <= today} <= set(windows)
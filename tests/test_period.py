@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import pytest
+
+from app import period
+from app.period import DEFAULT_INTERVAL, describe_report_period, get_report_period
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 10, 18, 9, 30)
+
+
+@pytest.fixture(autouse=True)
+def fixed_now(monkeypatch):
+    monkeypatch.setattr(period, 'datetime', FixedDatetime)
+
+
+def test_current_month_is_open():
+    period_start, period_end = get_report_period(interval=DEFAULT_INTERVAL, periods_ago=0)
+    assert period_start == datetime(2026, 9, 18, 9, 30)
+    assert period_end is None
+
+
+def test_previous_month_is_last_complete_month():
+    period_start, period_end = get_report_period(interval=DEFAULT_INTERVAL, periods_ago=1)
+    assert (period_start, period_end) == (datetime(2026, 9, 1), datetime(2026, 10, 1))
+    assert describe_report_period(period_start=period_start, period_end=period_end) == 'from 01 September 2026 to 30 September 2026'
+
+
+def test_earlier_months():
+    assert get_report_period(interval=DEFAULT_INTERVAL, periods_ago=2) == (datetime(2026, 8, 1), datetime(2026, 9, 1))
+    assert get_report_period(interval=DEFAULT_INTERVAL, periods_ago=10) == (datetime(2025, 12, 1), datetime(2026, 1, 1))
+
+
+def test_billing_cycle_periods():
+    assert get_report_period(interval='15', periods_ago=0) == (datetime(2026, 10, 15, 9, 30), None)
+    assert get_report_period(interval='15', periods_ago=1) == (datetime(2026, 9, 15), datetime(2026, 10, 15))
+    # the billing day has not yet come round this month
+    assert get_report_period(interval='25', periods_ago=0) == (datetime(2026, 9, 25, 9, 30), None)
+    assert get_report_period(interval='25', periods_ago=1) == (datetime(2026, 8, 25), datetime(2026, 9, 25))